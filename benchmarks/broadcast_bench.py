@@ -0,0 +1,132 @@
+# benchmarks/broadcast_bench.py
+"""Broadcast latency vs. room size for ConnectionManager.
+
+Runs without a database, against in-memory fake sockets. Compares the old
+sequential fan-out (one json.dumps and one awaited send per recipient) with
+the current ConnectionManager.broadcast, timed until every recipient's writer
+task has delivered the frame.
+
+    python benchmarks/broadcast_bench.py [--sizes 10,100,1000] [--latency-ms 1]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_ws import ConnectionManager  # noqa: E402
+
+MESSAGE = {
+    "type": "chat",
+    "id": 12345,
+    "sender": "benchmark_user",
+    "content": "The quick brown fox jumps over the lazy dog " * 3,
+    "timestamp": "2024-01-01T12:00:00.000000",
+    "room_id": 1,
+}
+
+
+class Delivery:
+    """Counts down deliveries so a run can wait until all recipients got a frame."""
+
+    def __init__(self):
+        self.remaining = 0
+        self.done = asyncio.Event()
+
+    def expect(self, count: int):
+        self.remaining = count
+        self.done.clear()
+
+    def delivered(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+
+class FakeWebSocket:
+    """Accepts frames after ``latency`` seconds, like a socket on a real link."""
+
+    def __init__(self, delivery: Delivery, latency: float = 0.0):
+        self.delivery = delivery
+        self.latency = latency
+        self.sent = 0
+
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+        self.sent += 1
+        self.delivery.delivered()
+
+
+async def legacy_broadcast(connections: list, message: dict):
+    for connection in connections:
+        await connection.websocket.send_text(json.dumps(message))
+
+
+async def queued_broadcast(manager: ConnectionManager, room: str, delivery: Delivery, size: int):
+    delivery.expect(size)
+    await manager.broadcast(MESSAGE, room)
+    await delivery.done.wait()
+
+
+async def time_it(coro_factory, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await coro_factory()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+async def run(sizes, latency_ms, repeat, legacy_limit, out):
+    manager = ConnectionManager(send_timeout=30, queue_size=repeat + 1)
+    delivery = Delivery()
+    latency = latency_ms / 1000
+    print(f"per-send latency: {latency_ms} ms, best of {repeat}", file=out)
+    print(f"{'room size':>10} {'legacy ms':>12} {'broadcast ms':>14} {'speedup':>9}", file=out)
+    for size in sizes:
+        room = f"room-{size}"
+        connections = []
+        for i in range(size):
+            user = {"user_id": str(i), "username": f"user{i}", "role": "user"}
+            connections.append(await manager.connect(FakeWebSocket(delivery, latency), room, user))
+
+        current = await time_it(lambda: queued_broadcast(manager, room, delivery, size), repeat)
+        if size <= legacy_limit:
+            delivery.expect(-1)  # not waited on
+            legacy = await time_it(lambda: legacy_broadcast(connections, MESSAGE), repeat)
+            print(f"{size:>10} {legacy:>12.2f} {current:>14.2f} {legacy / current:>8.1f}x", file=out)
+        else:
+            print(f"{size:>10} {'-':>12} {current:>14.2f} {'-':>9}", file=out)
+        for connection in connections:
+            manager.disconnect(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy-limit", type=int, default=10000,
+                        help="skip the sequential baseline above this room size")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+    # The manager logs every connect/disconnect; keep that out of the timings
+    out = sys.stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(run(sizes, args.latency_ms, args.repeat, args.legacy_limit, out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+# benchmarks/loadgen.py
+"""WebSocket load generator for a running chat server.
+
+Signs up (or logs in) N synthetic users over /signup and /login, spreads them
+across M rooms created by the first user, opens one /ws/token/{room_token}
+socket per user and sends chat messages at a fixed rate for a while. Every
+message carries its send time, so each delivery to every member of the room
+gives an end-to-end latency sample (clients share this process's clock).
+
+Reports join latency (socket open until the first history frame), delivery
+latency percentiles and throughput, plus the server's own counters from
+/metrics when it is reachable.
+
+    uvicorn main:app                     # against a local Postgres
+    python benchmarks/loadgen.py --users 200 --rooms 10 --rate 0.5 --duration 30
+
+Needs the ``websockets`` package (and ``msgpack`` for --encoding msgpack).
+Raise ``ulimit -n`` for thousands of sockets.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire  # noqa: E402
+
+# Prefix of generated message content, followed by "<sender>:<seq>:<monotonic ns>"
+MARKER = "lt:"
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50),
+        "p90_ms": percentile(samples, 90),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples) if samples else None
+    }
+
+
+class Http:
+    """Blocking JSON requests, run on threads so setup can overlap."""
+
+    def __init__(self, base_url: str, concurrency: int):
+        self.base_url = base_url.rstrip("/")
+        self.slots = asyncio.Semaphore(concurrency)
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None, token: Optional[str] = None):
+        """(status, parsed body); 503s from a busy password pool are retried."""
+        async with self.slots:
+            for attempt in range(5):
+                status, data = await asyncio.to_thread(self._request, method, path, body, token)
+                if status != 503:
+                    return status, data
+                await asyncio.sleep(0.2 * 2 ** attempt)
+            return status, data
+
+    def _request(self, method, path, body, token):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, self._parse(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, self._parse(e.read())
+
+    @staticmethod
+    def _parse(raw: bytes):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw.decode(errors="replace")
+
+
+async def get_token(http: Http, username: str, password: str) -> str:
+    status, data = await http.request("POST", "/signup", {
+        "username": username,
+        "email": f"{username}@loadtest.invalid",
+        "password": password
+    })
+    if status not in (200, 400):  # 400: already signed up by an earlier run
+        raise RuntimeError(f"signup {username} failed: {status} {data}")
+    status, data = await http.request("POST", "/login", {"username": username, "password": password})
+    if status != 200:
+        raise RuntimeError(f"login {username} failed: {status} {data}")
+    return data["access_token"]
+
+
+async def ensure_rooms(http: Http, token: str, prefix: str, count: int) -> List[str]:
+    """Tokens of rooms <prefix>-room-0..count-1, reusing ones from earlier runs."""
+    status, data = await http.request("GET", "/users/me/rooms", token=token)
+    if status != 200:
+        raise RuntimeError(f"listing rooms failed: {status} {data}")
+    existing = {room["name"]: room["token"] for room in data}
+    tokens = []
+    for i in range(count):
+        name = f"{prefix}-room-{i}"
+        if name not in existing:
+            status, data = await http.request("POST", "/rooms/create", {"name": name}, token=token)
+            if status != 200:
+                raise RuntimeError(f"creating {name} failed: {status} {data}")
+            existing[name] = data["room_token"]
+        tokens.append(existing[name])
+    return tokens
+
+
+class Stats:
+    def __init__(self):
+        self.join_ms: List[float] = []
+        self.delivery_ms: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.errors: Dict[str, int] = {}
+        self.measuring = False
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class Client:
+    def __init__(self, index: int, token: str, room_token: str, ws_url: str, stats: Stats, encoding: str = wire.JSON):
+        self.index = index
+        self.encoding = encoding
+        self.token = token
+        self.room_token = room_token
+        self.ws_url = ws_url
+        self.stats = stats
+        self.socket = None
+        self.sent = 0
+        self.joined = asyncio.Event()
+        self.reader: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        start = time.perf_counter()
+        try:
+            self.socket = await websockets.connect(
+                f"{self.ws_url}/ws/token/{self.room_token}?token={self.token}",
+                subprotocols=[f"chat.{self.encoding}"],
+                max_size=None,
+                ping_interval=None  # the server sends its own application pings
+            )
+            self.reader = asyncio.ensure_future(self._read())
+            await asyncio.wait_for(self.joined.wait(), timeout=30)
+        except Exception as e:
+            self.stats.error(f"connect: {type(e).__name__}")
+            return False
+        self.stats.join_ms.append((time.perf_counter() - start) * 1000)
+        return True
+
+    async def send_loop(self, rate: float, stop_at: float):
+        """Send ``rate`` messages per second, with random jitter, until ``stop_at``."""
+        seq = 0
+        await asyncio.sleep(random.uniform(0, 1 / rate))
+        while time.monotonic() < stop_at:
+            seq += 1
+            try:
+                await self.socket.send(f"{MARKER}{self.index}:{seq}:{time.monotonic_ns()}")
+                self.sent += 1
+                self.stats.sent += 1
+            except Exception as e:
+                self.stats.error(f"send: {type(e).__name__}")
+                return
+            await asyncio.sleep(random.expovariate(rate))
+
+    async def close(self):
+        if self.socket is not None:
+            try:
+                await self.socket.close()
+            except Exception:
+                pass
+        if self.reader is not None:
+            self.reader.cancel()
+
+    async def _read(self):
+        try:
+            async for raw in self.socket:
+                for frame in decode(raw):
+                    await self._handle(frame)
+        except websockets.ConnectionClosed as e:
+            if self.stats.measuring:
+                self.stats.error(f"closed: {e.code}")
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle(self, frame: dict):
+        kind = frame.get("type")
+        if kind == "ping":
+            await self.socket.send('{"type": "pong"}')
+        elif kind == "history":
+            self.joined.set()
+        elif kind == "chat":
+            content = frame.get("content", "")
+            if content.startswith(MARKER) and self.stats.measuring:
+                sent_ns = int(content.rsplit(":", 1)[1])
+                self.stats.delivery_ms.append((time.monotonic_ns() - sent_ns) / 1e6)
+                self.stats.received += 1
+        elif kind == "error":
+            self.stats.error(f"server: {frame.get('content')}")
+
+
+def _long_keys(frame: dict) -> dict:
+    return {wire.LONG_KEYS.get(key, key): value for key, value in frame.items()}
+
+
+def decode(raw) -> List[dict]:
+    """Server frames in a WebSocket message; batch frames are unpacked."""
+    if isinstance(raw, bytes):
+        frame = _long_keys(wire.msgpack.unpackb(raw))
+        if frame.get("type") == "batch":
+            return [_long_keys(inner) for inner in frame["frames"]]
+        return [frame]
+    frame = json.loads(raw)
+    return frame["frames"] if frame.get("type") == "batch" else [frame]
+
+
+async def scrape_metrics(http: Http) -> Dict[str, float]:
+    """Unlabelled and labelled samples from /metrics, or {} if unavailable."""
+    try:
+        status, data = await http.request("GET", "/metrics")
+    except Exception:
+        return {}
+    if status != 200 or not isinstance(data, str):
+        return {}
+    samples = {}
+    for line in data.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            try:
+                samples[name] = float(value)
+            except ValueError:
+                pass
+    return samples
+
+
+async def run(args) -> dict:
+    http = Http(args.url, args.setup_concurrency)
+    parts = urlsplit(args.url)
+    ws_url = f"{'wss' if parts.scheme == 'https' else 'ws'}://{parts.netloc}"
+    stats = Stats()
+
+    print(f"Setting up {args.users} users and {args.rooms} rooms...", file=sys.stderr)
+    setup_start = time.perf_counter()
+    tokens = await asyncio.gather(*[
+        get_token(http, f"{args.prefix}_user_{i}", args.password) for i in range(args.users)
+    ])
+    rooms = await ensure_rooms(http, tokens[0], args.prefix, args.rooms)
+    setup_s = time.perf_counter() - setup_start
+
+    clients = [
+        Client(i, token, rooms[i % len(rooms)], ws_url, stats, args.encoding)
+        for i, token in enumerate(tokens)
+    ]
+    print(f"Opening {len(clients)} sockets...", file=sys.stderr)
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with connect_slots:
+            return await client.connect()
+
+    connected = await asyncio.gather(*[connect(client) for client in clients])
+    clients = [client for client, ok in zip(clients, connected) if ok]
+    if not clients:
+        raise RuntimeError(f"no socket could connect: {stats.errors}")
+
+    before = await scrape_metrics(http)
+    print(f"Sending for {args.duration}s at {args.rate} msg/s per user...", file=sys.stderr)
+    stats.measuring = True
+    start = time.monotonic()
+    await asyncio.gather(*[client.send_loop(args.rate, start + args.duration) for client in clients])
+    # Let in-flight messages arrive
+    await asyncio.sleep(args.drain)
+    stats.measuring = False
+    elapsed = time.monotonic() - start
+    after = await scrape_metrics(http)
+
+    for client in clients:
+        await client.close()
+
+    members = {}
+    for client in clients:
+        members[client.room_token] = members.get(client.room_token, 0) + 1
+    # Every message goes to every member of its room, the sender included
+    expected = sum(client.sent * members[client.room_token] for client in clients)
+
+    report = {
+        "encoding": args.encoding,
+        "users": args.users,
+        "rooms": args.rooms,
+        "connected": len(clients),
+        "setup_s": round(setup_s, 2),
+        "duration_s": round(elapsed, 2),
+        "join": summarize(stats.join_ms),
+        "delivery": summarize(stats.delivery_ms),
+        "sent": stats.sent,
+        "delivered": stats.received,
+        "expected_deliveries": expected,
+        "sent_per_s": round(stats.sent / elapsed, 1),
+        "delivered_per_s": round(stats.received / elapsed, 1),
+        "errors": stats.errors
+    }
+    if before and after:
+        def delta(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        written = delta("chat_messages_written_total")
+        frames = delta('chat_ws_frames_total{outcome="sent"}')
+        report["server"] = {
+            "messages_written_per_s": round(written / elapsed, 1),
+            "frames_sent_per_s": round(frames / elapsed, 1),
+            "frames_saved": delta('chat_ws_broadcast_frames_total{kind="saved"}'),
+            "bytes_saved": delta('chat_ws_broadcast_bytes_total{kind="saved"}'),
+            "slow_queries": delta("chat_db_slow_queries_total")
+        }
+    return report
+
+
+def print_report(report: dict):
+    def ms(value):
+        return f"{value:.1f}" if value is not None else "-"
+
+    print(f"users {report['users']} ({report['connected']} connected), rooms {report['rooms']}, "
+          f"setup {report['setup_s']}s, measured {report['duration_s']}s")
+    print(f"{'':>10} {'count':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name in ("join", "delivery"):
+        row = report[name]
+        print(f"{name:>10} {row['count']:>8} {ms(row['p50_ms']):>9} {ms(row['p90_ms']):>9} "
+              f"{ms(row['p99_ms']):>9} {ms(row['max_ms']):>9}")
+    print(f"sent {report['sent']} ({report['sent_per_s']}/s), delivered {report['delivered']} "
+          f"({report['delivered_per_s']}/s) of ~{report['expected_deliveries']} expected")
+    if "server" in report:
+        server = report["server"]
+        print(f"server: {server['messages_written_per_s']} messages written/s, "
+              f"{server['frames_sent_per_s']} frames sent/s, {server['slow_queries']:.0f} slow queries")
+        print(f"server: {server['frames_saved']:.0f} frames saved by coalescing, "
+              f"{server['bytes_saved']:.0f} bytes saved by encoding")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for in-flight messages")
+    parser.add_argument("--prefix", default="loadtest", help="names of generated users and rooms")
+    parser.add_argument("--password", default="loadtest-password")
+    parser.add_argument("--setup-concurrency", type=int, default=16, help="signup/login requests at once")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="sockets opened at once")
+    parser.add_argument("--encoding", choices=(wire.JSON, wire.MSGPACK), default=wire.JSON,
+                        help="wire encoding the sockets negotiate")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.users < 1 or args.rooms < 1:
+        parser.error("--rate, --users and --rooms must be positive")
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# benchmarks/microbench.py
+"""Microbenchmarks for ConnectionManager and the message hot path.
+
+Runs without a database. Sockets are in-memory fakes, and history rows come
+from memory. Each case reports the best of ``--repeat`` runs, as time per
+operation:
+
+    connect/disconnect   per connection, for rooms of 10 to 10k members
+    broadcast            per message, until every member's writer delivered it
+    encode               one chat frame, as broadcast encodes it (and as
+                         msgpack, when installed)
+    history cached       one history page served from the history cache
+    history db rows      one history page formatted from database rows
+
+Results are compared with benchmarks/baseline.json. Slower cases beyond
+``--threshold`` are flagged, and the exit status is 1 so CI can fail on them.
+Baselines are machine specific. Record one with --save on the machine that
+runs the comparison.
+
+    python benchmarks/microbench.py                # compare with the baseline
+    python benchmarks/microbench.py --save         # record a new baseline
+    python benchmarks/microbench.py --sizes 10,1000 --repeat 3
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chat_ws  # noqa: E402
+import database  # noqa: E402
+from chat_ws import ConnectionManager  # noqa: E402
+from history_cache import RoomHistoryCache  # noqa: E402
+import wire  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+MESSAGE = {
+    "type": "chat",
+    "id": 12345,
+    "sender": "benchmark_user",
+    "content": "The quick brown fox jumps over the lazy dog " * 3,
+    "timestamp": "2024-01-01T12:00:00.000000",
+    "room_id": 1,
+}
+
+
+class FakeWebSocket:
+    """Accepts every frame immediately and tells ``on_send`` about it."""
+
+    def __init__(self, on_send=None):
+        self.on_send = on_send
+
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        if self.on_send is not None:
+            self.on_send()
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+class FakeOutbound:
+    """Collects frames like an OutboundQueue, without a writer task."""
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, payload: str, key=None) -> bool:
+        self.frames.append(payload)
+        return True
+
+
+def _users(count: int):
+    return [{"user_id": str(i), "username": f"user{i}", "role": "user"} for i in range(count)]
+
+
+def _history(count: int):
+    start = datetime(2024, 1, 1, 12)
+    return [{
+        "id": i,
+        "sender": f"user{i % 7}",
+        "content": MESSAGE["content"],
+        "created_at": start + timedelta(seconds=i)
+    } for i in range(1, count + 1)]
+
+
+async def best_of(repeat: int, run) -> float:
+    """Best wall time of ``repeat`` runs of ``await run()``, in seconds.
+
+    The garbage collector is paused while timing so a collection triggered by
+    one case's garbage does not land in another's numbers.
+    """
+    await run()  # warm-up: caches, allocator, lazily created state
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            await run()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+async def bench_connect(size: int, repeat: int) -> float:
+    """Microseconds to connect and then disconnect one member of a ``size`` room."""
+    manager = ConnectionManager(ping_interval=0, ping_timeout=0)
+    users = _users(size)
+
+    async def run():
+        connections = [await manager.connect(FakeWebSocket(), "room", user) for user in users]
+        for connection in connections:
+            manager.disconnect(connection)
+        # Let the cancelled writer tasks finish so runs do not pile up
+        await asyncio.sleep(0)
+
+    return await best_of(repeat, run) / size * 1e6
+
+
+async def bench_broadcast(size: int, repeat: int) -> float:
+    """Milliseconds from broadcast() until every member of a ``size`` room got the frame."""
+    manager = ConnectionManager(ping_interval=0, ping_timeout=0, queue_size=repeat + 2)
+    remaining = [0]
+    done = asyncio.Event()
+
+    def delivered():
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            done.set()
+
+    connections = [await manager.connect(FakeWebSocket(delivered), "room", user) for user in _users(size)]
+
+    async def run():
+        remaining[0] = size
+        done.clear()
+        await manager.broadcast(MESSAGE, "room")
+        await done.wait()
+
+    try:
+        return await best_of(repeat, run) * 1000
+    finally:
+        for connection in connections:
+            manager.disconnect(connection)
+        await asyncio.sleep(0)
+
+
+async def bench_encode(repeat: int, loops: int = 10000) -> float:
+    """Microseconds to encode one chat frame the way broadcast() does."""
+    async def run():
+        for _ in range(loops):
+            json.dumps({**MESSAGE, "room_token": "room"})
+
+    return await best_of(repeat, run) / loops * 1e6
+
+
+async def bench_encode_msgpack(repeat: int, loops: int = 10000) -> float:
+    """Microseconds to re-encode a broadcast JSON frame as compact msgpack."""
+    payload = json.dumps({**MESSAGE, "room_token": "room"})
+
+    async def run():
+        for _ in range(loops):
+            wire.pack_json(payload)
+
+    return await best_of(repeat, run) / loops * 1e6
+
+
+async def bench_history_cached(repeat: int, loops: int = 2000) -> float:
+    """Microseconds to serve the latest history page from a warm cache."""
+    cache = RoomHistoryCache()
+    cache.warm(1, [
+        {"id": row["id"], "sender": row["sender"], "content": row["content"], "timestamp": row["created_at"].isoformat()}
+        for row in _history(cache.per_room)
+    ])
+    outbound = FakeOutbound()
+    saved, chat_ws.history_cache = chat_ws.history_cache, cache
+
+    async def run():
+        outbound.frames.clear()
+        for _ in range(loops):
+            await chat_ws.send_recent_messages(outbound, 1, room_token="room")
+
+    try:
+        return await best_of(repeat, run) / loops * 1e6
+    finally:
+        chat_ws.history_cache = saved
+
+
+async def bench_history_rows(repeat: int, loops: int = 2000) -> float:
+    """Microseconds to format an older history page from (in-memory) database rows."""
+    rows = list(reversed(_history(chat_ws.HISTORY_PAGE_SIZE + 1)))
+    outbound = FakeOutbound()
+
+    async def fetch_all(query, params=None):
+        return rows
+
+    # Pages go through database.fetch_page, which calls database.fetch_all
+    saved, database.fetch_all = database.fetch_all, fetch_all
+
+    async def run():
+        outbound.frames.clear()
+        for _ in range(loops):
+            await chat_ws.send_recent_messages(outbound, 1, before_id=10 ** 9, room_token="room")
+
+    try:
+        return await best_of(repeat, run) / loops * 1e6
+    finally:
+        database.fetch_all = saved
+
+
+async def run_all(sizes, repeat: int) -> dict:
+    results = {}
+    for size in sizes:
+        results[f"connect_disconnect_us[{size}]"] = await bench_connect(size, repeat)
+    for size in sizes:
+        results[f"broadcast_ms[{size}]"] = await bench_broadcast(size, repeat)
+    results["encode_chat_us"] = await bench_encode(repeat)
+    if wire.MSGPACK in wire.available():
+        results["encode_chat_msgpack_us"] = await bench_encode_msgpack(repeat)
+    results["history_cached_us"] = await bench_history_cached(repeat)
+    results["history_db_rows_us"] = await bench_history_rows(repeat)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Print results against the baseline; returns how many cases regressed."""
+    regressions = 0
+    print(f"{'case':<30} {'baseline':>12} {'now':>12} {'change':>9}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<30} {'-':>12} {value:>12.3f} {'new':>9}")
+            continue
+        change = (value - base) / base if base else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<30} {base:>12.3f} {value:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fractional slowdown vs. the baseline that counts as a regression")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    # The manager logs every connect/disconnect; keep that out of the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run_all(sizes, args.repeat))
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({name: round(value, 4) for name, value in results.items()}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        for name, value in results.items():
+            print(f"{name:<30} {value:>12.3f}")
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        print(f"No baseline at {args.baseline}; run with --save to record one")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{regressions} case(s) slower than the baseline by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
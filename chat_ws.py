@@ -1,203 +1,1036 @@
 # chat_ws.py
 from fastapi import WebSocket, WebSocketDisconnect, APIRouter, Query, HTTPException, status
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import json
-from database import get_cursor
+import os
+import sys
+import time
+from database import fetch_one, fetch_all, fetch_page, execute
+from outbound import OutboundQueue, DROP_OLDEST, SLOW_CONSUMER
+from registry import Connection, RoomMembers, intern_key
+from pubsub import PubSub, CONTROL_ROOM, encode_event
+from presence import PresenceTracker
+from coalescing import FrameCoalescer, MAX_COALESCE_WINDOW_MS
+from history_cache import RoomHistoryCache
+from message_writer import MessageWriter
+from room_cache import room_cache
+from ttl_cache import TTLCache
+from dependencies import authenticate
+from search import search_messages, SearchError, SEARCH_PAGE_SIZE, RANK
+from read_markers import UnreadNotifier, mark_read, unread_frame
+from metrics import ws_messages_in, ws_broadcast_seconds
+import wire
 
 router = APIRouter()
 
-SECRET_KEY = "brahmabyte_irfanAlam"
-ALGORITHM = "HS256"
+# Max seconds a single recipient may take to accept a frame before it is dropped
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# Per-connection outbound queue bound and what to do when a client falls behind
+QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", DROP_OLDEST)
+# Heartbeats: every WS_PING_INTERVAL seconds each socket is sent a ping frame,
+# and sockets that sent nothing (pong or otherwise) for WS_PING_TIMEOUT seconds
+# are reaped. 0 disables both.
+PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "60"))
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, Dict[str, WebSocket]] = {}  # {room_token: {user_id: websocket}}
+    """Tracks which connections are subscribed to which rooms on this worker.
 
-    async def connect(self, websocket: WebSocket, room_token: str, user_id: str):
-        await websocket.accept()
-        if room_token not in self.active_connections:
-            self.active_connections[room_token] = {}
-        self.active_connections[room_token][user_id] = websocket
-        print(f"[CONNECT] User {user_id} joined room {room_token}")
+    Each socket is a slotted ``Connection`` record. Single-room sockets
+    (``/ws/token/{room_token}``) are subscribed to one room on connect;
+    multiplexed sockets (``/ws``) subscribe and unsubscribe as they go. A user
+    may have any number of connections, including several in the same room.
+    Subscriptions are indexed both by room (for broadcasts) and by connection
+    (``Connection.rooms``, for cleanup when a socket goes away).
+    """
 
-    def disconnect(self, websocket: WebSocket, room_token: str, user_id: str):
+    def __init__(
+        self,
+        send_timeout: float = SEND_TIMEOUT,
+        queue_size: int = QUEUE_SIZE,
+        policy: str = SLOW_CONSUMER_POLICY,
+        ping_interval: float = PING_INTERVAL,
+        ping_timeout: float = PING_TIMEOUT
+    ):
+        self.rooms: Dict[str, RoomMembers] = {}  # {room_token: members}
+        self.connections: Dict[OutboundQueue, Connection] = {}
+        self.send_timeout = send_timeout
+        self.queue_size = queue_size
+        self.policy = policy
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        # Totals from connections that already went away
+        self._closed_totals = {"queued": 0, "sent": 0, "dropped": 0, "coalesced": 0}
+        self.slow_consumers_disconnected = 0
+        self.reaped = 0
+        self._heartbeat: Optional[asyncio.Task] = None
+        # Joins, leaves and typing, flushed to each room once per presence.interval
+        self.presence = PresenceTracker()
+        self._presence_flush: Optional[asyncio.Task] = None
+        self._presence_sync: Optional[asyncio.Task] = None
+        # Holds busy rooms' broadcasts for a few ms and sends them as one frame
+        self.coalescer = FrameCoalescer(self._send_to_members)
+        # Broadcast traffic, including rooms that have since emptied
+        self.traffic = {"frames_sent": 0, "bytes_sent": 0, "frames_saved": 0, "bytes_saved": 0}
+        # Sockets whose client offered permessage-deflate; the server (uvicorn
+        # --ws-per-message-deflate) decides whether it is used
+        self.deflate_offered = 0
+        # Relays broadcasts to other workers; None means this process is alone
+        self.pubsub: Optional[PubSub] = None
+        # Called as hook(room_token, payload) for frames broadcast by other workers
+        self.remote_hooks: List = []
+        # {kind: [handler(data)]} for control events published by other workers
+        self.event_handlers: Dict[str, List] = {}
+        # Called as hook(room_token, connections) when users' last connections
+        # to a room on this worker go away; reaped connections come in batches.
+        # _announce_leave uses it when presence diffs are off.
+        self.leave_hooks: List = []
+        self.on_event("presence_state", self.presence.apply_state)
+        self.on_event("presence_request", lambda data: asyncio.ensure_future(self._publish_presence_state()))
+
+    async def start(self, pubsub: PubSub):
+        self.pubsub = pubsub
+        await pubsub.start(self._on_remote)
+        if self.ping_interval > 0 and self._heartbeat is None:
+            self._heartbeat = asyncio.ensure_future(self._run_heartbeat())
+        if self.presence.enabled and self._presence_flush is None:
+            self._presence_flush = asyncio.ensure_future(self._run_presence())
+            self._presence_sync = asyncio.ensure_future(self._run_presence_sync())
+
+    async def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self._presence_flush is not None:
+            self._presence_flush.cancel()
+            self._presence_flush = None
+            self._presence_sync.cancel()
+            self._presence_sync = None
+            # Other workers drop this one's users from their snapshots now
+            await self.publish_event("presence_state", self.presence.state(None))
+        self.coalescer.flush_all()
+        if self.pubsub is not None:
+            await self.pubsub.stop()
+            self.pubsub = None
+
+    async def accept(self, websocket: WebSocket, user: dict, encoding: Optional[str] = None) -> Connection:
+        """Accept a socket and register it with no subscriptions yet.
+
+        The wire encoding comes from the subprotocols the client offered, or
+        from ``encoding`` (the query parameter); JSON is the default.
+        """
+        encoding, subprotocol = wire.negotiate(websocket.scope.get("subprotocols"), encoding)
+        await websocket.accept(subprotocol=subprotocol)
+        headers = dict(websocket.scope.get("headers") or ())
+        if b"permessage-deflate" in headers.get(b"sec-websocket-extensions", b""):
+            self.deflate_offered += 1
+        queue = OutboundQueue(
+            websocket,
+            maxsize=self.queue_size,
+            policy=self.policy,
+            send_timeout=self.send_timeout,
+            on_failure=self._on_queue_failure,
+            encoder=wire.encoder(encoding)
+        )
+        connection = Connection(user, queue, encoding)
+        self.connections[queue] = connection
+        queue.start()
+        return connection
+
+    def subscribe(self, connection: Connection, room_token: str) -> bool:
+        """Add a room to a connection. Returns False if it was already subscribed."""
+        if connection.queue not in self.connections or room_token in connection.rooms:
+            return False
+        room_token = intern_key(room_token)
+        connection.rooms.add(room_token)
+        members = self.rooms.get(room_token)
+        if members is None:
+            members = self.rooms[room_token] = RoomMembers()
+        if members.add(connection):
+            self.presence.joined(room_token, connection.user_id, connection.username)
+        return True
+
+    def unsubscribe(self, connection: Connection, room_token: str, _left: Optional[Dict] = None) -> bool:
+        """Remove a room from a connection; True if that was the user's last
+        connection to the room on this worker."""
+        if room_token not in connection.rooms:
+            return False
+        connection.rooms.discard(room_token)
+        members = self.rooms.get(room_token)
+        if members is None:
+            return False
+        last = members.remove(connection)
+        if not members:  # Remove room if empty
+            del self.rooms[room_token]
+        if last:
+            self.presence.left(room_token, connection.user_id, connection.username)
+            if _left is None:
+                self._run_leave_hooks(room_token, [connection])
+            else:
+                _left.setdefault(room_token, []).append(connection)
+        return last
+
+    def release(self, connection: Connection, _left: Optional[Dict] = None) -> List[str]:
+        """Drop a connection and all its subscriptions.
+
+        Returns the rooms its user no longer has any connection to here.
+        """
+        if self.connections.pop(connection.queue, None) is None:
+            return []
+        left = [
+            room_token for room_token in list(connection.rooms)
+            if self.unsubscribe(connection, room_token, _left)
+        ]
+        self._retire(connection.queue)
+        return left
+
+    def reap(self) -> int:
+        """Evict connections that have been silent for longer than ping_timeout.
+
+        Their sockets are closed, and each room gets a single leave event for
+        everyone reaped from it.
+        """
+        deadline = time.monotonic() - self.ping_timeout
+        stale = [connection for connection in self.connections.values() if connection.last_seen < deadline]
+        left: Dict[str, List[Connection]] = {}
+        for connection in stale:
+            self.release(connection, left)
+            connection.queue.close(code=status.WS_1001_GOING_AWAY)
+        for room_token, connections in left.items():
+            self._run_leave_hooks(room_token, connections)
+        self.reaped += len(stale)
+        return len(stale)
+
+    def is_present(self, room_token: str, user_id: str) -> bool:
+        members = self.rooms.get(room_token)
+        return members is not None and user_id in members.sessions
+
+    def presence_snapshot(self, room_token: str) -> str:
+        """Encoded presence frame listing who is online in a room right now."""
+        members = self.rooms.get(room_token)
+        return json.dumps(self.presence.snapshot(room_token, members.usernames() if members else ()))
+
+    async def connect(self, websocket: WebSocket, room_token: str, user: dict, encoding: Optional[str] = None) -> Connection:
+        """Accept a single-room socket."""
+        connection = await self.accept(websocket, user, encoding)
+        self.subscribe(connection, room_token)
+        print(f"[CONNECT] User {connection.user_id} joined room {room_token}")
+        return connection
+
+    def disconnect(self, connection: Connection):
         try:
-            if room_token in self.active_connections and user_id in self.active_connections[room_token]:
-                del self.active_connections[room_token][user_id]
-                if not self.active_connections[room_token]:  # Remove room if empty
-                    del self.active_connections[room_token]
-                print(f"[DISCONNECT] User {user_id} left room {room_token}")
+            if connection.queue in self.connections:
+                self.release(connection)
+                print(f"[DISCONNECT] User {connection.user_id} closed a connection")
         except Exception as e:
             print(f"[ERROR] Disconnect failed: {str(e)}")
 
     async def broadcast(self, message: dict, room_token: str, exclude_user_id: str = None):
-        if room_token not in self.active_connections:
+        # Encode once for the whole room (and for every other worker). Frames
+        # name their room so multiplexed clients can route them.
+        payload = json.dumps({**message, "room_token": room_token})
+        self.deliver_local(room_token, payload, exclude_user_id)
+        if self.pubsub is not None:
+            await self.pubsub.publish(room_token, payload, exclude_user_id)
+
+    def deliver_local(self, room_token: str, payload: str, exclude_user_id: str = None):
+        """Queue an encoded frame for this worker's members of a room, or hold
+        it for the room's next batch when the room coalesces."""
+        if room_token not in self.rooms:
             return
-            
-        for user_id, connection in self.active_connections[room_token].items():
-            if user_id == exclude_user_id:
-                continue
+        if exclude_user_id is None:
+            if self.coalescer.add(room_token, payload):
+                return
+        else:
+            # Not everyone gets this one; send what is held first to keep order
+            self.coalescer.flush(room_token)
+        self._send_to_members(room_token, payload, 1, exclude_user_id)
+
+    def set_coalesce_window(self, room_token: str, window_ms: Optional[float]):
+        """Per-room coalescing window in ms; None uses WS_COALESCE_WINDOW_MS."""
+        if window_ms is not None:
+            window_ms = min(max(float(window_ms), 0.0), MAX_COALESCE_WINDOW_MS)
+        self.coalescer.set_window(room_token, window_ms)
+
+    def _send_to_members(self, room_token: str, payload: str, frames: int, exclude_user_id: str = None):
+        members = self.rooms.get(room_token)
+        if not members:
+            return
+        start = time.perf_counter()
+        # Encoded at most once per wire encoding, however many members use it
+        frame = wire.EncodedFrame(payload)
+        sent = 0
+        size = 0
+        # Each recipient's writer task does the actual send, so a slow socket
+        # never holds up the others. Copied because a failing queue removes
+        # its connection from the room.
+        for connection in tuple(members.connections):
+            if connection.user_id != exclude_user_id:
+                data = frame.get(connection.encoding)
+                connection.queue.put(data)
+                sent += 1
+                size += len(data)
+        ws_broadcast_seconds.observe(time.perf_counter() - start)
+        # JSON text is ASCII (json.dumps escapes the rest), so len() is bytes
+        saved_frames = sent * (frames - 1)
+        saved_bytes = sent * len(payload) - size
+        members.frames_sent += sent
+        members.bytes_sent += size
+        members.frames_saved += saved_frames
+        members.bytes_saved += saved_bytes
+        traffic = self.traffic
+        traffic["frames_sent"] += sent
+        traffic["bytes_sent"] += size
+        traffic["frames_saved"] += saved_frames
+        traffic["bytes_saved"] += saved_bytes
+
+    def on_event(self, kind: str, handler):
+        self.event_handlers.setdefault(kind, []).append(handler)
+
+    async def publish_event(self, kind: str, data):
+        """Send a control event (e.g. a cache invalidation) to the other workers."""
+        if self.pubsub is not None:
+            await self.pubsub.publish(CONTROL_ROOM, encode_event(kind, data))
+
+    def _on_remote(self, room_token: str, payload: str, exclude_user_id: str = None):
+        if room_token == CONTROL_ROOM:
+            event = json.loads(payload)
+            for handler in self.event_handlers.get(event["kind"], ()):
+                try:
+                    handler(event["data"])
+                except Exception as e:
+                    print(f"[ERROR] Event handler for {event['kind']} failed: {str(e)}")
+            return
+        self.deliver_local(room_token, payload, exclude_user_id)
+        for hook in self.remote_hooks:
+            try:
+                hook(room_token, payload)
+            except Exception as e:
+                print(f"[ERROR] Remote broadcast hook failed: {str(e)}")
+
+    def stats(self) -> dict:
+        totals = dict(self._closed_totals)
+        depth = 0
+        subscriptions = 0
+        for queue, connection in self.connections.items():
+            depth += len(queue)
+            subscriptions += len(connection.rooms)
+            for key in totals:
+                totals[key] += getattr(queue, key)
+        totals.update({
+            "connections": len(self.connections),
+            "users": len({connection.user_id for connection in self.connections.values()}),
+            "rooms": len(self.rooms),
+            "subscriptions": subscriptions,
+            "queue_depth": depth,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected,
+            "reaped": self.reaped,
+            "deflate_offered": self.deflate_offered,
+            **self.traffic,
+            **self.coalescer.stats(),
+            **self.presence.stats()
+        })
+        return totals
+
+    def introspect(self, top: int = 50) -> dict:
+        """Connection counts and estimated memory, overall and for the largest rooms.
+
+        A connection's own memory is split evenly across the rooms it is
+        subscribed to, so per-room figures add up to the total.
+        """
+        connection_bytes = {}
+        unsubscribed_bytes = 0
+        for connection in self.connections.values():
+            size = connection.estimated_bytes()
+            connection_bytes[connection] = size
+            if not connection.rooms:
+                unsubscribed_bytes += size
+
+        rooms = []
+        for room_token, members in self.rooms.items():
+            size = members.estimated_bytes()
+            depth = 0
+            for connection in members.connections:
+                size += connection_bytes[connection] // len(connection.rooms)
+                depth += len(connection.queue)
+            rooms.append({
+                "room_token": room_token,
+                "connections": len(members),
+                "users": len(members.sessions),
+                "queue_depth": depth,
+                "estimated_bytes": size,
+                "coalesce_window_ms": self.coalescer.window(room_token),
+                "frames_sent": members.frames_sent,
+                "bytes_sent": members.bytes_sent,
+                "frames_saved": members.frames_saved,
+                "bytes_saved": members.bytes_saved
+            })
+        rooms.sort(key=lambda room: room["connections"], reverse=True)
+
+        total_bytes = sys.getsizeof(self.rooms) + sys.getsizeof(self.connections)
+        total_bytes += unsubscribed_bytes + sum(room["estimated_bytes"] for room in rooms)
+        return {
+            "connections": len(self.connections),
+            "rooms": len(rooms),
+            "estimated_bytes": total_bytes,
+            "bytes_per_connection": total_bytes // len(self.connections) if self.connections else 0,
+            "top_rooms": rooms[:top]
+        }
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
             try:
-                await connection.send_text(json.dumps(message))
+                reaped = self.reap() if self.ping_timeout > 0 else 0
+                if reaped:
+                    print(f"[HEARTBEAT] Reaped {reaped} idle connections")
+                # Coalesced so a backed-up queue holds at most one ping
+                frame = wire.EncodedFrame(json.dumps({"type": "ping", "ts": int(time.time() * 1000)}))
+                for connection in tuple(self.connections.values()):
+                    connection.queue.put(frame.get(connection.encoding), key="ping")
             except Exception as e:
-                print(f"[ERROR] Failed to send to {user_id}: {str(e)}")
-                self.disconnect(connection, room_token, user_id)
+                print(f"[ERROR] Heartbeat failed: {str(e)}")
+
+    async def _run_presence(self):
+        while True:
+            await asyncio.sleep(self.presence.interval)
+            try:
+                for room_token, frame in self.presence.drain():
+                    await self.broadcast(frame, room_token)
+            except Exception as e:
+                print(f"[ERROR] Presence flush failed: {str(e)}")
+
+    async def _run_presence_sync(self):
+        # Other workers' online lists seed this worker's snapshots right away
+        await self.publish_event("presence_request", None)
+        while True:
+            await self._publish_presence_state()
+            await asyncio.sleep(self.presence.sync_interval)
+
+    async def _publish_presence_state(self):
+        try:
+            rooms = {room_token: list(members.usernames()) for room_token, members in self.rooms.items()}
+            await self.publish_event("presence_state", self.presence.state(rooms))
+        except Exception as e:
+            print(f"[ERROR] Presence sync failed: {str(e)}")
+
+    def _run_leave_hooks(self, room_token: str, connections: List[Connection]):
+        for hook in self.leave_hooks:
+            try:
+                hook(room_token, connections)
+            except Exception as e:
+                print(f"[ERROR] Leave hook failed: {str(e)}")
+
+    def _on_queue_failure(self, queue: OutboundQueue):
+        if queue.failure == SLOW_CONSUMER:
+            self.slow_consumers_disconnected += 1
+        connection = self.connections.get(queue)
+        if connection is not None:
+            self.release(connection)
+
+    def _retire(self, queue: OutboundQueue):
+        queue.close()
+        for key in self._closed_totals:
+            self._closed_totals[key] += getattr(queue, key)
 
 manager = ConnectionManager()
+history_cache = RoomHistoryCache()
+# Persists chat messages in group-committed batches (MESSAGE_DURABILITY)
+message_writer = MessageWriter()
+# Pushes unread counts for rooms with new messages to users connected here
+unread_notifier = UnreadNotifier(manager)
+
+def _history_entry(message: dict) -> dict:
+    return {
+        "id": message["id"],
+        "sender": message["sender"],
+        "content": message["content"],
+        "timestamp": message["timestamp"]
+    }
+
+def _cache_remote_message(room_token: str, payload: str):
+    # Keep this worker's history current with messages inserted by other workers
+    if '"type": "chat"' not in payload:
+        return
+    message = json.loads(payload)
+    if message.get("type") == "chat":
+        history_cache.append(message["room_id"], _history_entry(message))
+        unread_notifier.mark(message["room_id"])
+
+manager.remote_hooks.append(_cache_remote_message)
+
+def drop_history(room_ids: Optional[List[int]]):
+    """Forget cached history for rooms whose old messages maintenance removed (None: every room)."""
+    if room_ids is None:
+        history_cache.clear()
+    else:
+        for room_id in room_ids:
+            history_cache.evict(room_id)
+
+# Published by maintenance.py on the postgres backend, so runs from cron reach every worker
+manager.on_event("history_invalidated", drop_history)
 
 async def verify_websocket_token(token: str) -> dict:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        if not all(k in payload for k in ["sub", "user_id", "role"]):
-            raise ValueError("Missing required token fields")
-        return {
-            "username": payload["sub"],
-            "user_id": str(payload["user_id"]),  # Ensure user_id is string for dict keys
-            "role": payload["role"]
-        }
-    except JWTError as e:
-        print(f"Token verification failed: {str(e)}")
+        user = await authenticate(token)
+    except HTTPException as e:
+        print(f"Token verification failed: {e.detail}")
         raise WebSocketDisconnect(code=status.WS_1008_POLICY_VIOLATION)
+    return {
+        "username": user["username"],
+        "user_id": str(user["id"]),  # Ensure user_id is string for dict keys
+        "role": user["role"]
+    }
+
+async def load_room(room_token: str) -> Optional[dict]:
+    """Room row by token, from the room cache when possible; None if it does not exist."""
+    room = room_cache.get(room_token)
+    if room is not None:
+        return room
+    row = await fetch_one("""
+        SELECT id, name, description, created_by, is_private, coalesce_window_ms
+        FROM rooms WHERE room_token = %s
+    """, (room_token,))
+    if not row:
+        return None
+    room = {
+        "id": row["id"],
+        "name": row["name"],
+        "description": row["description"],
+        "created_by": row["created_by"],
+        "is_private": row["is_private"],
+        "coalesce_window_ms": row["coalesce_window_ms"]
+    }
+    room_cache.set(room_token, room)
+    manager.set_coalesce_window(room_token, room["coalesce_window_ms"])
+    return room
+
+async def invalidate_room(room_token: str):
+    """Drop a room from the cache on this and every other worker."""
+    room_cache.invalidate(room_token)
+    await manager.publish_event("room_invalidated", room_token)
+
+manager.on_event("room_invalidated", room_cache.invalidate)
+
+# Names listed in one batched "left the chat" event
+LEFT_NAMES_SHOWN = 5
+
+def _announce_leave(room_token: str, connections: List[Connection]):
+    """Tell a room who left, when presence diffs (which carry leaves) are off."""
+    if manager.presence.enabled:
+        return
+    names = list(dict.fromkeys(connection.username for connection in connections))
+    if len(names) > LEFT_NAMES_SHOWN:
+        who = f"{', '.join(names[:LEFT_NAMES_SHOWN])} and {len(names) - LEFT_NAMES_SHOWN} others"
+    else:
+        who = ", ".join(names)
+    asyncio.ensure_future(manager.broadcast({
+        "type": "system",
+        "content": f"{who} left the chat",
+        "users": names
+    }, room_token))
+
+manager.leave_hooks.append(_announce_leave)
+
+async def set_coalesce_window(room_token: str, window_ms: Optional[int]):
+    """Apply a room's new coalescing window on this and every other worker."""
+    manager.set_coalesce_window(room_token, window_ms)
+    await manager.publish_event("coalesce_window", {"room_token": room_token, "window_ms": window_ms})
+
+manager.on_event("coalesce_window", lambda data: manager.set_coalesce_window(data["room_token"], data["window_ms"]))
 
 async def get_room_by_token(room_token: str) -> dict:
     try:
-        conn, cur = get_cursor()
-        cur.execute("SELECT id, name FROM rooms WHERE room_token = %s", (room_token,))
-        room = cur.fetchone()
-        if not room:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Room not found"
-            )
-        return {
-            "id": room["id"],
-            "name": room["name"]
-        }
+        room = await load_room(room_token)
     except Exception as e:
         print(f"Room lookup error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Database error"
         )
-    finally:
-        if conn:
-            conn.close()
+    if not room:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Room not found"
+        )
+    return {
+        "id": room["id"],
+        "name": room["name"],
+        "token": room_token
+    }
+
+# (user_id, room_id) pairs known to have a participant row, so rejoining a
+# room (or a reconnect storm) costs no query
+PARTICIPANT_CACHE_SIZE = int(os.getenv("PARTICIPANT_CACHE_SIZE", "100000"))
+participant_cache = TTLCache(PARTICIPANT_CACHE_SIZE)
 
-async def send_recent_messages(websocket: WebSocket, room_id: int, limit: int = 20):
+async def record_participant(user_id: int, room_id: int):
+    """Remember that a user joined a room (their room list and search scope).
+
+    Only the first join per worker writes; participant rows are never removed
+    while the user and room exist, and ids are not reused.
+    """
+    key = (user_id, room_id)
+    if participant_cache.get(key) is not None:
+        return
     try:
-        conn, cur = get_cursor()
-        cur.execute("""
+        await execute("""
+            INSERT INTO room_participants (user_id, room_id) VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+        """, (user_id, room_id))
+        participant_cache.set(key, True)
+    except Exception as e:
+        print(f"Error recording participant: {str(e)}")
+
+# History page size bounds for the get_history command
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+def _message_entries(rows) -> List[dict]:
+    return [{
+        "id": row["id"],
+        "sender": row["sender"],
+        "content": row["content"],
+        "timestamp": row["created_at"].isoformat()
+    } for row in rows]
+
+def _recent_messages_query(room_id: int, before_id: Optional[int]):
+    # Keyset pagination on (room_id, id): no OFFSET, constant cost per page
+    if before_id is None:
+        return """
             SELECT m.id, m.content, m.created_at, u.username as sender
             FROM messages m
             JOIN users u ON m.sender_id = u.id
             WHERE m.room_id = %s
-            ORDER BY m.created_at DESC
+            ORDER BY m.id DESC
             LIMIT %s
-        """, (room_id, limit))
+        """, [room_id]
+    return """
+        SELECT m.id, m.content, m.created_at, u.username as sender
+        FROM messages m
+        JOIN users u ON m.sender_id = u.id
+        WHERE m.room_id = %s AND m.id < %s
+        ORDER BY m.id DESC
+        LIMIT %s
+    """, [room_id, before_id]
 
-        messages = cur.fetchall()
-        for msg in reversed(messages):  # Send oldest first
-            await websocket.send_text(json.dumps({
-                "type": "history",
-                "id": msg["id"],
-                "sender": msg["sender"],
-                "content": msg["content"],
-                "timestamp": msg["created_at"].isoformat()
-            }))
+async def fetch_recent_messages(room_id: int, limit: int, before_id: Optional[int] = None) -> List[dict]:
+    query, params = _recent_messages_query(room_id, before_id)
+    rows = await fetch_all(query, [*params, limit])
+    return _message_entries(reversed(rows))  # Oldest first
+
+async def fetch_history_page(room_id: int, limit: int, before_id: Optional[int] = None) -> Tuple[List[dict], bool]:
+    """A page of messages before ``before_id`` (oldest first), and whether older ones exist."""
+    query, params = _recent_messages_query(room_id, before_id)
+    rows, has_more = await fetch_page(query, params, limit)
+    return _message_entries(reversed(rows)), has_more
+
+async def send_recent_messages(
+    outbound: OutboundQueue,
+    room_id: int,
+    limit: int = HISTORY_PAGE_SIZE,
+    before_id: Optional[int] = None,
+    room_token: Optional[str] = None
+):
+    """Send one page of history as a single batched frame, oldest message first."""
+    try:
+        if before_id is None and limit <= history_cache.per_room:
+            # Latest page comes from memory; the database is only hit once per cold room
+            messages = history_cache.get(room_id)
+            if messages is None:
+                history_cache.begin_warm(room_id)
+                try:
+                    recent = await fetch_recent_messages(room_id, history_cache.per_room)
+                except Exception:
+                    history_cache.abort_warm(room_id)
+                    raise
+                messages = history_cache.warm(room_id, recent)
+            has_more = len(messages) > limit or not history_cache.is_complete(room_id)
+            messages = messages[-limit:]
+        else:
+            messages, has_more = await fetch_history_page(room_id, limit, before_id)
+
+        outbound.put(json.dumps({
+            "type": "history",
+            "room_token": room_token,
+            "before_id": before_id,
+            "messages": messages,
+            "has_more": has_more
+        }))
     except Exception as e:
         print(f"Error fetching message history: {str(e)}")
-        await websocket.send_text(json.dumps({
+        outbound.put(json.dumps({
             "type": "error",
             "content": "Could not load message history"
         }))
-    finally:
-        if conn:
-            conn.close()
+
+# Reconnect delta sync: page size and how much one sync request may stream
+SYNC_BATCH_SIZE = 100
+SYNC_MAX_MESSAGES = 1000
+
+async def fetch_messages_since(room_id: int, since_id: int, limit: int) -> Tuple[List[dict], bool]:
+    """Up to ``limit`` messages after ``since_id`` (oldest first), and whether more follow."""
+    rows, has_more = await fetch_page("""
+        SELECT m.id, m.content, m.created_at, u.username as sender
+        FROM messages m
+        JOIN users u ON m.sender_id = u.id
+        WHERE m.room_id = %s AND m.id > %s
+        ORDER BY m.id ASC
+        LIMIT %s
+    """, [room_id, since_id], limit)
+    return _message_entries(rows), has_more
+
+async def send_messages_since(outbound: OutboundQueue, room_id: int, since_id: int, room_token: Optional[str] = None):
+    """Stream the messages after ``since_id`` (oldest first) in batched history frames.
+
+    At most SYNC_MAX_MESSAGES are sent per call; if more remain, the last frame
+    has ``truncated`` set and the client continues with a sync command.
+    """
+    try:
+        # Fast path: the cache covers everything after since_id
+        cached = history_cache.get(room_id)
+        if cached is not None and (history_cache.is_complete(room_id) or (cached and cached[0]["id"] <= since_id)):
+            outbound.put(json.dumps({
+                "type": "history",
+                "room_token": room_token,
+                "after_id": since_id,
+                "messages": [msg for msg in cached if msg["id"] > since_id],
+                "has_more": False,
+                "truncated": False
+            }))
+            return
+
+        sent = 0
+        while True:
+            batch, has_more = await fetch_messages_since(room_id, since_id, SYNC_BATCH_SIZE)
+            sent += len(batch)
+            truncated = has_more and sent >= SYNC_MAX_MESSAGES
+            outbound.put(json.dumps({
+                "type": "history",
+                "room_token": room_token,
+                "after_id": since_id,
+                "messages": batch,
+                "has_more": has_more,
+                "truncated": truncated
+            }))
+            if not has_more or truncated:
+                break
+            since_id = batch[-1]["id"]
+    except Exception as e:
+        print(f"Error syncing messages: {str(e)}")
+        outbound.put(json.dumps({
+            "type": "error",
+            "content": "Could not sync messages"
+        }))
+
+async def send_search_results(connection: Connection, command: dict, room: dict):
+    """Answer a search command; scope "room" (default) or "all" rooms the user belongs to."""
+    room_id = None if command.get("scope") == "all" else room["id"]
+    try:
+        page = await search_messages(
+            command.get("q"),
+            int(connection.user_id),
+            room_id,
+            _int_arg(command, "limit", SEARCH_PAGE_SIZE),
+            command.get("cursor"),
+            command.get("sort", RANK)
+        )
+    except SearchError as e:
+        connection.queue.put(json.dumps({"type": "error", "content": str(e)}))
+        return
+    except Exception as e:
+        print(f"Error searching messages: {str(e)}")
+        connection.queue.put(json.dumps({"type": "error", "content": "Search failed"}))
+        return
+    connection.queue.put(json.dumps({
+        "type": "search_results",
+        "room_token": room["token"],
+        "q": command.get("q"),
+        "scope": "all" if room_id is None else "room",
+        **page
+    }))
+
+async def post_message(connection: Connection, room: dict, content: str):
+    """Persist a chat message and broadcast it to the room (including the sender)."""
+    try:
+        message_data = await message_writer.submit(content, int(connection.user_id), room["id"])
+        
+        # Prepare the message to broadcast
+        message = {
+            "type": "chat",
+            "id": message_data["id"],
+            "sender": connection.username,
+            "content": content,
+            "timestamp": message_data["created_at"].isoformat(),
+            "room_id": room["id"]
+        }
+        
+        history_cache.append(room["id"], _history_entry(message))
+
+        await manager.broadcast(message, room["token"])
+        unread_notifier.mark(room["id"])
+        
+    except Exception as e:
+        print(f"Error handling message: {str(e)}")
+        connection.queue.put(json.dumps({
+            "type": "error",
+            "room_token": room["token"],
+            "content": "Failed to send message"
+        }))
+
+async def send_read_marker(connection: Connection, room: dict, message_id: int):
+    """Move the user's read marker and answer with the room's new unread count."""
+    try:
+        unread = await mark_read(int(connection.user_id), room["id"], message_id)
+    except Exception as e:
+        print(f"Error updating read marker: {str(e)}")
+        connection.queue.put(_error_frame("Could not update read marker", room["token"]))
+        return
+    if unread is not None:
+        connection.queue.put(unread_frame(room["token"], unread, message_id), key=f"unread:{room['token']}")
+
+# Frames with one of these types are commands; any other text is a chat message
+COMMANDS = {"get_history", "sync", "search", "typing", "read", "pong"}
+
+async def receive_frame(websocket: WebSocket) -> Optional[str]:
+    """Next client frame as text. Binary frames (msgpack clients) are a chat
+    message string or a command map, and are turned into the same text a
+    JSON client would send; None if one cannot be decoded."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    if message.get("text") is not None:
+        return message["text"]
+    try:
+        return wire.unpack_command(message.get("bytes") or b"")
+    except Exception:
+        return None
+
+def parse_command(data: str, commands=COMMANDS) -> Optional[dict]:
+    if not data.startswith("{"):
+        return None
+    try:
+        command = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(command, dict) and command.get("type") in commands:
+        return command
+    return None
+
+def _int_arg(command: dict, name: str, default: Optional[int] = None) -> Optional[int]:
+    value = command.get(name, default)
+    if value is None:
+        return None
+    return int(value)
+
+async def handle_command(command: dict, connection: Connection, room: dict):
+    outbound = connection.queue
+    try:
+        if command["type"] == "get_history":
+            limit = _int_arg(command, "limit", HISTORY_PAGE_SIZE)
+            limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+            await send_recent_messages(outbound, room["id"], limit, _int_arg(command, "before_id"), room["token"])
+        elif command["type"] == "sync":
+            await send_messages_since(outbound, room["id"], _int_arg(command, "since_id", 0), room["token"])
+        elif command["type"] == "search":
+            await send_search_results(connection, command, room)
+        elif command["type"] == "read":
+            await send_read_marker(connection, room, int(command["message_id"]))
+        elif command["type"] == "typing":
+            # Throttled per user and sent with the room's next presence frame
+            manager.presence.typing(room["token"], connection.user_id, connection.username)
+        # "pong" needs no answer; receiving it already refreshed the connection
+    except (KeyError, TypeError, ValueError):
+        outbound.put(json.dumps({
+            "type": "error",
+            "content": f"Invalid {command['type']} request"
+        }))
 
 @router.websocket("/ws/token/{room_token}")
-async def websocket_endpoint_token(websocket: WebSocket, room_token: str, token: str = Query(...)):
-    user = None
-    room = None
+async def websocket_endpoint_token(
+    websocket: WebSocket,
+    room_token: str,
+    token: str = Query(...),
+    since_id: Optional[int] = Query(None),
+    encoding: Optional[str] = Query(None)
+):
+    connection = None
     try:
         # Verify token
         user = await verify_websocket_token(token)
         
         # Get room info
         room = await get_room_by_token(room_token)
+        await record_participant(int(user["user_id"]), room["id"])
         
-        # Connect to room
-        await manager.connect(websocket, room_token, user["user_id"])
+        # Connect to room; everything sent to this client goes through its queue
+        connection = await manager.connect(websocket, room_token, user, encoding)
+        outbound = connection.queue
         
         # Send welcome message
-        await websocket.send_text(json.dumps({
+        outbound.put(json.dumps({
             "type": "system",
-            "content": f"Welcome {user['username']} to {room['name']}",
-            "user": user
+            "content": f"Welcome {connection.username} to {room['name']}",
+            "user": connection.user(),
+            "encoding": connection.encoding
         }))
+        outbound.put(manager.presence_snapshot(room_token))
         
-        # Send message history immediately after connection
-        await send_recent_messages(websocket, room["id"])
+        # Send message history immediately after connection; a reconnecting
+        # client only gets what it missed
+        if since_id is None:
+            await send_recent_messages(outbound, room["id"], room_token=room_token)
+        else:
+            await send_messages_since(outbound, room["id"], since_id, room_token)
         
         # Handle incoming messages
         while True:
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
+            connection.touch()
+            ws_messages_in.inc(1, "room")
+            if data is None:
+                connection.queue.put(_error_frame("Could not decode binary frame", room_token))
+                continue
             
-            # Skip if it's a history request (we already sent history)
-            if data.strip() == '{"type":"get_history"}':
+            command = parse_command(data.strip())
+            if command is not None:
+                await handle_command(command, connection, room)
                 continue
                 
             # Process regular chat messages
-            conn = None
-            try:
-                conn, cur = get_cursor()
-                cur.execute("""
-                    INSERT INTO messages (content, sender_id, room_id, created_at)
-                    VALUES (%s, %s, %s, %s)
-                    RETURNING id, created_at
-                """, (data, user["user_id"], room["id"], datetime.utcnow()))
-                message_data = cur.fetchone()
-                conn.commit()
-                
-                # Prepare the message to broadcast
-                message = {
-                    "type": "chat",
-                    "id": message_data["id"],
-                    "sender": user["username"],
-                    "content": data,
-                    "timestamp": message_data["created_at"].isoformat(),
-                    "room_id": room["id"]
-                }
-                
-                # Broadcast to all in room (including sender)
-                await manager.broadcast(message, room_token)
-                
-            except Exception as e:
-                print(f"Error handling message: {str(e)}")
-                if conn:
-                    conn.rollback()
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "content": "Failed to send message"
-                }))
-            finally:
-                if conn:
-                    conn.close()
+            await post_message(connection, room, data)
                     
     except WebSocketDisconnect:
-        print(f"User {user['username'] if user else 'unknown'} disconnected")
-        if user and room:
-            await manager.broadcast({
-                "type": "system",
-                "content": f"{user['username']} left the chat"
-            }, room_token)
-            manager.disconnect(websocket, room_token, user["user_id"])
+        print(f"User {connection.username if connection else 'unknown'} disconnected")
+    except Exception as e:
+        print(f"WebSocket error: {str(e)}")
+        try:
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except:
+            pass
+    finally:
+        # Reported as a presence leave unless the user is still here on another socket
+        if connection is not None:
+            manager.disconnect(connection)
+
+# Multiplexed sockets: every frame is a command naming its room
+MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "100"))
+MUX_COMMANDS = COMMANDS | {"subscribe", "unsubscribe", "send"}
+# Commands about the socket itself rather than one of its rooms; no room_token
+CONNECTION_COMMANDS = {"pong"}
+
+def _error_frame(content: str, room_token: Optional[str] = None) -> str:
+    return json.dumps({"type": "error", "room_token": room_token, "content": content})
+
+async def subscribe_room(connection: Connection, command: dict, rooms: Dict[str, dict]):
+    outbound = connection.queue
+    room_token = command.get("room_token")
+    if not isinstance(room_token, str) or not room_token:
+        outbound.put(_error_frame("subscribe needs a room_token"))
+        return
+    if room_token in rooms:
+        outbound.put(_error_frame("Already subscribed", room_token))
+        return
+    if len(rooms) >= MAX_SUBSCRIPTIONS:
+        outbound.put(_error_frame(f"At most {MAX_SUBSCRIPTIONS} rooms per connection", room_token))
+        return
+    try:
+        room = await get_room_by_token(room_token)
+        since_id = _int_arg(command, "since_id")
+    except HTTPException as e:
+        outbound.put(_error_frame(e.detail, room_token))
+        return
+    except (TypeError, ValueError):
+        outbound.put(_error_frame("Invalid subscribe request", room_token))
+        return
+    await record_participant(int(connection.user_id), room["id"])
+
+    rooms[room_token] = room
+    manager.subscribe(connection, room_token)
+    outbound.put(json.dumps({
+        "type": "subscribed",
+        "room_token": room_token,
+        "room": {"id": room["id"], "name": room["name"]}
+    }))
+    outbound.put(manager.presence_snapshot(room_token))
+    if since_id is None:
+        await send_recent_messages(outbound, room["id"], room_token=room_token)
+    else:
+        await send_messages_since(outbound, room["id"], since_id, room_token)
+
+async def handle_mux_command(command: dict, connection: Connection, rooms: Dict[str, dict]):
+    outbound = connection.queue
+    if command["type"] in CONNECTION_COMMANDS:
+        # A pong needs no answer; receiving it already refreshed the connection
+        return
+    if command["type"] == "subscribe":
+        await subscribe_room(connection, command, rooms)
+        return
+
+    room_token = command.get("room_token")
+    room = rooms.get(room_token) if isinstance(room_token, str) else None
+    if room is None:
+        outbound.put(_error_frame("Not subscribed to that room", room_token if isinstance(room_token, str) else None))
+        return
+
+    if command["type"] == "unsubscribe":
+        del rooms[room_token]
+        outbound.put(json.dumps({"type": "unsubscribed", "room_token": room_token}))
+        manager.unsubscribe(connection, room_token)
+    elif command["type"] == "send":
+        content = command.get("content")
+        if not isinstance(content, str) or not content.strip():
+            outbound.put(_error_frame("send needs non-empty content", room_token))
+            return
+        await post_message(connection, room, content)
+    else:
+        await handle_command(command, connection, room)
+
+@router.websocket("/ws")
+async def websocket_multiplexed(
+    websocket: WebSocket,
+    token: str = Query(...),
+    encoding: Optional[str] = Query(None)
+):
+    """One socket for any number of rooms.
+
+    Client frames are JSON commands: subscribe (room_token, optional
+    since_id), unsubscribe, send (room_token, content), and get_history, sync,
+    search, typing and read with a room_token. pong answers the server's ping
+    and names no room. Every room frame sent back carries its room_token.
+    """
+    connection = None
+    rooms: Dict[str, dict] = {}  # {room_token: room}
+    try:
+        user = await verify_websocket_token(token)
+        connection = await manager.accept(websocket, user, encoding)
+        connection.queue.put(json.dumps({
+            "type": "system",
+            "content": f"Welcome {connection.username}",
+            "user": connection.user(),
+            "encoding": connection.encoding
+        }))
+
+        while True:
+            data = await receive_frame(websocket)
+            connection.touch()
+            ws_messages_in.inc(1, "mux")
+            command = parse_command(data.strip(), MUX_COMMANDS) if data is not None else None
+            if command is None:
+                connection.queue.put(_error_frame("Expected a JSON command"))
+                continue
+            await handle_mux_command(command, connection, rooms)
+
+    except WebSocketDisconnect:
+        print(f"User {connection.username if connection else 'unknown'} disconnected")
     except Exception as e:
         print(f"WebSocket error: {str(e)}")
         try:
             await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
         except:
             pass
-        if user and room:
-            manager.disconnect(websocket, room_token, user["user_id"])
\ No newline at end of file
+    finally:
+        if connection is not None:
+            manager.disconnect(connection)
@@ -0,0 +1,97 @@
+# coalescing.py
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional
+
+# Milliseconds a room's broadcast frames are held so that frames produced close
+# together reach each member as one batch frame (0 sends every frame as is).
+# Rooms can override it with rooms.coalesce_window_ms.
+COALESCE_WINDOW_MS = float(os.getenv("WS_COALESCE_WINDOW_MS", "0"))
+# A held batch is sent early once it has this many frames
+COALESCE_MAX_FRAMES = int(os.getenv("WS_COALESCE_MAX_FRAMES", "50"))
+# Upper bound for per-room windows set through the API
+MAX_COALESCE_WINDOW_MS = 1000
+
+
+def batch_frame(payloads: List[str]) -> str:
+    """One frame carrying already-encoded frames, in order, without re-encoding them."""
+    return '{"type": "batch", "frames": [' + ", ".join(payloads) + "]}"
+
+
+class FrameCoalescer:
+    """Holds a room's broadcast frames for a short window and sends them together.
+
+    The first frame broadcast to a quiet room starts its window. Every frame
+    for that room until the window closes (or ``max_frames`` is reached) is
+    handed to ``deliver`` as one batch frame, so each member's queue, writer
+    and socket see one frame instead of many. A window that caught a single
+    frame sends it unchanged. Rooms whose window is 0 are never held.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable[[str, str, int], None],
+        window_ms: float = COALESCE_WINDOW_MS,
+        max_frames: int = COALESCE_MAX_FRAMES
+    ):
+        self.deliver = deliver  # deliver(room_token, payload, frames in payload)
+        self.window_ms = window_ms
+        self.max_frames = max_frames
+        self.windows: Dict[str, float] = {}  # {room_token: ms} per-room overrides
+        self.batches = 0
+        self.batched_frames = 0
+        self._pending: Dict[str, List[str]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def window(self, room_token: str) -> float:
+        return self.windows.get(room_token, self.window_ms)
+
+    def set_window(self, room_token: str, window_ms: Optional[float]):
+        """Override a room's window; None goes back to the default."""
+        if window_ms is None:
+            self.windows.pop(room_token, None)
+        else:
+            self.windows[room_token] = window_ms
+        if self.window(room_token) <= 0:
+            self.flush(room_token)
+
+    def add(self, room_token: str, payload: str) -> bool:
+        """Hold a frame for its room's batch. False if the room does not
+        coalesce, in which case the caller sends the frame itself."""
+        pending = self._pending.get(room_token)
+        if pending is None:
+            window = self.window(room_token)
+            if window <= 0:
+                return False
+            pending = self._pending[room_token] = []
+            self._timers[room_token] = asyncio.get_event_loop().call_later(window / 1000, self.flush, room_token)
+        pending.append(payload)
+        if len(pending) >= self.max_frames:
+            self.flush(room_token)
+        return True
+
+    def flush(self, room_token: str):
+        """Send whatever a room has held so far."""
+        timer = self._timers.pop(room_token, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(room_token, None)
+        if not pending:
+            return
+        if len(pending) == 1:
+            self.deliver(room_token, pending[0], 1)
+            return
+        self.batches += 1
+        self.batched_frames += len(pending)
+        self.deliver(room_token, batch_frame(pending), len(pending))
+
+    def flush_all(self):
+        for room_token in list(self._pending):
+            self.flush(room_token)
+
+    def stats(self) -> dict:
+        return {
+            "coalesce_batches": self.batches,
+            "coalesce_batched_frames": self.batched_frames,
+            "coalesce_pending_rooms": len(self._pending)
+        }
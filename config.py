@@ -32,6 +32,15 @@ def load_config(filename='database.ini', section='postgresql'):
 
     return config
 
+def load_pool_config():
+    # Connection pool sizing, overridable through the environment
+    return {
+        'minconn': int(os.getenv('DB_POOL_MIN', '1')),
+        'maxconn': int(os.getenv('DB_POOL_MAX', '10')),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', '5')),
+        'idle_check': float(os.getenv('DB_POOL_IDLE_CHECK', '30')),
+    }
+
 if __name__ == '__main__':
     config = load_config()
     print(config)
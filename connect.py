@@ -1,14 +1,26 @@
 # connect.py
+import time
 import psycopg2
 from psycopg2.extras import DictCursor
 from config import load_config 
+from metrics import record_query
+
+class TimedCursor(DictCursor):
+    """DictCursor that records how long each statement takes (and logs slow ones)."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - start)
 
 def connect(config):
     """Connect to the PostgreSQL database server"""
     try:
         conn = psycopg2.connect(
             **config,
-            cursor_factory=DictCursor  # Allows dict-like row access
+            cursor_factory=TimedCursor  # Dict-like row access, timed statements
         )
         print('Connected to the PostgreSQL server.')
         return conn
@@ -1,12 +1,285 @@
 # database.py
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import psycopg2
+from psycopg2 import extensions
+
 from connect import connect
-from config import load_config
+from config import load_config, load_pool_config
+from metrics import db_pool_wait_seconds
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection became available within the timeout."""
+
+
+class ConnectionPool:
+    """Process-wide, thread-safe pool of PostgreSQL connections.
+
+    At most ``maxconn`` connections are checked out at once; callers block for
+    up to ``timeout`` seconds waiting for a free slot. Connections that sat idle
+    for longer than ``idle_check`` seconds are pinged before being handed out.
+    """
+
+    def __init__(self, config, minconn=1, maxconn=10, timeout=5.0, idle_check=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: need 0 <= minconn <= maxconn, maxconn >= 1")
+        self._config = config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._idle = []  # [(conn, last_used)], most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._in_use = 0
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append((connect(config), time.monotonic()))
+
+    def getconn(self):
+        start = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        db_pool_wait_seconds.observe(time.perf_counter() - start)
+        if not acquired:
+            raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        raise PoolTimeoutError("Connection pool is closed")
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = connect(self._config)
+                    break
+                conn, last_used = item
+                if self._is_healthy(conn, last_used):
+                    break
+                self._close_quietly(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def putconn(self, conn, discard=False):
+        try:
+            if not discard and not conn.closed:
+                try:
+                    # Never hand out a connection with an open transaction
+                    if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except Exception:
+                    discard = True
+            with self._lock:
+                self._in_use -= 1
+                keep = not (self._closed or discard or conn.closed)
+                if keep:
+                    self._idle.append((conn, time.monotonic()))
+            if not keep:
+                self._close_quietly(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._lock:
+            return {"idle": len(self._idle), "in_use": self._in_use, "max": self.maxconn}
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            print(f"[POOL] Dropping stale connection: {str(e)}")
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+_stream_ids = itertools.count(1)
+
+def init_pool(config=None, **options):
+    """Create the shared pool (called from app startup). Idempotent."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            settings = load_pool_config()
+            settings.update(options)
+            _pool = ConnectionPool(config or load_config(), **settings)
+            print(f"[POOL] Started (min={_pool.minconn}, max={_pool.maxconn})")
+        return _pool
+
+def get_pool():
+    return _pool or init_pool()
+
+def close_pool():
+    global _pool, _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+            print("[POOL] Closed")
+
+def pool_stats():
+    """Pool usage without opening the pool if it is not running."""
+    pool = _pool
+    if pool is None:
+        return {"idle": 0, "in_use": 0, "max": 0}
+    return pool.stats()
 
 def get_db_connection():
-    config = load_config()
-    return connect(config)
+    return get_pool().getconn()
+
+def release_connection(conn, discard=False):
+    """Return a connection obtained from get_db_connection()/get_cursor()."""
+    if conn is None:
+        return
+    if _pool is None:
+        # Pool already shut down; just drop the connection
+        ConnectionPool._close_quietly(conn)
+        return
+    _pool.putconn(conn, discard=discard)
 
 def get_cursor():
     conn = get_db_connection()
-    cur = conn.cursor()
+    try:
+        cur = conn.cursor()
+    except Exception:
+        release_connection(conn, discard=True)
+        raise
     return conn, cur
+
+
+# --- Async access -----------------------------------------------------------
+# psycopg2 is blocking, so every query issued from an async handler runs on a
+# dedicated thread pool (one thread per pooled connection) instead of the
+# event loop.
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        pool = get_pool()
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=pool.maxconn,
+                    thread_name_prefix="db",
+                )
+    return _executor
+
+def _run_with_cursor(func, args, commit):
+    conn = get_db_connection()
+    discard = False
+    try:
+        with conn.cursor() as cur:
+            result = func(cur, *args)
+        if commit:
+            conn.commit()
+        return result
+    except (psycopg2.InterfaceError, psycopg2.OperationalError):
+        discard = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn, discard=discard)
+
+async def run_in_db(func, *args, commit=False):
+    """Run ``func(cur, *args)`` on a pooled connection without blocking the loop.
+
+    The whole call is one transaction: it is committed when ``commit`` is true
+    and rolled back if ``func`` raises.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), partial(_run_with_cursor, func, args, commit)
+    )
+
+async def fetch_one(query, params=None):
+    def _fetch(cur):
+        cur.execute(query, params)
+        return cur.fetchone()
+    return await run_in_db(_fetch)
+
+async def fetch_all(query, params=None):
+    def _fetch(cur):
+        cur.execute(query, params)
+        return cur.fetchall()
+    return await run_in_db(_fetch)
+
+async def fetch_page(query, params, limit: int):
+    """Up to ``limit`` rows of a keyset-paginated query, and whether more follow.
+
+    The last placeholder in ``query`` is its ``LIMIT``, bound here to
+    ``limit + 1``: the one extra row tells whether another page exists,
+    without a count or a second query.
+    """
+    rows = await fetch_all(query, [*params, limit + 1])
+    return rows[:limit], len(rows) > limit
+
+async def execute(query, params=None, returning=False):
+    """Execute and commit a single statement, optionally returning its first row."""
+    def _execute(cur):
+        cur.execute(query, params)
+        return cur.fetchone() if returning else None
+    return await run_in_db(_execute, commit=True)
+
+async def stream_all(query, params=None, batch_size=1000):
+    """Yield the rows of a large result set, ``batch_size`` at a time.
+
+    Uses a server-side (named) cursor, so memory stays constant however many
+    rows match. The connection is held until the generator is exhausted or
+    closed.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    conn = await loop.run_in_executor(executor, get_db_connection)
+    try:
+        cur = conn.cursor(name=f"stream_{next(_stream_ids)}")
+        cur.itersize = batch_size
+        await loop.run_in_executor(executor, cur.execute, query, params)
+        while True:
+            rows = await loop.run_in_executor(executor, cur.fetchmany, batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        # Not awaited: this also runs when the consumer was cancelled. Returning
+        # the connection rolls back, which closes the server-side cursor.
+        try:
+            executor.submit(release_connection, conn)
+        except RuntimeError:
+            # Executor already shut down
+            release_connection(conn)
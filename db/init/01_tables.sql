@@ -19,6 +19,9 @@ CREATE TABLE IF NOT EXISTS rooms (
     room_token VARCHAR(255) UNIQUE
 );
 
+-- Admin listings filtered by creator are paged by id
+CREATE INDEX IF NOT EXISTS idx_rooms_created_by ON rooms(created_by, id);
+
 
 CREATE TABLE IF NOT EXISTS room_participants (
     user_id INTEGER REFERENCES users(id),
@@ -28,13 +31,18 @@ CREATE TABLE IF NOT EXISTS room_participants (
 );
 
 
+-- Range-partitioned by month on created_at; partitions, the default partition
+-- and the conversion of older unpartitioned installs live in 02_message_partitions.sql
 CREATE TABLE IF NOT EXISTS messages (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     content TEXT NOT NULL,
     room_id INTEGER REFERENCES rooms(id),
     sender_id INTEGER REFERENCES users(id),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
-CREATE INDEX IF NOT EXISTS idx_messages_room ON messages(room_id);
+-- (room_id, id) serves history pages by keyset and also covers plain room_id lookups
+CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id);
+DROP INDEX IF EXISTS idx_messages_room;
 CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);
\ No newline at end of file
@@ -0,0 +1,102 @@
+-- Monthly partitions of messages (messages_yYYYYmMM), retention settings, and
+-- a one-time conversion of installs created before messages was partitioned.
+-- Safe to run repeatedly.
+
+-- Per-room retention in days (NULL = keep for the global retention period)
+ALTER TABLE rooms ADD COLUMN IF NOT EXISTS message_retention_days INTEGER
+    CHECK (message_retention_days IS NULL OR message_retention_days > 0);
+
+-- Rows for the month already in messages_default would make CREATE ... PARTITION
+-- OF fail, so they are moved out first and re-inserted into the new partition
+CREATE OR REPLACE FUNCTION create_message_partition(month_start DATE) RETURNS TEXT AS $$
+DECLARE
+    partition_name TEXT := format('messages_y%sm%s', to_char(month_start, 'YYYY'), to_char(month_start, 'MM'));
+    range_start DATE := date_trunc('month', month_start)::date;
+    range_end DATE := (date_trunc('month', month_start) + INTERVAL '1 month')::date;
+    moved BOOLEAN := FALSE;
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        IF to_regclass('messages_default') IS NOT NULL AND EXISTS (
+            SELECT 1 FROM messages_default WHERE created_at >= range_start AND created_at < range_end
+        ) THEN
+            CREATE TEMP TABLE moved_messages AS
+            SELECT id, content, room_id, sender_id, created_at FROM messages_default
+            WHERE created_at >= range_start AND created_at < range_end;
+            DELETE FROM messages_default WHERE created_at >= range_start AND created_at < range_end;
+            moved := TRUE;
+        END IF;
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            partition_name, range_start, range_end
+        );
+        IF moved THEN
+            INSERT INTO messages (id, content, room_id, sender_id, created_at)
+            SELECT id, content, room_id, sender_id, created_at FROM moved_messages;
+            DROP TABLE moved_messages;
+        END IF;
+    END IF;
+    RETURN partition_name;
+END
+$$ LANGUAGE plpgsql;
+
+-- Creates partitions from the current month through months_ahead months ahead
+CREATE OR REPLACE FUNCTION ensure_message_partitions(months_ahead INTEGER DEFAULT 3) RETURNS VOID AS $$
+DECLARE
+    current_month DATE := date_trunc('month', now())::date;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        PERFORM create_message_partition((current_month + make_interval(months => i))::date);
+    END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+-- Convert an unpartitioned messages table, keeping ids and the id sequence
+DO $$
+DECLARE
+    first_month DATE;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE relname = 'messages' AND relkind = 'r' AND relnamespace = 'public'::regnamespace
+    ) THEN
+        ALTER TABLE messages RENAME TO messages_legacy;
+        ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey;
+        DROP INDEX IF EXISTS idx_messages_room;
+        DROP INDEX IF EXISTS idx_messages_room_id;
+        DROP INDEX IF EXISTS idx_messages_sender;
+
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            content TEXT NOT NULL,
+            room_id INTEGER REFERENCES rooms(id),
+            sender_id INTEGER REFERENCES users(id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+        SELECT date_trunc('month', min(created_at))::date INTO first_month FROM messages_legacy;
+        WHILE first_month IS NOT NULL AND first_month < date_trunc('month', now())::date LOOP
+            PERFORM create_message_partition(first_month);
+            first_month := (first_month + INTERVAL '1 month')::date;
+        END LOOP;
+        PERFORM ensure_message_partitions(3);
+        CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+        INSERT INTO messages (id, content, room_id, sender_id, created_at)
+        SELECT id, content, room_id, sender_id, COALESCE(created_at, now())
+        FROM messages_legacy;
+        DROP TABLE messages_legacy;
+    END IF;
+END
+$$;
+
+-- Catches rows outside every monthly range so inserts never fail; kept empty
+-- by creating partitions ahead of time, and by maintenance giving any month
+-- that still lands here its own partition
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);
+
+SELECT ensure_message_partitions(3);
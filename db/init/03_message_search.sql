@@ -0,0 +1,7 @@
+-- Full-text search over messages.content. The text search configuration
+-- ('english') must match SEARCH_CONFIG in search.py. Safe to run repeatedly.
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', content)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_content_tsv ON messages USING GIN (content_tsv);
@@ -0,0 +1,14 @@
+-- Per-user read markers and unread counters on room_participants. The message
+-- writer bumps unread_count as it inserts each batch, so room lists never
+-- count messages. Safe to run repeatedly.
+
+ALTER TABLE room_participants ADD COLUMN IF NOT EXISTS last_read_id INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE room_participants ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0;
+
+-- The writer updates every participant of a room at once
+CREATE INDEX IF NOT EXISTS idx_room_participants_room ON room_participants(room_id);
+
+-- Creators have a participant row (and so a read marker) for their rooms
+INSERT INTO room_participants (user_id, room_id)
+SELECT created_by, id FROM rooms WHERE created_by IS NOT NULL
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,5 @@
+-- Per-room outbound coalescing window in milliseconds. NULL uses the server's
+-- WS_COALESCE_WINDOW_MS; 0 turns coalescing off for the room. Safe to run
+-- repeatedly.
+
+ALTER TABLE rooms ADD COLUMN IF NOT EXISTS coalesce_window_ms INTEGER;
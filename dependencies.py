@@ -1,46 +1,113 @@
+# dependencies.py
+import hashlib
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
-from passlib.context import CryptContext
-from connect import connect
-from chat_app.database.config import load_config
+from database import fetch_one
+from ttl_cache import TTLCache
 
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-SECRET_KEY = "your-secret-key"
+SECRET_KEY = "brahmabyte_irfanAlam"
 ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# Verified tokens are remembered until they expire; user rows for USER_CACHE_TTL
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+
+# {sha256(token): claims}; keyed by digest so raw tokens are not kept in memory
+token_cache = TTLCache(TOKEN_CACHE_SIZE)
+# {user_id: user row}
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def verify_token(token: str) -> dict:
+    """Claims of a valid access token; the signature is only checked once per token."""
+    digest = hashlib.sha256(token.encode()).digest()
+    claims = token_cache.get(digest)
+    if claims is not None:
+        return claims
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        role = payload.get("role")
-        
-        if not username or not role:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid credentials"
-            )
-        
-        conn = connect(load_config())
-        with conn.cursor() as cur:
-            cur.execute("SELECT username, email, role FROM users WHERE username = %s", (username,))
-            user = cur.fetchone()
-            
-            if not user:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid credentials"
-                )
-            return {"username": user[0], "email": user[1], "role": user[2]}
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid credentials"
+            detail="Invalid token"
         )
-    except Exception:
+    if not claims.get("sub") or not claims.get("user_id"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+        )
+    if "exp" in claims:
+        token_cache.set(digest, claims, float(claims["exp"]))
+    return claims
+
+
+async def load_user(user_id: int) -> Optional[dict]:
+    """User row by id, from the user cache when possible; None if it does not exist."""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    row = await fetch_one(
+        "SELECT id, username, email, role, is_active FROM users WHERE id = %s",
+        (user_id,)
+    )
+    if not row:
+        return None
+    user = {
+        "id": row["id"],
+        "username": row["username"],
+        "email": row["email"],
+        "role": row["role"],
+        "is_active": row["is_active"]
+    }
+    user_cache.set(user_id, user)
+    return user
+
+
+def invalidate_user(user_id: int):
+    user_cache.invalidate(user_id)
+
+
+async def authenticate(token: str) -> dict:
+    """The active user a token belongs to. Shared by REST and WebSocket routes."""
+    claims = verify_token(token)
+    try:
+        user = await load_user(int(claims["user_id"]))
+    except Exception as e:
+        print(f"User lookup error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Database error"
-        )
\ No newline at end of file
+        )
+    if not user or not user["is_active"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid credentials"
+        )
+    return user
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
+    return await authenticate(token)
+
+
+async def require_admin(user: dict = Depends(get_current_user)) -> dict:
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
@@ -0,0 +1,147 @@
+# history_cache.py
+import os
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional
+
+# Messages kept per room (matches the history sent on join)
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "20"))
+HISTORY_CACHE_ROOMS = int(os.getenv("HISTORY_CACHE_ROOMS", "1000"))
+HISTORY_CACHE_MB = float(os.getenv("HISTORY_CACHE_MB", "64"))
+
+# Rough per-message overhead of the dict, its keys and the deque slot
+_ENTRY_OVERHEAD = 400
+
+
+def _entry_size(message: dict) -> int:
+    return _ENTRY_OVERHEAD + len(message["content"]) + len(message["sender"])
+
+
+class RoomHistoryCache:
+    """Most recent messages per room, so joining a room needs no query.
+
+    Messages are dicts in the history frame shape (id, sender, content,
+    timestamp), kept oldest first and unique by id. A room is only served from
+    the cache once it has been warmed from the database; appends to a room
+    that is being warmed are buffered and merged so none are lost. Rooms are
+    evicted least recently used first when either ``max_rooms`` or the
+    ``max_bytes`` estimate is exceeded.
+    """
+
+    def __init__(
+        self,
+        per_room: int = HISTORY_CACHE_SIZE,
+        max_rooms: int = HISTORY_CACHE_ROOMS,
+        max_bytes: int = int(HISTORY_CACHE_MB * 1024 * 1024)
+    ):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rooms: "OrderedDict[int, deque]" = OrderedDict()
+        self._warming: Dict[int, List[dict]] = {}
+        # Rooms whose entire history fits in the buffer
+        self._complete = set()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def get(self, room_id: int) -> Optional[List[dict]]:
+        """Cached messages oldest first, or None if the room is cold."""
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            self.misses += 1
+            return None
+        self._rooms.move_to_end(room_id)
+        self.hits += 1
+        return list(messages)
+
+    def begin_warm(self, room_id: int):
+        """Call before querying the database for a cold room."""
+        self._warming.setdefault(room_id, [])
+
+    def abort_warm(self, room_id: int):
+        self._warming.pop(room_id, None)
+
+    def is_complete(self, room_id: int) -> bool:
+        """True if the room has no messages older than the ones cached."""
+        return room_id in self._complete
+
+    def warm(self, room_id: int, messages: Iterable[dict]) -> List[dict]:
+        """Fill a room from a database result (oldest first) and return its contents.
+
+        ``messages`` should be the room's latest ``per_room`` messages; a
+        shorter result means the room's whole history is now cached.
+        """
+        messages = list(messages)
+        pending = self._warming.pop(room_id, [])
+        if room_id not in self._rooms and len(messages) < self.per_room:
+            self._complete.add(room_id)
+        for message in messages + pending:
+            self._insert(room_id, message)
+        if room_id not in self._rooms:
+            # Empty room: remember that, too
+            self._rooms[room_id] = deque()
+        self._rooms.move_to_end(room_id)
+        contents = list(self._rooms[room_id])
+        self._enforce_limits()
+        return contents
+
+    def append(self, room_id: int, message: dict):
+        """Record a newly inserted message. Cold rooms are left cold."""
+        if room_id in self._rooms:
+            self._insert(room_id, message)
+            self._enforce_limits()
+        elif room_id in self._warming:
+            self._warming[room_id].append(message)
+
+    def evict(self, room_id: int):
+        messages = self._rooms.pop(room_id, None)
+        if messages:
+            self.bytes -= sum(_entry_size(m) for m in messages)
+        self._warming.pop(room_id, None)
+        self._complete.discard(room_id)
+
+    def clear(self):
+        self._rooms.clear()
+        self._warming.clear()
+        self._complete.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _insert(self, room_id: int, message: dict):
+        messages = self._rooms.get(room_id)
+        if messages is None:
+            messages = self._rooms[room_id] = deque()
+        # Messages normally arrive in id order; walk back from the newest for
+        # the occasional late one from another worker
+        position = len(messages)
+        while position and messages[position - 1]["id"] >= message["id"]:
+            if messages[position - 1]["id"] == message["id"]:
+                return
+            position -= 1
+        if position == 0 and len(messages) >= self.per_room:
+            self._complete.discard(room_id)
+            return  # Older than everything we keep
+        messages.insert(position, message)
+        self.bytes += _entry_size(message)
+        while len(messages) > self.per_room:
+            self.bytes -= _entry_size(messages.popleft())
+            self._complete.discard(room_id)
+
+    def _enforce_limits(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self.bytes > self.max_bytes):
+            room_id, messages = self._rooms.popitem(last=False)
+            self._complete.discard(room_id)
+            self.bytes -= sum(_entry_size(m) for m in messages)
+            self.evictions += 1
@@ -1,32 +1,98 @@
-from fastapi import FastAPI, HTTPException, status, Depends
-from fastapi.security import OAuth2PasswordBearer
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, status, Depends, Query, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from jose import JWTError, jwt
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
 from typing import Optional, List
 from pydantic import BaseModel
+import asyncio
+import json
 import secrets
 
-from connect import connect
-from config import load_config
-from chat_ws import router as chat_router
-
-app = FastAPI()
+from database import init_pool, close_pool, pool_stats, fetch_one, fetch_all, fetch_page, execute, run_in_db, stream_all
+from chat_ws import router as chat_router, manager, message_writer, unread_notifier, history_cache, load_room, invalidate_room, set_coalesce_window, participant_cache, drop_history
+from read_markers import mark_read
+from dependencies import create_access_token, get_current_user, require_admin, invalidate_user, token_cache, user_cache
+from passwords import password_hasher, HasherBusyError
+from search import search_messages, SearchError, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE, RANK
+from pubsub import create_pubsub
+from maintenance import maintenance_loop, MAINTENANCE_INTERVAL_HOURS
+from coalescing import MAX_COALESCE_WINDOW_MS
+from metrics import registry, pick, TimingMiddleware
+from room_cache import room_cache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One connection pool per worker process, shared by REST and WebSocket handlers
+    init_pool()
+    # Relay room broadcasts to the other workers (PUBSUB_BACKEND)
+    await manager.start(create_pubsub())
+    await message_writer.start()
+    await unread_notifier.start()
+    # Message partitions and retention (MAINTENANCE_INTERVAL_HOURS=0 to run it from cron instead)
+    maintenance = asyncio.ensure_future(maintenance_loop(on_pruned=drop_history)) if MAINTENANCE_INTERVAL_HOURS > 0 else None
+    try:
+        yield
+    finally:
+        if maintenance:
+            maintenance.cancel()
+        # Flush queued chat messages while the pool is still open
+        await message_writer.stop()
+        await unread_notifier.stop()
+        await manager.stop()
+        password_hasher.shutdown()
+        close_pool()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(TimingMiddleware)
 app.include_router(chat_router)
 app.mount("/static", StaticFiles(directory="public"), name="static")
 
-# Authentication setup
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-SECRET_KEY = "brahmabyte_irfanAlam"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-# Database connection
-def get_db_connection():
-    return connect(load_config())
+# Cached user rows are dropped on every worker when a user is deleted
+manager.on_event("user_invalidated", invalidate_user)
+
+# Metrics read from each component's stats at scrape time
+WS_STATE = ("connections", "users", "rooms", "subscriptions", "queue_depth")
+WS_FRAMES = ("queued", "sent", "dropped", "coalesced")
+WS_EVENTS = ("reaped", "slow_consumers_disconnected", "presence_frames", "typing_forwarded", "typing_throttled")
+registry.gauge("chat_ws_current", "WebSocket connections, users, rooms, subscriptions and queued frames on this worker",
+               lambda: pick(manager.stats(), *WS_STATE), ("state",))
+registry.callback_counter("chat_ws_frames_total", "Outbound WebSocket frames by outcome",
+                          lambda: pick(manager.stats(), *WS_FRAMES), ("outcome",))
+registry.callback_counter("chat_ws_events_total", "Reaped and dropped sockets, presence frames and typing events",
+                          lambda: pick(manager.stats(), *WS_EVENTS), ("event",))
+registry.callback_counter("chat_ws_broadcast_frames_total",
+                          "Broadcast frames queued to members, and member frames saved by coalescing",
+                          lambda: {("sent",): manager.traffic["frames_sent"], ("saved",): manager.traffic["frames_saved"]},
+                          ("kind",))
+registry.callback_counter("chat_ws_broadcast_bytes_total",
+                          "Broadcast payload bytes queued to members, and bytes saved by compact encodings",
+                          lambda: {("sent",): manager.traffic["bytes_sent"], ("saved",): manager.traffic["bytes_saved"]},
+                          ("kind",))
+registry.callback_counter("chat_ws_coalesce_batches_total", "Batch frames sent by room coalescing",
+                          lambda: manager.coalescer.batches)
+registry.callback_counter("chat_ws_deflate_offered_total", "WebSocket handshakes that offered permessage-deflate",
+                          lambda: manager.deflate_offered)
+registry.callback_counter("chat_unread_pushed_total", "Unread-count frames pushed to sockets",
+                          lambda: unread_notifier.stats()["unread_pushed"])
+registry.callback_counter("chat_messages_written_total", "Chat messages persisted by the message writer",
+                          lambda: message_writer.stats()["written"])
+registry.callback_counter("chat_message_batches_total", "Message writer batches committed",
+                          lambda: message_writer.stats()["batches"])
+registry.gauge("chat_message_queue_depth", "Chat messages waiting to be persisted",
+               lambda: message_writer.stats()["queued"])
+registry.gauge("chat_db_pool_connections", "Pooled database connections by state",
+               lambda: pick(pool_stats(), "idle", "in_use", "max"), ("state",))
+registry.gauge("chat_password_hasher", "Password hashing workers busy and calls waiting",
+               lambda: {("running",): password_hasher.stats()["running"], ("waiting",): password_hasher.stats()["queue_depth"]},
+               ("state",))
+registry.callback_counter("chat_cache_lookups_total", "Cache lookups by cache and result",
+                          lambda: {
+                              (name, result): cache.stats()[result]
+                              for name, cache in (("history", history_cache), ("room", room_cache),
+                                                  ("token", token_cache), ("user", user_cache),
+                                                  ("participant", participant_cache))
+                              for result in ("hits", "misses")
+                          }, ("cache", "result"))
 
 # Models (kept minimal)
 class UserResponse(BaseModel):
@@ -60,165 +126,204 @@ class RoomCreateRequest(BaseModel):
     name: str
     description: Optional[str] = None
     is_private: bool = False
-# Admin dependency
-async def require_admin(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        if payload.get("role") != "admin":
-            raise HTTPException(status_code=403, detail="Admin access required")
-        return payload
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+
+class ReadMarkerRequest(BaseModel):
+    message_id: int
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text format for this worker (each uvicorn worker keeps its own)."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 # Admin endpoints
+# Listings are paged by id (keyset): pass the X-Next-After-Id response header
+# back as after_id for the next page. The /export variants stream every
+# matching row as NDJSON.
+ADMIN_PAGE_SIZE = 100
+MAX_ADMIN_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+def _keyset_query(select: str, conditions: list, params: list, after_id: Optional[int], paged: bool):
+    """Query and params ordered by id after ``after_id``; paged queries end in
+    a ``LIMIT %s`` for fetch_page to bind."""
+    conditions = list(conditions)
+    params = list(params)
+    if after_id is not None:
+        conditions.append("id > %s")
+        params.append(after_id)
+    query = select
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    if paged:
+        query += " LIMIT %s"
+    return query, params
+
+def _user_filters(role: Optional[str], is_active: Optional[bool]):
+    conditions, params = [], []
+    if role is not None:
+        conditions.append("role = %s")
+        params.append(role)
+    if is_active is not None:
+        conditions.append("COALESCE(is_active, TRUE) = %s")
+        params.append(is_active)
+    return conditions, params
+
+def _room_filters(created_by: Optional[int]):
+    if created_by is None:
+        return [], []
+    return ["created_by = %s"], [created_by]
+
+ADMIN_USERS_SELECT = "SELECT id, username, email, role, is_active FROM users"
+# Use COALESCE to handle NULL tokens
+ADMIN_ROOMS_SELECT = "SELECT id, name, created_by, COALESCE(room_token, '') AS token FROM rooms"
+
+def _admin_user(row) -> dict:
+    return {
+        "id": row[0],
+        "username": row[1],
+        "email": row[2] or "",  # Handle NULL emails
+        "role": row[3],
+        "is_active": row[4]
+    }
+
+def _admin_room(row) -> dict:
+    return {
+        "id": row[0],
+        "name": row[1],
+        "created_by": row[2],
+        "token": row[3]  # Will never be NULL
+    }
+
+async def _keyset_page(response: Response, select: str, filters, after_id, limit, to_dict):
+    query, params = _keyset_query(select, *filters, after_id, True)
+    rows, has_more = await fetch_page(query, params, limit)
+    page = [to_dict(row) for row in rows]
+    if has_more:
+        response.headers["X-Next-After-Id"] = str(page[-1]["id"])
+    return page
+
+def _ndjson_export(select: str, filters, after_id, to_dict) -> StreamingResponse:
+    query, params = _keyset_query(select, *filters, after_id, False)
+
+    async def lines():
+        async for row in stream_all(query, params, batch_size=EXPORT_BATCH_SIZE):
+            yield json.dumps(to_dict(row)) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @app.get("/admin/rooms", response_model=List[RoomResponse])
-async def get_all_rooms(_ = Depends(require_admin)):
-    conn = None
-    cursor = None
+async def get_all_rooms(
+    response: Response,
+    after_id: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=MAX_ADMIN_PAGE_SIZE),
+    created_by: Optional[int] = None,
+    _ = Depends(require_admin)
+):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Use COALESCE to handle NULL tokens
-        cursor.execute("""
-            SELECT 
-                id, 
-                name, 
-                created_by, 
-                COALESCE(room_token, '') as token  -- Converts NULL to empty string
-            FROM rooms 
-            ORDER BY id
-        """)
-        
-        rooms = [
-            {
-                "id": row[0],
-                "name": row[1],
-                "created_by": row[2],
-                "token": row[3]  # Will never be NULL
-            }
-            for row in cursor.fetchall()
-        ]
-        
-        return rooms
-        
-    finally:
-        cursor and cursor.close()
-        conn and conn.close() 
+        return await _keyset_page(
+            response, ADMIN_ROOMS_SELECT, _room_filters(created_by), after_id, limit, _admin_room
+        )
+    except Exception as e:
+        print(f"Error fetching rooms: {str(e)}")
+        raise HTTPException(500, detail="Failed to fetch rooms")
+
+@app.get("/admin/rooms/export")
+async def export_rooms(
+    after_id: Optional[int] = None,
+    created_by: Optional[int] = None,
+    _ = Depends(require_admin)
+):
+    return _ndjson_export(ADMIN_ROOMS_SELECT, _room_filters(created_by), after_id, _admin_room)
+
 @app.get("/admin/users", response_model=List[UserResponse])
-async def get_all_users(_ = Depends(require_admin)):
-    conn = None
-    cursor = None
+async def get_all_users(
+    response: Response,
+    after_id: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=MAX_ADMIN_PAGE_SIZE),
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    _ = Depends(require_admin)
+):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, username, email, role, is_active 
-            FROM users
-            ORDER BY id
-        """)
-        
-        users = [
-            {
-                "id": row[0],
-                "username": row[1],
-                "email": row[2] or "",  # Handle NULL emails
-                "role": row[3],
-                "is_active": row[4]
-            }
-            for row in cursor.fetchall()
-        ]
-        
-        return users
-        
+        return await _keyset_page(
+            response, ADMIN_USERS_SELECT, _user_filters(role, is_active), after_id, limit, _admin_user
+        )
     except Exception as e:
         print(f"Error fetching users: {str(e)}")
         raise HTTPException(500, detail="Failed to fetch users")
-    finally:
-        cursor and cursor.close()
-        conn and conn.close()
+
+@app.get("/admin/users/export")
+async def export_users(
+    after_id: Optional[int] = None,
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    _ = Depends(require_admin)
+):
+    return _ndjson_export(ADMIN_USERS_SELECT, _user_filters(role, is_active), after_id, _admin_user)
+
+@app.get("/admin/connections")
+async def get_connections(top: int = Query(50, ge=1, le=1000), _ = Depends(require_admin)):
+    """This worker's WebSocket connections: counts and estimated memory, overall
+    and for the ``top`` largest rooms."""
+    return {**manager.introspect(top), "totals": {**manager.stats(), **unread_notifier.stats()}}
+
 @app.delete("/admin/users/{user_id}")
 async def admin_delete_user(user_id: int, _ = Depends(require_admin)):
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+    def _delete_user(cursor):
         # First delete from room_participants if needed
         cursor.execute("""
             DELETE FROM room_participants 
             WHERE user_id = %s
         """, (user_id,))
-        
+
         # Then delete the user
         cursor.execute("""
             DELETE FROM users 
             WHERE id = %s
             RETURNING id
         """, (user_id,))
-        
+
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="User not found")
-            
-        conn.commit()
+
+    try:
+        await run_in_db(_delete_user, commit=True)
+        invalidate_user(user_id)
+        await manager.publish_event("user_invalidated", user_id)
         return {"status": "success", "message": "User deleted"}
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.delete("/admin/rooms/{room_token}")
 async def admin_delete_room(room_token: str, _ = Depends(require_admin)):
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+    def _delete_room(cursor):
         # First delete from room_participants if needed
         cursor.execute("""
             DELETE FROM room_participants 
             WHERE room_id = (SELECT id FROM rooms WHERE room_token = %s)
         """, (room_token,))
-        
+
         # Then delete the room
         cursor.execute("""
             DELETE FROM rooms 
             WHERE room_token = %s
             RETURNING id
         """, (room_token,))
-        
+
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="Room not found")
-            
-        conn.commit()
+
+    try:
+        await run_in_db(_delete_room, commit=True)
+        await invalidate_room(room_token)
         return {"status": "success", "message": "Room deleted"}
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
-
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_db_connection():
-    return connect(load_config())
 
 @app.get("/")
 def root():
@@ -226,51 +331,33 @@ def root():
 
 @app.post("/signup")
 async def signup(user: UserSignup):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM users WHERE username = %s", (user.username,))
-        if cursor.fetchone():
+        if await fetch_one("SELECT id FROM users WHERE username = %s", (user.username,)):
             raise HTTPException(status_code=400, detail="Username already exists")
 
-        hashed_password = pwd_context.hash(user.password)
-        cursor.execute(
+        hashed_password = await password_hasher.hash(user.password)
+        row = await execute(
             """INSERT INTO users (username, email, hashed_password, role, is_active) 
             VALUES (%s, %s, %s, %s, %s) RETURNING id""",
-            (user.username, user.email, hashed_password, user.role, True)
+            (user.username, user.email, hashed_password, user.role, True),
+            returning=True
         )
-        user_id = cursor.fetchone()[0]
-        conn.commit()
 
-        return {"status": "success", "user_id": user_id}
+        return {"status": "success", "user_id": row[0]}
     except HTTPException:
         raise
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="Server busy, try again")
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.post("/login", response_model=Token)
 async def login(credentials: UserLogin):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
+        user = await fetch_one(
             "SELECT id, username, hashed_password, role FROM users WHERE username = %s", 
             (credentials.username,)
         )
-        user = cursor.fetchone()
 
         if not user:
             raise HTTPException(
@@ -278,121 +365,77 @@ async def login(credentials: UserLogin):
                 detail="Invalid credentials"
             )
 
-        if not pwd_context.verify(credentials.password, user[2]):
+        valid, new_hash = await password_hasher.verify_and_update(credentials.password, user[2])
+        if not valid:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
             )
 
+        # Stored with an old scheme or cost: upgrade it now that we have the password
+        if new_hash:
+            await execute(
+                "UPDATE users SET hashed_password = %s WHERE id = %s AND hashed_password = %s",
+                (new_hash, user[0], user[2])
+            )
+
         access_token = create_access_token(
             data={"sub": user[1], "user_id": user[0], "role": user[3]}
         )
 
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException:
+        raise
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="Server busy, try again")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
         )
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.get("/users/me")
-async def read_current_user(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        user_id = payload.get("user_id")
-        if not username:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT id, username, email, role FROM users WHERE username = %s", (username,))
-        user = cursor.fetchone()
-
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+async def read_current_user(user: dict = Depends(get_current_user)):
+    return {
+        "id": user["id"],  # Make sure this is included
+        "username": user["username"],
+        "email": user["email"],
+        "role": user["role"]
+    }
 
-        return {
-            "id": user[0],  # Make sure this is included
-            "username": user[1],
-            "email": user[2],
-            "role": user[3]
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 @app.get("/users/me/rooms")
-async def get_user_rooms(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    conn = None
-    cursor = None
+async def get_user_rooms(user: dict = Depends(get_current_user)):
+    user_id = user["id"]
+
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Creators are participants too, so one lookup on the participants
+        # primary key gives every room with its unread counter
+        rooms = await fetch_all("""
+            SELECT r.id, r.name, r.description, r.room_token, r.created_by,
+                   rp.unread_count, rp.last_read_id
+            FROM room_participants rp
+            JOIN rooms r ON r.id = rp.room_id
+            WHERE rp.user_id = %s
+        """, (user_id,))
 
-        # Select the creator as well
-        cursor.execute("""
-            SELECT r.id, r.name, r.description, r.room_token, r.created_by
-            FROM rooms r
-            LEFT JOIN room_participants rp ON r.id = rp.room_id
-            WHERE r.created_by = %s OR rp.user_id = %s
-            GROUP BY r.id
-        """, (user_id, user_id))
-        
-        rooms = cursor.fetchall()
         return [{
             "id": room[0],
             "name": room[1],
             "description": room[2],
             "token": room[3],
-            "created_by": room[4]  # ✅ now included!
+            "created_by": room[4],  # ✅ now included!
+            "unread": room[5],
+            "last_read_id": room[6]
         } for room in rooms]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+
 @app.post("/rooms/create")
-async def create_room(room: RoomCreateRequest, token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+async def create_room(room: RoomCreateRequest, user: dict = Depends(get_current_user)):
+    user_id = user["id"]
 
+    def _create_room(cursor):
         cursor.execute("SELECT id FROM rooms WHERE name = %s", (room.name,))
         if cursor.fetchone():
             raise HTTPException(status_code=400, detail="Room name already taken")
@@ -405,136 +448,173 @@ async def create_room(room: RoomCreateRequest, token: str = Depends(oauth2_schem
             (room.name, room.description, user_id, room.is_private, room_token)
         )
         room_id = cursor.fetchone()[0]
-        conn.commit()
+        # The creator gets a read marker like any participant
+        cursor.execute(
+            "INSERT INTO room_participants (user_id, room_id) VALUES (%s, %s)",
+            (user_id, room_id)
+        )
+        return room_id, room_token
+
+    try:
+        room_id, room_token = await run_in_db(_create_room, commit=True)
+        participant_cache.set((user_id, room_id), True)
         print("DEBUG: Room create response:", {"room_id": room_id, "room_token": room_token})
         return {"room_id": room_id, "room_token": room_token}
-        # return {"room_id": room_id, "room_token": room_token}
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.get("/rooms/token/{room_token}")
-async def get_room_by_token(room_token: str, token: str = Depends(oauth2_scheme)):
+async def get_room_by_token(room_token: str, _ = Depends(get_current_user)):
     try:
-        jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        room = await load_room(room_token)
 
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if not room:
+            raise HTTPException(status_code=404, detail="Room not found")
 
-        cursor.execute("""
-            SELECT id, name, description, created_by, is_private 
-            FROM rooms WHERE room_token = %s
-        """, (room_token,))
-        room = cursor.fetchone()
+        return room
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/rooms/{room_token}/read")
+async def mark_room_read(room_token: str, marker: ReadMarkerRequest, user: dict = Depends(get_current_user)):
+    """Move the user's read marker forward; markers never move back."""
+    user_id = user["id"]
 
+    try:
+        room = await load_room(room_token)
         if not room:
             raise HTTPException(status_code=404, detail="Room not found")
 
-        return {
-            "id": room[0],
-            "name": room[1],
-            "description": room[2],
-            "created_by": room[3],
-            "is_private": room[4]
-        }
+        unread = await mark_read(user_id, room["id"], marker.message_id)
+        if unread is not None:
+            return {"unread": unread, "last_read_id": marker.message_id}
+
+        row = await fetch_one("""
+            SELECT unread_count, last_read_id FROM room_participants
+            WHERE user_id = %s AND room_id = %s
+        """, (user_id, room["id"]))
+        if not row:
+            raise HTTPException(status_code=404, detail="Not a participant of this room")
+        return {"unread": row["unread_count"], "last_read_id": row["last_read_id"]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/search")
+async def search(
+    q: str,
+    room_token: Optional[str] = None,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = RANK,
+    user: dict = Depends(get_current_user)
+):
+    """Search messages in one room (room_token) or in every room the user created or joined."""
+    try:
+        room_id = None
+        if room_token is not None:
+            room = await load_room(room_token)
+            if not room:
+                raise HTTPException(status_code=404, detail="Room not found")
+            room_id = room["id"]
+
+        return await search_messages(q, user["id"], room_id, limit, cursor, sort)
+    except HTTPException:
+        raise
+    except SearchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.put("/rooms/{room_token}")
 async def update_room(
     room_token: str,
     room_data: dict,
-    token: str = Depends(oauth2_scheme)
+    user: dict = Depends(get_current_user)
 ):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    user_id = user["id"]
+    retention_days = room_data.get("message_retention_days")
+    if retention_days is not None and (
+        isinstance(retention_days, bool) or not isinstance(retention_days, int) or retention_days <= 0
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="message_retention_days must be null or a positive number of days"
+        )
+    window_ms = room_data.get("coalesce_window_ms")
+    if window_ms is not None and (
+        isinstance(window_ms, bool) or not isinstance(window_ms, int) or not 0 <= window_ms <= MAX_COALESCE_WINDOW_MS
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"coalesce_window_ms must be null or 0-{MAX_COALESCE_WINDOW_MS}"
+        )
 
+    def _update_room(cursor):
         # Verify user is the room creator
         cursor.execute("""
             SELECT created_by FROM rooms 
             WHERE room_token = %s
         """, (room_token,))
         room = cursor.fetchone()
-        
+
         if not room:
             raise HTTPException(status_code=404, detail="Room not found")
-        
+
         if room[0] != user_id:
             raise HTTPException(
                 status_code=403, 
                 detail="Only room creator can update the room"
             )
 
-        # Update room
+        # Update room; message_retention_days (days, or null for the global
+        # retention) and coalesce_window_ms (ms, or null for
+        # WS_COALESCE_WINDOW_MS) are only changed when present in the request
         cursor.execute("""
             UPDATE rooms 
-            SET name = %s 
+            SET name = COALESCE(%s, name),
+                message_retention_days = CASE WHEN %s THEN %s ELSE message_retention_days END,
+                coalesce_window_ms = CASE WHEN %s THEN %s ELSE coalesce_window_ms END
             WHERE room_token = %s
-            RETURNING id, name
-        """, (room_data.get("name"), room_token))
-        
-        updated_room = cursor.fetchone()
-        conn.commit()
-        
+            RETURNING id, name, message_retention_days, coalesce_window_ms
+        """, (
+            room_data.get("name"),
+            "message_retention_days" in room_data,
+            retention_days,
+            "coalesce_window_ms" in room_data,
+            window_ms,
+            room_token
+        ))
+        return cursor.fetchone()
+
+    try:
+        updated_room = await run_in_db(_update_room, commit=True)
+        await invalidate_room(room_token)
+        if "coalesce_window_ms" in room_data:
+            await set_coalesce_window(room_token, updated_room[3])
+
         return {
             "id": updated_room[0],
-            "name": updated_room[1]
+            "name": updated_room[1],
+            "message_retention_days": updated_room[2],
+            "coalesce_window_ms": updated_room[3]
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @app.delete("/rooms/{room_token}")
-async def delete_room(room_token: str, token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    conn = None
-    cursor = None
-
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+async def delete_room(room_token: str, user: dict = Depends(get_current_user)):
+    user_id = user["id"]
 
+    def _delete_room(cursor):
         # Check if the user is the room creator
         cursor.execute("SELECT created_by FROM rooms WHERE room_token = %s", (room_token,))
         room = cursor.fetchone()
@@ -549,17 +629,13 @@ async def delete_room(room_token: str, token: str = Depends(oauth2_scheme)):
 
         # Delete room
         cursor.execute("DELETE FROM rooms WHERE room_token = %s", (room_token,))
-        conn.commit()
 
+    try:
+        await run_in_db(_delete_room, commit=True)
+        await invalidate_room(room_token)
         return {"status": "success", "message": "Room deleted"}
 
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
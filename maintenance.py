@@ -0,0 +1,227 @@
+# maintenance.py
+"""Partition upkeep and retention for the messages table.
+
+Creates future monthly partitions, archives partitions older than the global
+retention period (detach, COPY to a gzip'd CSV, drop) and applies per-room
+retention (rooms.message_retention_days: archive and delete that room's older
+rows). Runs periodically inside the app and can be run by hand or from cron:
+
+    python maintenance.py
+"""
+import asyncio
+import gzip
+import os
+import re
+from datetime import date, datetime, timedelta
+
+from connect import connect
+from config import load_config
+from pubsub import PUBSUB_BACKEND, CONTROL_ROOM, encode_event, notify
+
+# 0 keeps messages forever; otherwise whole months older than this are archived
+MESSAGE_RETENTION_MONTHS = int(os.getenv("MESSAGE_RETENTION_MONTHS", "0"))
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "archive")
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# How often the app runs maintenance; 0 disables the in-app job
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+
+# Only one worker/process runs maintenance at a time
+ADVISORY_LOCK_KEY = 720_301
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+
+def _month_start(year: int, month: int) -> date:
+    return date(year, month, 1)
+
+
+def _add_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def ensure_partitions(cur, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    cur.execute("SELECT ensure_message_partitions(%s)", (months_ahead,))
+
+
+def drain_default_partition(conn):
+    """Give every month with rows in messages_default its own partition.
+
+    create_message_partition moves those rows into it, so they are archived
+    with the month instead of staying in the default partition forever. A
+    month that fails is logged and skipped; the rest still run.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT date_trunc('month', created_at)::date FROM messages_default")
+        months = [row[0] for row in cur.fetchall()]
+    for month_start in sorted(months):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT create_message_partition(%s)", (month_start,))
+                name = cur.fetchone()[0]
+            conn.commit()
+            print(f"[MAINTENANCE] Moved {month_start:%Y-%m} rows from messages_default to {name}")
+        except Exception as e:
+            conn.rollback()
+            print(f"[MAINTENANCE] Could not partition {month_start:%Y-%m} out of messages_default: {str(e)}")
+
+
+def list_monthly_partitions(cur):
+    """[(name, month_start, attached)] for every messages_yYYYYmMM table."""
+    cur.execute("""
+        SELECT c.relname, i.inhparent IS NOT NULL AS attached
+        FROM pg_class c
+        LEFT JOIN pg_inherits i
+            ON i.inhrelid = c.oid AND i.inhparent = 'messages'::regclass
+        WHERE c.relkind = 'r'
+          AND c.relnamespace = 'public'::regnamespace
+          AND c.relname LIKE 'messages\\_y%m%'
+    """)
+    partitions = []
+    for name, attached in cur.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, _month_start(int(match[1]), int(match[2])), attached))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def _copy_to_archive(cur, query: str, path: str):
+    tmp_path = path + ".part"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+    os.replace(tmp_path, path)
+
+
+def archive_old_partitions(conn, retention_months: int = MESSAGE_RETENTION_MONTHS,
+                           archive_dir: str = MESSAGE_ARCHIVE_DIR):
+    """Detach, archive and drop monthly partitions older than the retention period.
+
+    A partition is only dropped once its archive file has been written; one
+    left detached by an earlier failed run is picked up again.
+    """
+    if retention_months <= 0:
+        return []
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = _add_months(date.today().replace(day=1), -retention_months)
+    archived = []
+    with conn.cursor() as cur:
+        partitions = list_monthly_partitions(cur)
+    for name, month_start, attached in partitions:
+        if _add_months(month_start, 1) > cutoff:
+            continue
+        with conn.cursor() as cur:
+            if attached:
+                cur.execute(f'ALTER TABLE messages DETACH PARTITION "{name}"')
+                conn.commit()
+            path = os.path.join(archive_dir, f"{name}.csv.gz")
+            _copy_to_archive(cur, f'SELECT * FROM "{name}" ORDER BY id', path)
+            cur.execute(f'DROP TABLE "{name}"')
+            conn.commit()
+        print(f"[MAINTENANCE] Archived partition {name} to {path}")
+        archived.append(name)
+    return archived
+
+
+def apply_room_retention(conn, archive_dir: str = MESSAGE_ARCHIVE_DIR):
+    """Archive and delete messages older than each room's message_retention_days.
+
+    Returns the ids of the rooms that lost messages.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, message_retention_days FROM rooms
+            WHERE message_retention_days IS NOT NULL
+        """)
+        rooms = cur.fetchall()
+    os.makedirs(archive_dir, exist_ok=True)
+    pruned = []
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    for room_id, retention_days in rooms:
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM messages WHERE room_id = %s AND created_at < %s LIMIT 1",
+                (room_id, cutoff)
+            )
+            if not cur.fetchone():
+                continue
+            condition = cur.mogrify("room_id = %s AND created_at < %s", (room_id, cutoff)).decode()
+            path = os.path.join(archive_dir, f"room_{room_id}_{stamp}.csv.gz")
+            _copy_to_archive(cur, f"SELECT * FROM messages WHERE {condition} ORDER BY id", path)
+            cur.execute(f"DELETE FROM messages WHERE {condition}")
+            conn.commit()
+        print(f"[MAINTENANCE] Archived room {room_id} messages older than {retention_days} days to {path}")
+        pruned.append(room_id)
+    return pruned
+
+
+def invalidate_history(conn, room_ids, on_pruned=None):
+    """Make the app drop cached history of rooms that lost messages (None: every room).
+
+    On the postgres pub/sub backend every worker is told through NOTIFY, so
+    this also works from cron; ``on_pruned(room_ids)`` covers the worker
+    running the in-app job on the memory backend.
+    """
+    if PUBSUB_BACKEND == "postgres":
+        with conn.cursor() as cur:
+            notify(cur, CONTROL_ROOM, encode_event("history_invalidated", room_ids))
+        conn.commit()
+    if on_pruned is not None:
+        on_pruned(room_ids)
+
+
+def run_maintenance(config=None, on_pruned=None):
+    """Run one maintenance pass unless another process is already running one.
+
+    ``on_pruned`` is called on this thread with the rooms that lost messages,
+    see invalidate_history.
+    """
+    conn = connect(config or load_config())
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                return False
+        try:
+            try:
+                with conn.cursor() as cur:
+                    ensure_partitions(cur)
+                conn.commit()
+            except Exception as e:
+                # Archiving and room retention still run without new partitions
+                conn.rollback()
+                print(f"[MAINTENANCE] Creating partitions failed: {str(e)}")
+            drain_default_partition(conn)
+            if archive_old_partitions(conn):
+                invalidate_history(conn, None, on_pruned)
+            pruned = apply_room_retention(conn)
+            if pruned:
+                invalidate_history(conn, pruned, on_pruned)
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+            conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+async def maintenance_loop(interval_hours: float = MAINTENANCE_INTERVAL_HOURS, on_pruned=None):
+    """Background task started with the app; ``on_pruned`` runs on the event loop."""
+    loop = asyncio.get_running_loop()
+
+    def pruned(room_ids):
+        if on_pruned is not None:
+            loop.call_soon_threadsafe(on_pruned, room_ids)
+
+    while True:
+        try:
+            await loop.run_in_executor(None, run_maintenance, None, pruned)
+        except Exception as e:
+            print(f"[MAINTENANCE] Failed: {str(e)}")
+        await asyncio.sleep(interval_hours * 3600)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(0 if run_maintenance() else 1)
@@ -0,0 +1,220 @@
+# message_writer.py
+import asyncio
+import os
+from datetime import datetime
+from typing import List, Optional
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from database import run_in_db
+
+# Group commit window: a batch is flushed once it has MESSAGE_BATCH_SIZE rows
+# or MESSAGE_BATCH_DELAY_MS after its first message, whichever comes first
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "500"))
+MESSAGE_BATCH_DELAY_MS = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "2"))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+# "commit": callers are answered once the batch is committed.
+# "broadcast_first": callers are answered as soon as ids are assigned, before
+# the insert commits; a failed commit then loses already-broadcast messages.
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "commit")
+
+COMMIT = "commit"
+BROADCAST_FIRST = "broadcast_first"
+
+# Errors caused by one row's data (a NUL byte, a sender or room deleted while
+# the message was queued) rather than by the database itself
+ROW_ERRORS = (ValueError, psycopg2.DataError, psycopg2.IntegrityError)
+
+
+class _Pending:
+    __slots__ = ("content", "sender_id", "room_id", "created_at", "future", "message_id")
+
+    def __init__(self, content, sender_id, room_id, created_at, future):
+        self.content = content
+        self.sender_id = sender_id
+        self.room_id = room_id
+        self.created_at = created_at
+        self.future = future
+        self.message_id = None
+
+    def result(self) -> dict:
+        return {"id": self.message_id, "created_at": self.created_at}
+
+
+class MessageWriter:
+    """Write-behind stage that persists chat messages from all rooms in batches.
+
+    Messages are flushed by a single task, one multi-row INSERT per batch, so
+    throughput is bounded by batches per fsync instead of rows per fsync. Ids
+    are taken from the messages sequence at flush time and handed out in
+    submission order, which keeps every room's messages in order. A batch
+    that fails on a bad row is retried in halves, so only the offending
+    messages fail and every other sender's message is still written.
+    """
+
+    def __init__(
+        self,
+        max_batch: int = MESSAGE_BATCH_SIZE,
+        max_delay: float = MESSAGE_BATCH_DELAY_MS / 1000,
+        durability: str = MESSAGE_DURABILITY,
+        queue_size: int = MESSAGE_QUEUE_SIZE
+    ):
+        if durability not in (COMMIT, BROADCAST_FIRST):
+            raise ValueError(f"Unknown MESSAGE_DURABILITY {durability!r}, expected 'commit' or 'broadcast_first'")
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self.queue_size = queue_size
+        # Counters
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.largest_batch = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._runner: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._runner is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._runner = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Flush whatever is queued, then stop."""
+        if self._runner is None:
+            return
+        await self._queue.put(None)
+        await self._runner
+        self._runner = None
+
+    async def submit(self, content: str, sender_id: int, room_id: int) -> dict:
+        """Queue a message and wait for its id (and commit, in commit mode).
+
+        Returns ``{"id": ..., "created_at": ...}`` like the old INSERT ... RETURNING.
+        Raises ValueError for content PostgreSQL cannot store.
+        """
+        if "\x00" in content:
+            raise ValueError("Message content cannot contain NUL characters")
+        if self._runner is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Pending(content, sender_id, room_id, datetime.utcnow(), future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "largest_batch": self.largest_batch,
+            "queued": self._queue.qsize() if self._queue else 0
+        }
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            if self.max_delay and self._queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[_Pending]):
+        loop = asyncio.get_running_loop()
+        try:
+            await run_in_db(self._write, batch, loop, commit=True)
+        except Exception as e:
+            if isinstance(e, ROW_ERRORS) and len(batch) > 1:
+                # Retry each half so one bad row only fails its own sender
+                middle = len(batch) // 2
+                await self._flush(batch[:middle])
+                await self._flush(batch[middle:])
+            else:
+                self._fail(batch, e)
+            return
+        self.batches += 1
+        self.written += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for item in batch:
+            self._resolve(item)
+
+    def _fail(self, batch: List[_Pending], e: Exception):
+        self.failed += len(batch)
+        print(f"[WRITER] Failed to persist {len(batch)} messages: {str(e)}")
+        for item in batch:
+            if not item.future.done():
+                item.future.set_exception(e)
+
+    def _write(self, cur, batch: List[_Pending], loop):
+        # Runs on a database thread, inside one transaction.
+        # A retried message keeps the id it was given: sequence values are never
+        # handed out twice, and broadcast_first callers may already have sent it
+        fresh = [item for item in batch if item.message_id is None]
+        if fresh:
+            cur.execute(
+                "SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, %s)",
+                (len(fresh),)
+            )
+            ids = sorted(row[0] for row in cur.fetchall())
+            for item, message_id in zip(fresh, ids):
+                item.message_id = message_id
+        if self.durability == BROADCAST_FIRST:
+            for item in batch:
+                loop.call_soon_threadsafe(self._resolve, item)
+        execute_values(
+            cur,
+            "INSERT INTO messages (id, content, sender_id, room_id, created_at) VALUES %s",
+            [
+                (item.message_id, item.content, item.sender_id, item.room_id, item.created_at)
+                for item in batch
+            ],
+            page_size=len(batch)
+        )
+        self._count_unread(cur, batch)
+
+    @staticmethod
+    def _count_unread(cur, batch: List[_Pending]):
+        """Bump every participant's unread counter once per room for the whole batch.
+
+        Sending counts as reading: a sender's marker moves to their last
+        message and only messages after it in the batch stay unread for them.
+        """
+        # Walk newest first: the first message seen from a sender is their last,
+        # and the room's running count is how many came after it
+        per_room = {}  # {room_id: messages in batch}
+        senders = {}   # {(room_id, sender_id): (last message id, messages after it)}
+        for item in reversed(batch):
+            key = (item.room_id, item.sender_id)
+            if key not in senders:
+                senders[key] = (item.message_id, per_room.get(item.room_id, 0))
+            per_room[item.room_id] = per_room.get(item.room_id, 0) + 1
+        # Sorted so participant rows are always locked in the same order
+        execute_values(
+            cur,
+            """UPDATE room_participants rp SET unread_count = rp.unread_count + b.n
+            FROM (VALUES %s) AS b(room_id, n) WHERE rp.room_id = b.room_id""",
+            sorted(per_room.items()),
+            page_size=len(per_room)
+        )
+        execute_values(
+            cur,
+            """UPDATE room_participants rp
+            SET last_read_id = s.last_id, unread_count = s.unread
+            FROM (VALUES %s) AS s(room_id, user_id, last_id, unread)
+            WHERE rp.room_id = s.room_id AND rp.user_id = s.user_id AND rp.last_read_id < s.last_id""",
+            sorted((room_id, sender_id, last_id, unread) for (room_id, sender_id), (last_id, unread) in senders.items()),
+            page_size=len(senders)
+        )
+
+    @staticmethod
+    def _resolve(item: _Pending):
+        if not item.future.done():
+            item.future.set_result(item.result())
@@ -0,0 +1,264 @@
+# metrics.py
+import bisect
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+# Queries slower than this are logged with their SQL template (0 disables the log)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Seconds; covers sub-millisecond cache hits up to requests that time out
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, optionally split by label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {} if labels else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, as Prometheus expects."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # {label values: [per-bucket counts (last is +Inf), sum]}
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        lines = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_labels(self.labels, key, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time, so nothing is paid per event.
+
+    The callback returns a number, or a ``{label values: number}`` dict for
+    labelled gauges.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+
+    def samples(self) -> List[str]:
+        value = self.read()
+        if not isinstance(value, dict):
+            return [f"{self.name} {_number(value)}"]
+        return [f"{self.name}{_format_labels(self.labels, key)} {_number(v)}" for key, v in value.items()]
+
+
+class CallbackCounter(Gauge):
+    """Running total kept elsewhere (e.g. a component's stats), read at scrape time."""
+
+    kind = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, read, labels))
+
+    def callback_counter(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()) -> CallbackCounter:
+        return self.register(CallbackCounter(name, help, read, labels))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"[METRICS] Could not read {metric.name}: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# HTTP
+http_request_seconds = registry.histogram(
+    "chat_http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ("method", "route", "status")
+)
+
+# Database
+db_query_seconds = registry.histogram(
+    "chat_db_query_duration_seconds",
+    "Time spent executing SQL statements, by statement kind",
+    ("statement",)
+)
+db_pool_wait_seconds = registry.histogram(
+    "chat_db_pool_wait_seconds",
+    "Time waiting for a pooled database connection"
+)
+db_slow_queries = registry.counter(
+    "chat_db_slow_queries_total",
+    "Statements slower than SLOW_QUERY_MS"
+)
+
+# WebSockets
+ws_messages_in = registry.counter(
+    "chat_ws_messages_received_total",
+    "Frames received from WebSocket clients",
+    ("endpoint",)
+)
+ws_broadcast_seconds = registry.histogram(
+    "chat_ws_broadcast_fanout_seconds",
+    "Time to queue one broadcast frame for every local member of a room",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+)
+
+
+def pick(stats: dict, *keys) -> dict:
+    """``{(key,): stats[key]}`` for a labelled gauge fed from a stats dict."""
+    return {(key,): stats[key] for key in keys}
+
+
+class TimingMiddleware:
+    """ASGI middleware timing every HTTP request until its last body chunk is sent.
+
+    Requests are labelled by route template (``/rooms/token/{room_token}``),
+    not the raw path, so the number of series stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                getattr(route, "path", "other"),
+                str(status[0])
+            )
+
+
+def _query_text(query) -> str:
+    return query.decode(errors="replace") if isinstance(query, bytes) else str(query)
+
+
+def statement_kind(query) -> str:
+    """SELECT, INSERT, ... of a statement; keeps the query label's cardinality tiny."""
+    words = _query_text(query).split(None, 1)
+    return words[0].upper() if words else "EMPTY"
+
+
+def record_query(query, seconds: float):
+    db_query_seconds.observe(seconds, statement_kind(query))
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        db_slow_queries.inc()
+        print(f"[SLOW QUERY] {seconds * 1000:.1f}ms {loggable_query(query)[:500]}")
+
+
+def loggable_query(query) -> str:
+    """Query text that is safe to log.
+
+    Statements the application writes arrive as ``str`` templates with
+    placeholders. ``bytes`` were rendered by psycopg2 (``execute_values``,
+    ``mogrify``) with the values inlined, chat message contents included, so
+    only the part before the VALUES list is kept, or just the statement kind.
+    """
+    text = " ".join(_query_text(query).split())
+    if not isinstance(query, bytes):
+        return text
+    values = re.search(r"\bVALUES\b", text, re.IGNORECASE)
+    if values is None:
+        return f"{statement_kind(query)} (rendered)"
+    return f"{text[:values.end()]} ... (rendered)"
@@ -11,19 +11,25 @@ def run_migrations():
         
         # Get the directory where this script is located
         script_dir = os.path.dirname(os.path.abspath(__file__))
-        sql_path = os.path.join(script_dir, 'db', 'init', '01_tables.sql')
+        init_dir = os.path.join(script_dir, 'db', 'init')
         
-        # Read and execute your SQL file
-        with open(sql_path, 'r') as f:
-            sql = f.read()
-            cursor.execute(sql)
+        # Run every init script in order, as the Postgres container does on first start
+        for name in sorted(os.listdir(init_dir)):
+            if not name.endswith('.sql'):
+                continue
+            with open(os.path.join(init_dir, name), 'r') as f:
+                sql = f.read()
+                cursor.execute(sql)
         
         conn.commit()
         print("✅ Database tables created successfully")
+        return True
     except Exception as e:
         print("❌ Migration failed:", e)
+        return False
     finally:
-        conn.close()
+        if conn:
+            conn.close()
 
 if __name__ == '__main__':
     import sys
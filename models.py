@@ -27,12 +27,16 @@ class Room(SQLModel, table=True):
     created_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
     is_private: bool = Field(default=False)
     room_token: Optional[str] = Field(default=None, unique=True)
+    message_retention_days: Optional[int] = None
+    coalesce_window_ms: Optional[int] = None
 
 class Message(SQLModel, table=True):
+    # Partitioned by month on created_at, which is therefore part of the key.
+    # The generated content_tsv search column is maintained by the database.
     __tablename__ = "messages"
     
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str = Field(nullable=False)
     room_id: int = Field(foreign_key="rooms.id")
     sender_id: int = Field(foreign_key="users.id")
-    created_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    created_at: datetime = Field(default_factory=datetime.utcnow, primary_key=True)
\ No newline at end of file
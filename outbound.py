@@ -0,0 +1,164 @@
+# outbound.py
+import asyncio
+import sys
+import time
+from collections import deque
+from typing import Callable, Optional, Union
+
+from fastapi import WebSocket, status
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+SLOW_CONSUMER = "slow consumer"
+
+# Rough sizes not visible to sys.getsizeof: a (key, payload) tuple in the
+# deque, and the writer coroutine's frame
+_FRAME_SLOT_BYTES = 64
+_WRITER_TASK_BYTES = 600
+
+
+class OutboundQueue:
+    """Bounded send queue for one WebSocket, drained by its own writer task.
+
+    ``put`` never blocks, so a slow client cannot hold up a broadcast. What
+    happens when the queue is full depends on ``policy``:
+
+    * ``drop_oldest`` - discard the oldest queued frame to make room.
+    * ``coalesce``    - frames put with a ``key`` replace a still-queued frame
+      with the same key (latest state wins); on overflow the oldest frame is
+      dropped as with ``drop_oldest``.
+    * ``disconnect``  - close the socket (1013 try again later) and give up on
+      the slow consumer.
+
+    A send that takes longer than ``send_timeout`` also counts as a failure;
+    it is detected when the next frame is queued, so no timer runs per frame.
+
+    Frames are JSON text or already-encoded bytes. With an ``encoder`` (e.g.
+    msgpack for clients that negotiated it), text frames are converted by the
+    writer just before sending, so dropped or coalesced frames cost nothing;
+    bytes are sent as binary frames.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        maxsize: int = 256,
+        policy: str = DROP_OLDEST,
+        send_timeout: float = 5.0,
+        on_failure: Optional[Callable[["OutboundQueue"], None]] = None,
+        encoder: Optional[Callable[[str], bytes]] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy {policy!r}, expected one of {POLICIES}")
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_failure = on_failure
+        self.encoder = encoder
+        self.closed = False
+        self.failure = None  # reason the connection was given up on, if any
+        # Counters
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._frames = deque()  # [(key, payload)]
+        self._wakeup = asyncio.Event()
+        self._sending_since = None
+        self._writer = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._drain())
+        return self
+
+    def put(self, payload: Union[str, bytes], key: Optional[str] = None) -> bool:
+        """Queue a pre-encoded frame. Returns False if it was not accepted."""
+        if self.closed:
+            return False
+        if self._sending_since is not None and time.monotonic() - self._sending_since > self.send_timeout:
+            self._fail("send timed out")
+            return False
+
+        if key is not None and self.policy == COALESCE:
+            for i, (queued_key, _) in enumerate(self._frames):
+                if queued_key == key:
+                    self._frames[i] = (key, payload)
+                    self.coalesced += 1
+                    return True
+
+        if len(self._frames) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                self.dropped += len(self._frames) + 1
+                self._frames.clear()
+                self._fail(SLOW_CONSUMER, code=status.WS_1013_TRY_AGAIN_LATER)
+                return False
+            self._frames.popleft()
+            self.dropped += 1
+
+        self._frames.append((key, payload))
+        self.queued += 1
+        self._wakeup.set()
+        return True
+
+    def estimated_bytes(self) -> int:
+        """Memory held by this queue and its writer, excluding the queued payloads
+        themselves (one encoded payload is shared by every recipient)."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self._frames)
+        size += sys.getsizeof(self._wakeup) + len(self._frames) * _FRAME_SLOT_BYTES
+        if self._writer is not None:
+            size += sys.getsizeof(self._writer) + _WRITER_TASK_BYTES
+        return size
+
+    def close(self, code: Optional[int] = None):
+        """Stop the writer; frames still queued are discarded. With ``code``,
+        the socket is closed too."""
+        self.closed = True
+        self._frames.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if code is not None:
+            asyncio.ensure_future(self._close_socket(code))
+
+    async def _drain(self):
+        try:
+            while not self.closed:
+                if not self._frames:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                _, payload = self._frames.popleft()
+                self._sending_since = time.monotonic()
+                if self.encoder is not None and isinstance(payload, str):
+                    payload = self.encoder(payload)
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+                self._sending_since = None
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self._fail(str(e))
+
+    def _fail(self, reason: str, code: int = status.WS_1011_INTERNAL_ERROR):
+        if self.closed:
+            return
+        self.failure = reason
+        print(f"[OUTBOUND] Dropping connection: {reason}")
+        self.close(code)
+        if self.on_failure:
+            self.on_failure(self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
@@ -0,0 +1,134 @@
+# passwords.py
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+# First scheme hashes new passwords; the rest are still accepted and are
+# rehashed with the first one on the next successful login
+PASSWORD_SCHEMES = [s.strip() for s in os.getenv("PASSWORD_SCHEMES", "sha256_crypt").split(",") if s.strip()]
+# Cost of new hashes (scheme rounds); stored hashes with fewer rounds are upgraded on login
+PASSWORD_ROUNDS = os.getenv("PASSWORD_ROUNDS")
+# "process" keeps pure-Python hashing off the event loop's GIL; "thread" suits C-backed schemes
+PASSWORD_POOL = os.getenv("PASSWORD_POOL", "process")
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash/verify calls allowed to wait for a worker before new ones are refused
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", "100"))
+
+
+def build_context(schemes=PASSWORD_SCHEMES, rounds=PASSWORD_ROUNDS) -> CryptContext:
+    settings = {}
+    if rounds:
+        settings[f"{schemes[0]}__default_rounds"] = int(rounds)
+        settings[f"{schemes[0]}__min_rounds"] = int(rounds)
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+
+pwd_context = build_context()
+
+
+# Module-level so they can run in worker processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class HasherBusyError(Exception):
+    """Raised when too many hash/verify calls are already waiting for a worker."""
+
+
+class PasswordHasher:
+    """Runs password hashing and verification on a bounded worker pool.
+
+    At most ``workers`` calls run at once; up to ``max_queue`` more wait for a
+    slot and any beyond that fail fast with ``HasherBusyError``, so a login
+    spike never stalls the event loop or piles up unbounded work.
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_WORKERS,
+        max_queue: int = PASSWORD_MAX_QUEUE,
+        pool: str = PASSWORD_POOL
+    ):
+        if pool not in ("process", "thread"):
+            raise ValueError(f"Unknown PASSWORD_POOL {pool!r}, expected 'process' or 'thread'")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pool = pool
+        # Counters
+        self.running = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(valid, new_hash); new_hash is set when the stored hash should be replaced."""
+        return await self._run(_verify_and_update, password, hashed)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "peak_queue_depth": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+    async def _run(self, func, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._slots.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise HasherBusyError("Too many password operations in progress")
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                await self._slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.pool == "process":
+                # Spawned, not forked: by the first hash this process already runs
+                # the database and pub/sub threads, and a fork can copy their locks
+                # while held and deadlock the children
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="passwords")
+        return self._executor
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,176 @@
+# presence.py
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+# Seconds between presence frames per room; joins, leaves and typing in
+# between are coalesced into one diff. 0 disables presence and typing events.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "1"))
+# A user's typing notifications in a room are forwarded at most once per this many seconds
+TYPING_THROTTLE = float(os.getenv("TYPING_THROTTLE", "3"))
+# Online users listed in the snapshot a client gets when it joins a room
+PRESENCE_SNAPSHOT_MAX = int(os.getenv("PRESENCE_SNAPSHOT_MAX", "500"))
+# Seconds between the online lists each worker sends the others for their
+# snapshots; a worker not heard from for REMOTE_EXPIRY_SYNCS of them is dropped
+PRESENCE_SYNC_INTERVAL = float(os.getenv("PRESENCE_SYNC_INTERVAL", "5"))
+REMOTE_EXPIRY_SYNCS = 3
+
+
+class RoomDiff:
+    """Presence changes in one room since the last flush."""
+
+    __slots__ = ("joined", "left", "typing")
+
+    def __init__(self):
+        self.joined: Dict[str, str] = {}  # {user_id: username}
+        self.left: Dict[str, str] = {}
+        self.typing: Dict[str, str] = {}
+
+    def __bool__(self):
+        return bool(self.joined or self.left or self.typing)
+
+
+class PresenceTracker:
+    """In-memory presence and typing state for the rooms on this worker.
+
+    Nothing here touches the database. Joins and leaves (a user's first and
+    last connection to a room) and throttled typing notifications collect in
+    a per-room diff that ``drain`` hands out once per interval, so a busy room
+    gets at most one presence frame per ``interval`` however many users come
+    and go.
+
+    Snapshots also list users connected to other workers. Every worker sends
+    its whole online list every ``sync_interval`` (and when asked, so a worker
+    that starts late is seeded at once); each list replaces that worker's
+    previous one, and a worker that stops sending is forgotten.
+    """
+
+    def __init__(
+        self,
+        interval: float = PRESENCE_INTERVAL,
+        typing_throttle: float = TYPING_THROTTLE,
+        snapshot_max: int = PRESENCE_SNAPSHOT_MAX,
+        sync_interval: float = PRESENCE_SYNC_INTERVAL
+    ):
+        self.interval = interval
+        self.typing_throttle = typing_throttle
+        self.snapshot_max = snapshot_max
+        self.sync_interval = sync_interval
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._pending: Dict[str, RoomDiff] = {}  # {room_token: diff}
+        self._typing_at: Dict[Tuple[str, str], float] = {}  # {(room_token, user_id): monotonic}
+        # {worker_id: {room_token: usernames}}, from other workers' online lists
+        self.remote: Dict[str, Dict[str, List[str]]] = {}
+        self._remote_seen: Dict[str, float] = {}  # {worker_id: monotonic}
+        # Counters
+        self.frames = 0
+        self.typing_forwarded = 0
+        self.typing_throttled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def joined(self, room_token: str, user_id: str, username: str):
+        if not self.enabled:
+            return
+        diff = self._diff(room_token)
+        # Leaving and coming back within one interval is no change at all
+        if diff.left.pop(user_id, None) is None:
+            diff.joined[user_id] = username
+
+    def left(self, room_token: str, user_id: str, username: str):
+        if not self.enabled:
+            return
+        diff = self._diff(room_token)
+        diff.typing.pop(user_id, None)
+        self._typing_at.pop((room_token, user_id), None)
+        if diff.joined.pop(user_id, None) is None:
+            diff.left[user_id] = username
+
+    def typing(self, room_token: str, user_id: str, username: str) -> bool:
+        """Note that a user is typing; False if it was throttled."""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        key = (room_token, user_id)
+        last = self._typing_at.get(key)
+        if last is not None and now - last < self.typing_throttle:
+            self.typing_throttled += 1
+            return False
+        self._typing_at[key] = now
+        self._diff(room_token).typing[user_id] = username
+        self.typing_forwarded += 1
+        return True
+
+    def drain(self) -> List[Tuple[str, dict]]:
+        """The (room_token, frame) pairs to broadcast for everything since the last call."""
+        pending, self._pending = self._pending, {}
+        # Throttle entries only matter for typing_throttle seconds
+        cutoff = time.monotonic() - self.typing_throttle
+        for key in [key for key, at in self._typing_at.items() if at < cutoff]:
+            del self._typing_at[key]
+
+        frames = []
+        for room_token, diff in pending.items():
+            if not diff:
+                continue
+            frames.append((room_token, {
+                "type": "presence",
+                "joined": list(diff.joined.values()),
+                "left": list(diff.left.values()),
+                "typing": list(diff.typing.values())
+            }))
+        self.frames += len(frames)
+        return frames
+
+    def state(self, rooms: Optional[Dict[str, List[str]]]) -> dict:
+        """This worker's online list for the others; None says it is going away."""
+        return {"worker": self.worker_id, "rooms": rooms}
+
+    def apply_state(self, state: dict):
+        """Replace another worker's online list with the one it just sent."""
+        worker = state["worker"]
+        if worker == self.worker_id:
+            return
+        if state["rooms"] is None:
+            self.remote.pop(worker, None)
+            self._remote_seen.pop(worker, None)
+            return
+        self.remote[worker] = state["rooms"]
+        self._remote_seen[worker] = time.monotonic()
+
+    def snapshot(self, room_token: str, local_usernames) -> dict:
+        """Presence frame listing who is online in a room, local users first."""
+        self._expire_remote()
+        online = dict.fromkeys(local_usernames)
+        for rooms in self.remote.values():
+            online.update(dict.fromkeys(rooms.get(room_token, ())))
+        names = list(online)
+        return {
+            "type": "presence",
+            "room_token": room_token,
+            "online": names[:self.snapshot_max],
+            "count": len(names)
+        }
+
+    def stats(self) -> dict:
+        return {
+            "presence_frames": self.frames,
+            "typing_forwarded": self.typing_forwarded,
+            "typing_throttled": self.typing_throttled,
+            "presence_remote_workers": len(self.remote)
+        }
+
+    def _expire_remote(self):
+        cutoff = time.monotonic() - self.sync_interval * REMOTE_EXPIRY_SYNCS
+        for worker in [worker for worker, seen in self._remote_seen.items() if seen < cutoff]:
+            del self._remote_seen[worker]
+            self.remote.pop(worker, None)
+
+    def _diff(self, room_token: str) -> RoomDiff:
+        diff = self._pending.get(room_token)
+        if diff is None:
+            diff = self._pending[room_token] = RoomDiff()
+        return diff
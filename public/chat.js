@@ -28,6 +28,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentRoom = null;
     let currentRoomToken = null;
     let socket = null;
+    let lastMessageId = null;
+    let reconnectAttempts = 0;
+    const MAX_RECONNECT_ATTEMPTS = 5;
     let username = '';
     let userId = null;
     let userRole = null;
@@ -42,6 +45,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatMessages = document.getElementById('chat-messages');
     const messageForm = document.getElementById('message-form');
     const messageInput = document.getElementById('message-input');
+    const typingIndicator = document.getElementById('typing-indicator');
     const currentRoomName = document.getElementById('current-room-name');
     const createRoomModal = document.getElementById('create-room-modal');
     const joinRoomModal = document.getElementById('join-room-modal');
@@ -126,27 +130,36 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 }
 
+    // Admin listings are paged by id; follow X-Next-After-Id until the last page
+    async function fetchAllPages(url) {
+      const items = [];
+      let afterId = null;
+      do {
+        const pageUrl = afterId === null ? url : `${url}?after_id=${afterId}`;
+        const response = await fetch(pageUrl, {
+          headers: {
+            'Authorization': `Bearer ${token}`,
+            'Content-Type': 'application/json'
+          }
+        });
+        if (!response.ok) {
+          const errorData = await response.json().catch(() => ({}));
+          console.error('API Error:', response.status, errorData);
+          throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+        }
+        items.push(...await response.json());
+        afterId = response.headers.get('X-Next-After-Id');
+      } while (afterId !== null);
+      return items;
+    }
+
     // Load all rooms (admin only)
    async function loadAllRooms() {
   try {
     const adminRoomsList = document.getElementById('admin-rooms-list').querySelector('tbody');
     adminRoomsList.innerHTML = '<tr><td colspan="4" class="loading">Loading rooms...</td></tr>';
     
-    const response = await fetch('/admin/rooms', {
-      headers: { 
-        'Authorization': `Bearer ${token}`,
-        'Content-Type': 'application/json'
-      }
-    });
-    
-    // First check if response is ok
-    if (!response.ok) {
-      const errorData = await response.json().catch(() => ({}));
-      console.error('API Error:', response.status, errorData);
-      throw new Error(errorData.message || `HTTP error! status: ${response.status}`);
-    }
-    
-    const rooms = await response.json();
+    const rooms = await fetchAllPages('/admin/rooms');
     console.log('Rooms data:', rooms); // Debug log
     
     // Clear loading message
@@ -225,19 +238,7 @@ async function deleteRoomAdmin(roomId) {
         const adminUsersList = document.getElementById('admin-users-list');
         adminUsersList.innerHTML = '<tr><td colspan="5" class="loading">Loading users...</td></tr>';
         
-        const response = await fetch('/admin/users', {
-            headers: { 
-                'Authorization': `Bearer ${token}`,
-                'Content-Type': 'application/json'
-            }
-        });
-        
-        if (!response.ok) {
-            const error = await response.json().catch(() => ({}));
-            throw new Error(error.detail || 'Failed to load users');
-        }
-        
-        const users = await response.json();
+        const users = await fetchAllPages('/admin/users');
         adminUsersList.innerHTML = '';
         
         if (users.length === 0) {
@@ -335,7 +336,8 @@ async function deleteUser(userId) {
                     room.name, 
                     room.token, 
                     String(room.created_by) === String(userId),
-                    room.is_private
+                    room.is_private,
+                    room.token === currentRoomToken ? 0 : room.unread
                 );
             });
             
@@ -357,7 +359,7 @@ async function deleteUser(userId) {
     }
 
     // Add room to sidebar list with edit/delete options
-    function addRoomToList(name, token, isOwner, isPrivate = false) {
+    function addRoomToList(name, token, isOwner, isPrivate = false, unread = 0) {
         const roomItem = document.createElement('li');
         roomItem.dataset.token = token;
         
@@ -370,6 +372,7 @@ async function deleteUser(userId) {
         
         roomItem.innerHTML = `
             <span class="room-name">${name}</span>
+            <span class="unread-badge"></span>
             <div class="room-actions">
                 ${isPrivate ? '<button class="lock-icon" title="Show room token">🔒</button>' : ''}
                 ${showControls ? '<button class="edit-room-icon" title="Edit room">✏️</button>' : ''}
@@ -420,6 +423,27 @@ async function deleteUser(userId) {
         }
         
         roomsList.appendChild(roomItem);
+        setUnread(token, unread);
+    }
+
+    // Unread badge next to a room in the sidebar
+    function setUnread(roomToken, count) {
+        const badge = roomsList.querySelector(`li[data-token="${roomToken}"] .unread-badge`);
+        if (!badge) return;
+        badge.textContent = count > 99 ? '99+' : String(count || '');
+        badge.classList.toggle('hidden', !count);
+    }
+
+    // Tell the server what we have read, at most once per second
+    let readTimer = null;
+    function scheduleMarkRead() {
+        if (readTimer) return;
+        readTimer = setTimeout(() => {
+            readTimer = null;
+            if (lastMessageId != null && socket && socket.readyState === WebSocket.OPEN) {
+                socket.send(JSON.stringify({ type: 'read', message_id: lastMessageId }));
+            }
+        }, 1000);
     }
 
     // Show room token
@@ -549,29 +573,37 @@ async function deleteUser(userId) {
         }
     }
 
-    // Reset room UI
-    function resetRoomUI() {
+    // Close the current socket without triggering reconnect logic
+    function closeSocket() {
         if (socket) {
+            socket.onclose = null;
             socket.close();
             socket = null;
         }
+    }
+
+    // Reset room UI
+    function resetRoomUI() {
+        closeSocket();
         
         currentRoom = null;
         currentRoomToken = null;
+        lastMessageId = null;
         currentRoomName.textContent = 'Select a room';
         messageInput.disabled = true;
         messageForm.querySelector('button').disabled = true;
         chatMessages.innerHTML = '<p class="system-message">Select a room to start chatting</p>';
         usersList.innerHTML = '';
+        onlineUsers.clear();
+        typingUsers.clear();
+        renderTyping();
     }
 
     // Join room by token
     async function joinRoomByToken(roomToken) {
         if (!roomToken || currentRoomToken === roomToken) return;
         
-        if (socket) {
-            socket.close();
-        }
+        closeSocket();
         
         try {
             const response = await fetch(`/rooms/token/${roomToken}`, {
@@ -587,38 +619,12 @@ async function deleteUser(userId) {
             currentRoom = roomInfo.name;
             currentRoomToken = roomToken;
             currentRoomName.textContent = currentRoom;
+            lastMessageId = null;
+            reconnectAttempts = 0;
             
             highlightSelectedRoom(roomToken);
-            
-            const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            socket = new WebSocket(`${wsProtocol}//${window.location.host}/ws/token/${roomToken}?token=${token}`);
-            socket.onopen = () => {
-                messageInput.disabled = false;
-                messageForm.querySelector('button').disabled = false;
-                chatMessages.innerHTML = '';
-                addSystemMessage(`Joined ${currentRoom}`);
-            };
-            
-            socket.onmessage = (event) => {
-                const message = JSON.parse(event.data);
-                if (message.type === 'system') {
-                    addSystemMessage(message.content);
-                } else if (message.type === 'history') {
-                    addMessage(message, false);
-                } else if (message.type === 'chat') {
-                    addMessage(message, message.sender === username);
-                }
-            };
-            
-            socket.onclose = () => {
-                addSystemMessage(`Disconnected from ${currentRoom}`);
-                resetRoomUI();
-            };
-            
-            socket.onerror = (error) => {
-                console.error('WebSocket error:', error);
-                addSystemMessage('Connection error');
-            };
+            setUnread(roomToken, 0);
+            openSocket(roomToken, null);
             
         } catch (error) {
             console.error('Error joining room:', error);
@@ -626,20 +632,192 @@ async function deleteUser(userId) {
         }
     }
 
+    // Open the room socket; with sinceId the server only sends what we missed
+    function openSocket(roomToken, sinceId) {
+        const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const sinceParam = sinceId != null ? `&since_id=${sinceId}` : '';
+        const roomSocket = new WebSocket(`${wsProtocol}//${window.location.host}/ws/token/${roomToken}?token=${token}${sinceParam}`);
+        socket = roomSocket;
+
+        roomSocket.onopen = () => {
+            messageInput.disabled = false;
+            messageForm.querySelector('button').disabled = false;
+            if (sinceId == null) {
+                chatMessages.innerHTML = '';
+                addSystemMessage(`Joined ${currentRoom}`);
+            } else {
+                addSystemMessage(`Reconnected to ${currentRoom}`);
+            }
+            reconnectAttempts = 0;
+        };
+        
+        const handleFrame = (message) => {
+            if (message.type === 'batch') {
+                // Frames the server coalesced; handled one by one, in order
+                message.frames.forEach(handleFrame);
+            } else if (message.type === 'ping') {
+                roomSocket.send(JSON.stringify({ type: 'pong' }));
+            } else if (message.type === 'unread') {
+                if (message.room_token !== currentRoomToken) setUnread(message.room_token, message.unread);
+            } else if (message.type === 'presence') {
+                applyPresence(message);
+            } else if (message.type === 'system') {
+                addSystemMessage(message.content);
+            } else if (message.type === 'history') {
+                addHistory(message);
+            } else if (message.type === 'chat') {
+                addMessage(message, message.sender === username);
+            }
+        };
+        roomSocket.onmessage = (event) => handleFrame(JSON.parse(event.data));
+        
+        roomSocket.onclose = () => {
+            if (socket !== roomSocket) return;
+            messageInput.disabled = true;
+            messageForm.querySelector('button').disabled = true;
+            if (currentRoomToken === roomToken && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+                const delay = 1000 * 2 ** reconnectAttempts;
+                reconnectAttempts++;
+                addSystemMessage(`Connection lost, reconnecting in ${delay / 1000}s...`);
+                setTimeout(() => {
+                    if (socket === roomSocket && currentRoomToken === roomToken) {
+                        openSocket(roomToken, lastMessageId);
+                    }
+                }, delay);
+                return;
+            }
+            addSystemMessage(`Disconnected from ${currentRoom}`);
+            resetRoomUI();
+        };
+        
+        roomSocket.onerror = (error) => {
+            console.error('WebSocket error:', error);
+            addSystemMessage('Connection error');
+        };
+    }
 
-    // Add message to chat
-    function addMessage(message, isSelf) {
+
+    // Build a chat message element
+    function renderMessage(message, isSelf) {
         const messageEl = document.createElement('div');
         messageEl.className = `chat-message ${isSelf ? 'self' : ''}`;
+        messageEl.dataset.id = message.id;
         messageEl.innerHTML = `
             <div class="sender">${message.sender}</div>
             <div class="content">${message.content}</div>
             <div class="timestamp">${new Date(message.timestamp).toLocaleTimeString()}</div>
         `;
-        chatMessages.appendChild(messageEl);
+        return messageEl;
+    }
+
+    // Add message to chat, keeping id order and skipping ones already shown
+    function addMessage(message, isSelf) {
+        if (chatMessages.querySelector(`.chat-message[data-id="${message.id}"]`)) return;
+        const messageEl = renderMessage(message, isSelf);
+        const shown = chatMessages.querySelectorAll('.chat-message');
+        let next = null;
+        for (let i = shown.length - 1; i >= 0 && Number(shown[i].dataset.id) > message.id; i--) {
+            next = shown[i];
+        }
+        chatMessages.insertBefore(messageEl, next);
+        if (lastMessageId == null || message.id > lastMessageId) {
+            lastMessageId = message.id;
+            scheduleMarkRead();
+        }
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
+    // Add a batched history page; older pages are inserted above what is shown
+    function addHistory(page) {
+        if (page.after_id != null) {
+            // Delta sync after a reconnect
+            page.messages.forEach(message => addMessage(message, message.sender === username));
+            if (page.truncated && socket && socket.readyState === WebSocket.OPEN) {
+                socket.send(JSON.stringify({ type: 'sync', since_id: lastMessageId }));
+            }
+            return;
+        }
+
+        document.getElementById('load-older-btn')?.remove();
+        if (page.before_id == null) {
+            page.messages.forEach(message => addMessage(message, message.sender === username));
+        } else {
+            const previousHeight = chatMessages.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            page.messages.forEach(message => fragment.appendChild(renderMessage(message, message.sender === username)));
+            chatMessages.insertBefore(fragment, chatMessages.querySelector('.chat-message'));
+            chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+        }
+
+        if (page.has_more && page.messages.length) {
+            const loadOlderBtn = document.createElement('button');
+            loadOlderBtn.id = 'load-older-btn';
+            loadOlderBtn.className = 'btn load-older-btn';
+            loadOlderBtn.textContent = 'Load earlier messages';
+            loadOlderBtn.addEventListener('click', () => {
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ type: 'get_history', before_id: page.messages[0].id }));
+                }
+            });
+            chatMessages.prepend(loadOlderBtn);
+        }
+    }
+
+    // Presence: a snapshot ("online") on join, then periodic diffs
+    const onlineUsers = new Set();
+    const typingUsers = new Map();  // username -> timer
+    const TYPING_SHOWN_MS = 4000;
+    const TYPING_SEND_MS = 2000;
+    let lastTypingSent = 0;
+
+    function applyPresence(frame) {
+        if (frame.online) {
+            onlineUsers.clear();
+            frame.online.forEach(name => onlineUsers.add(name));
+        }
+        (frame.joined || []).forEach(name => {
+            onlineUsers.add(name);
+            if (name !== username) addSystemMessage(`${name} joined the chat`);
+        });
+        (frame.left || []).forEach(name => {
+            onlineUsers.delete(name);
+            stopTyping(name);
+            if (name !== username) addSystemMessage(`${name} left the chat`);
+        });
+        (frame.typing || []).forEach(name => {
+            if (name === username) return;
+            clearTimeout(typingUsers.get(name));
+            typingUsers.set(name, setTimeout(() => stopTyping(name), TYPING_SHOWN_MS));
+        });
+        renderUsers();
+        renderTyping();
+    }
+
+    function stopTyping(name) {
+        clearTimeout(typingUsers.get(name));
+        if (typingUsers.delete(name)) renderTyping();
+    }
+
+    function renderUsers() {
+        usersList.innerHTML = '';
+        onlineUsers.forEach(name => {
+            const li = document.createElement('li');
+            li.textContent = name;
+            usersList.appendChild(li);
+        });
+    }
+
+    function renderTyping() {
+        const names = [...typingUsers.keys()];
+        if (names.length === 0) {
+            typingIndicator.textContent = '';
+        } else if (names.length <= 3) {
+            typingIndicator.textContent = `${names.join(', ')} ${names.length === 1 ? 'is' : 'are'} typing...`;
+        } else {
+            typingIndicator.textContent = 'Several people are typing...';
+        }
+    }
+
     // Add system message
     function addSystemMessage(text) {
         const messageEl = document.createElement('p');
@@ -733,6 +911,16 @@ async function deleteUser(userId) {
         if (message && socket && socket.readyState === WebSocket.OPEN) {
             socket.send(message);
             messageInput.value = '';
+            lastTypingSent = 0;
+        }
+    });
+
+    // Tell the room we are typing; the server throttles this further
+    messageInput.addEventListener('input', () => {
+        const now = Date.now();
+        if (socket && socket.readyState === WebSocket.OPEN && now - lastTypingSent > TYPING_SEND_MS) {
+            socket.send(JSON.stringify({ type: 'typing' }));
+            lastTypingSent = now;
         }
     });
 
@@ -741,7 +929,7 @@ async function deleteUser(userId) {
     
     function logout() {
         localStorage.removeItem('token');
-        if (socket) socket.close();
+        closeSocket();
         window.location.href = '/';
     }
 
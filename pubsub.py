@@ -0,0 +1,245 @@
+# pubsub.py
+"""Room broadcast fan-out between worker processes.
+
+ConnectionManager delivers every broadcast to its own sockets right away and
+hands the encoded frame to a PubSub backend, which relays it to the other
+workers. Each backend drops the frames it published itself, so nothing is
+delivered twice.
+
+Backends:
+    memory   - in-process only; several instances can share a hub to simulate
+               workers in tests.
+    postgres - LISTEN/NOTIFY on the application database, for running
+               ``uvicorn --workers N`` or several containers.
+"""
+import asyncio
+import json
+import os
+import select
+from abc import ABC, abstractmethod
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import psycopg2
+
+from connect import connect
+from config import load_config
+from database import run_in_db
+
+# handler(room_token, payload, exclude_user_id)
+Handler = Callable[[str, str, Optional[str]], None]
+
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory")
+NOTIFY_CHANNEL = os.getenv("PUBSUB_CHANNEL", "chat_broadcast")
+# Pseudo room carrying control events between workers; room tokens never contain "*"
+CONTROL_ROOM = "*"
+# NOTIFY payloads must stay under 8000 bytes; chunk by characters so that
+# even 4-byte UTF-8 text plus the header fits
+CHUNK_CHARS = 1800
+
+
+def encode_envelope(room_token: str, payload: str, exclude_user_id: Optional[str]) -> str:
+    # Room tokens and user ids never contain newlines, the payload may
+    return f"{room_token}\n{exclude_user_id or ''}\n{payload}"
+
+
+def decode_envelope(body: str):
+    room_token, exclude_user_id, payload = body.split("\n", 2)
+    return room_token, payload, exclude_user_id or None
+
+
+def encode_event(kind: str, data) -> str:
+    """Payload of a control event, published to CONTROL_ROOM."""
+    return json.dumps({"kind": kind, "data": data})
+
+
+def _notifications(origin: str, seq: int, body: str):
+    parts = [body[i:i + CHUNK_CHARS] for i in range(0, len(body), CHUNK_CHARS)] or [""]
+    return [f"{origin}:{seq}:{index}:{len(parts)}\n{part}" for index, part in enumerate(parts)]
+
+
+def notify(cur, room_token: str, payload: str, channel: str = NOTIFY_CHANNEL):
+    """Publish one frame to every worker from outside the app (e.g. a
+    maintenance run from cron), on the postgres backend's channel.
+
+    Delivered when the cursor's transaction commits.
+    """
+    for notification in _notifications(uuid.uuid4().hex[:12], 1, encode_envelope(room_token, payload, None)):
+        cur.execute("SELECT pg_notify(%s, %s)", (channel, notification))
+
+
+class PubSub(ABC):
+    """Interface for cross-worker room broadcasts."""
+
+    @abstractmethod
+    async def start(self, handler: Handler):
+        """Begin relaying: ``handler`` is called for frames other workers publish."""
+
+    @abstractmethod
+    async def publish(self, room_token: str, payload: str, exclude_user_id: Optional[str] = None):
+        """Send an encoded frame to every other worker."""
+
+    async def stop(self):
+        pass
+
+
+class InMemoryPubSub(PubSub):
+    """Relays between PubSub instances sharing one hub (a set) in this process."""
+
+    def __init__(self, hub: Optional[set] = None):
+        self.hub = hub if hub is not None else set()
+        self.handler = None
+        self._loop = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        self._loop = asyncio.get_running_loop()
+        self.hub.add(self)
+
+    async def publish(self, room_token: str, payload: str, exclude_user_id: Optional[str] = None):
+        for peer in list(self.hub):
+            if peer is not self and peer.handler is not None:
+                # Deliver asynchronously, as a real transport would
+                peer._loop.call_soon_threadsafe(peer.handler, room_token, payload, exclude_user_id)
+
+    async def stop(self):
+        self.hub.discard(self)
+        self.handler = None
+
+
+class PostgresPubSub(PubSub):
+    """LISTEN/NOTIFY relay over the application database.
+
+    Publishes are queued and sent by a single task, several per transaction,
+    so other workers see a room's frames in the order this worker sent them.
+    A dedicated listener connection is polled on a background thread and
+    re-established with backoff if it drops.
+    """
+
+    MAX_PARTIAL = 1000
+
+    def __init__(self, channel: str = NOTIFY_CHANNEL, config: Optional[dict] = None):
+        self.channel = channel
+        self.config = config
+        self.origin = uuid.uuid4().hex[:12]
+        self.handler = None
+        self.published = 0
+        self.received = 0
+        self._seq = 0
+        self._loop = None
+        self._outbox = None
+        self._publisher = None
+        self._listener = None
+        self._stopping = threading.Event()
+        self._partial = OrderedDict()  # {(origin, seq): [parts]}
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        self._loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        self._publisher = asyncio.ensure_future(self._publish_loop())
+        self._listener = threading.Thread(target=self._listen_loop, name="pubsub-listener", daemon=True)
+        self._listener.start()
+
+    async def publish(self, room_token: str, payload: str, exclude_user_id: Optional[str] = None):
+        self._seq += 1
+        for notification in _notifications(self.origin, self._seq, encode_envelope(room_token, payload, exclude_user_id)):
+            self._outbox.put_nowait(notification)
+
+    async def stop(self):
+        self._stopping.set()
+        if self._publisher is not None:
+            self._publisher.cancel()
+            # Last words, e.g. this worker's presence going away
+            batch = []
+            while not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            if batch:
+                try:
+                    await run_in_db(self._notify, batch, commit=True)
+                except Exception as e:
+                    print(f"[PUBSUB] Publish failed, {len(batch)} notifications lost: {str(e)}")
+        if self._listener is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._listener.join, 5)
+        self.handler = None
+
+    async def _publish_loop(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            try:
+                await run_in_db(self._notify, batch, commit=True)
+                self.published += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[PUBSUB] Publish failed, {len(batch)} notifications lost: {str(e)}")
+
+    def _notify(self, cur, batch):
+        for notification in batch:
+            cur.execute("SELECT pg_notify(%s, %s)", (self.channel, notification))
+
+    def _listen_loop(self):
+        backoff = 0.5
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = connect(self.config or load_config())
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+                print(f"[PUBSUB] Listening on {self.channel}")
+                backoff = 0.5
+                while not self._stopping.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._on_notify(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"[PUBSUB] Listener error, reconnecting in {backoff}s: {str(e)}")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _on_notify(self, notification: str):
+        header, part = notification.split("\n", 1)
+        origin, seq, index, count = header.split(":")
+        if origin == self.origin:
+            return
+        count = int(count)
+        if count == 1:
+            body = part
+        else:
+            key = (origin, seq)
+            parts = self._partial.setdefault(key, [None] * count)
+            parts[int(index)] = part
+            if any(p is None for p in parts):
+                while len(self._partial) > self.MAX_PARTIAL:
+                    self._partial.popitem(last=False)
+                return
+            del self._partial[key]
+            body = "".join(parts)
+        self.received += 1
+        room_token, payload, exclude_user_id = decode_envelope(body)
+        self._loop.call_soon_threadsafe(self._dispatch, room_token, payload, exclude_user_id)
+
+    def _dispatch(self, room_token, payload, exclude_user_id):
+        if self.handler is not None:
+            self.handler(room_token, payload, exclude_user_id)
+
+
+def create_pubsub(backend: str = PUBSUB_BACKEND) -> PubSub:
+    if backend == "memory":
+        return InMemoryPubSub()
+    if backend == "postgres":
+        return PostgresPubSub()
+    raise ValueError(f"Unknown PUBSUB_BACKEND {backend!r}, expected 'memory' or 'postgres'")
@@ -0,0 +1,103 @@
+# read_markers.py
+import asyncio
+import json
+import os
+from typing import Optional, Set
+
+from database import execute, fetch_all
+
+# Seconds between unread pushes; rooms with new messages in between are sent once
+UNREAD_PUSH_INTERVAL = float(os.getenv("UNREAD_PUSH_INTERVAL", "1"))
+
+
+async def mark_read(user_id: int, room_id: int, message_id: int) -> Optional[int]:
+    """Move a user's read marker forward to ``message_id``.
+
+    Returns the unread count after the marker, or None if the user is not a
+    participant or the marker was already at or past ``message_id``. Only
+    messages after the marker are counted, which is usually none.
+    """
+    row = await execute("""
+        UPDATE room_participants rp
+        SET last_read_id = %s,
+            unread_count = (
+                SELECT count(*) FROM messages m
+                WHERE m.room_id = rp.room_id AND m.id > %s AND m.sender_id <> rp.user_id
+            )
+        WHERE rp.user_id = %s AND rp.room_id = %s AND rp.last_read_id < %s
+        RETURNING unread_count
+    """, (message_id, message_id, user_id, room_id, message_id), returning=True)
+    return row["unread_count"] if row else None
+
+
+def unread_frame(room_token: str, unread: int, last_read_id: Optional[int] = None) -> str:
+    return json.dumps({
+        "type": "unread",
+        "room_token": room_token,
+        "unread": unread,
+        "last_read_id": last_read_id
+    })
+
+
+class UnreadNotifier:
+    """Pushes unread counts to this worker's connected users.
+
+    Rooms are marked dirty whenever a chat message is seen on this worker
+    (sent here or relayed from another worker). Once per interval the counts
+    for dirty rooms are read for the users connected here, in one indexed
+    query, and sent to each of their sockets.
+    """
+
+    def __init__(self, manager, interval: float = UNREAD_PUSH_INTERVAL):
+        self.manager = manager
+        self.interval = interval
+        self.pushed = 0
+        self._dirty: Set[int] = set()  # room ids
+        self._runner: Optional[asyncio.Task] = None
+
+    def mark(self, room_id: int):
+        if self._runner is not None:
+            self._dirty.add(room_id)
+
+    async def start(self):
+        if self.interval > 0 and self._runner is None:
+            self._runner = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        self._dirty.clear()
+
+    def stats(self) -> dict:
+        return {"unread_pushed": self.pushed, "unread_dirty_rooms": len(self._dirty)}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._dirty:
+                continue
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[ERROR] Unread push failed: {str(e)}")
+
+    async def flush(self):
+        rooms, self._dirty = self._dirty, set()
+        by_user = {}  # {user_id: [connection]}
+        for connection in self.manager.connections.values():
+            by_user.setdefault(connection.user_id, []).append(connection)
+        if not by_user:
+            return
+        rows = await fetch_all("""
+            SELECT rp.user_id, rp.unread_count, rp.last_read_id, r.room_token
+            FROM room_participants rp
+            JOIN rooms r ON r.id = rp.room_id
+            WHERE rp.room_id = ANY(%s) AND rp.user_id = ANY(%s)
+        """, (list(rooms), [int(user_id) for user_id in by_user]))
+        for row in rows:
+            payload = unread_frame(row["room_token"], row["unread_count"], row["last_read_id"])
+            for connection in by_user.get(str(row["user_id"]), ()):
+                # Keyed so a backed-up socket only holds the latest count per room
+                connection.queue.put(payload, key=f"unread:{row['room_token']}")
+                self.pushed += 1
@@ -0,0 +1,88 @@
+# registry.py
+import sys
+import time
+from typing import Dict, Set
+
+from outbound import OutboundQueue
+
+
+def intern_key(value) -> str:
+    """Room tokens and user ids are stored once per process however many
+    connections and indexes refer to them."""
+    return sys.intern(str(value))
+
+
+class Connection:
+    """One WebSocket: who it belongs to, its outbound queue and its rooms."""
+
+    __slots__ = ("user_id", "username", "role", "queue", "rooms", "connected_at", "last_seen", "encoding")
+
+    def __init__(self, user: dict, queue: OutboundQueue, encoding: str = "json"):
+        self.user_id = intern_key(user["user_id"])
+        self.username = user["username"]
+        self.role = user["role"]
+        self.queue = queue
+        self.rooms: Set[str] = set()
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.encoding = encoding  # wire encoding negotiated on connect
+
+    def touch(self):
+        """Record that the client sent something (any frame counts as a pong)."""
+        self.last_seen = time.monotonic()
+
+    @property
+    def websocket(self):
+        return self.queue.websocket
+
+    def user(self) -> dict:
+        """The user as sent to clients (welcome frame)."""
+        return {"username": self.username, "user_id": self.user_id, "role": self.role}
+
+    def estimated_bytes(self) -> int:
+        # The WebSocket object and server-side socket buffers are not included
+        return sys.getsizeof(self) + sys.getsizeof(self.rooms) + self.queue.estimated_bytes()
+
+
+class RoomMembers:
+    """This worker's connections to one room, how many each user has, and
+    what broadcasting to it has cost and saved since its first member joined."""
+
+    __slots__ = ("connections", "sessions", "frames_sent", "bytes_sent", "frames_saved", "bytes_saved")
+
+    def __init__(self):
+        self.connections: Set[Connection] = set()
+        self.sessions: Dict[str, int] = {}  # {user_id: connections in this room}
+        # Frames and payload bytes queued to members; frames saved by batching
+        # and bytes saved by compact encodings, compared with one JSON frame each
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_saved = 0
+        self.bytes_saved = 0
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection: Connection) -> bool:
+        """Add a connection; True if it is its user's first one in the room."""
+        self.connections.add(connection)
+        count = self.sessions.get(connection.user_id, 0) + 1
+        self.sessions[connection.user_id] = count
+        return count == 1
+
+    def usernames(self):
+        """Each connected user's name once."""
+        return dict.fromkeys(connection.username for connection in self.connections)
+
+    def remove(self, connection: Connection) -> bool:
+        """Remove a connection; True if it was its user's last one in the room."""
+        self.connections.discard(connection)
+        remaining = self.sessions.get(connection.user_id, 1) - 1
+        if remaining:
+            self.sessions[connection.user_id] = remaining
+            return False
+        self.sessions.pop(connection.user_id, None)
+        return True
+
+    def estimated_bytes(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.connections) + sys.getsizeof(self.sessions)
@@ -0,0 +1,11 @@
+# room_cache.py
+import os
+
+from ttl_cache import TTLCache
+
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", "300"))
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", "10000"))
+
+# {room_token: room row (id, name, description, created_by, is_private, ...)};
+# updates and deletes call invalidate_room, which clears it on every worker
+room_cache = TTLCache(ROOM_CACHE_SIZE, ROOM_CACHE_TTL)
@@ -0,0 +1,112 @@
+# search.py
+from typing import Optional
+
+from database import fetch_page
+
+# Text search configuration; must match the generated column in
+# db/init/03_message_search.sql or the GIN index is not used
+SEARCH_CONFIG = "english"
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_QUERY_LENGTH = 200
+
+RANK = "rank"
+RECENT = "recent"
+SORTS = (RANK, RECENT)
+
+# Content is HTML-escaped before highlighting, so snippets are safe to render
+# as HTML with matches wrapped in <mark>
+SNIPPET_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8, MaxFragments=2, FragmentDelimiter=\" … \""
+ESCAPED_CONTENT = "replace(replace(replace(h.content, '&', '&amp;'), '<', '&lt;'), '>', '&gt;')"
+
+
+class SearchError(ValueError):
+    """Invalid search request (empty query, bad cursor or sort)."""
+
+
+def _encode_cursor(sort: str, row) -> str:
+    if sort == RANK:
+        return f"{row['rank']!r}:{row['id']}"
+    return str(row["id"])
+
+
+def _decode_cursor(sort: str, cursor: str):
+    try:
+        if sort == RANK:
+            rank, message_id = cursor.split(":")
+            return float(rank), int(message_id)
+        return int(cursor)
+    except ValueError:
+        raise SearchError("Invalid cursor")
+
+
+async def search_messages(
+    q: str,
+    user_id: int,
+    room_id: Optional[int] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    sort: str = RANK
+) -> dict:
+    """Messages matching ``q`` in one room, or in every room the user created or joined.
+
+    Results are ordered by relevance (``rank``) or newest first (``recent``)
+    and paged by keyset: pass ``next_cursor`` back as ``cursor`` for the next
+    page. Snippets are only built for the rows on the page.
+    """
+    q = (q or "").strip()
+    if not q or len(q) > MAX_QUERY_LENGTH:
+        raise SearchError(f"Query must be 1-{MAX_QUERY_LENGTH} characters")
+    if sort not in SORTS:
+        raise SearchError(f"Unknown sort {sort!r}, expected 'rank' or 'recent'")
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+
+    conditions = ["m.content_tsv @@ tsq"]
+    params = [q]
+    if room_id is not None:
+        conditions.append("m.room_id = %s")
+        params.append(room_id)
+    else:
+        conditions.append("""m.room_id IN (
+            SELECT id FROM rooms WHERE created_by = %s
+            UNION SELECT room_id FROM room_participants WHERE user_id = %s
+        )""")
+        params.extend([user_id, user_id])
+    if cursor:
+        if sort == RANK:
+            conditions.append("(ts_rank(m.content_tsv, tsq), m.id) < (%s::real, %s)")
+            params.extend(_decode_cursor(sort, cursor))
+        else:
+            conditions.append("m.id < %s")
+            params.append(_decode_cursor(sort, cursor))
+    order = "rank DESC, id DESC" if sort == RANK else "id DESC"
+
+    rows, has_more = await fetch_page(f"""
+        SELECT h.id, h.room_id, h.created_at, h.rank,
+               u.username AS sender, r.room_token, r.name AS room_name,
+               ts_headline('{SEARCH_CONFIG}', {ESCAPED_CONTENT}, h.tsq, '{SNIPPET_OPTIONS}') AS snippet
+        FROM (
+            SELECT m.id, m.room_id, m.sender_id, m.created_at, m.content, tsq,
+                   ts_rank(m.content_tsv, tsq) AS rank
+            FROM messages m, websearch_to_tsquery('{SEARCH_CONFIG}', %s) tsq
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {order}
+            LIMIT %s
+        ) h
+        JOIN users u ON u.id = h.sender_id
+        JOIN rooms r ON r.id = h.room_id
+        ORDER BY {order}
+    """, params, limit)
+    return {
+        "results": [{
+            "id": row["id"],
+            "room_id": row["room_id"],
+            "room_token": row["room_token"],
+            "room_name": row["room_name"],
+            "sender": row["sender"],
+            "snippet": row["snippet"],
+            "timestamp": row["created_at"].isoformat(),
+            "rank": row["rank"]
+        } for row in rows],
+        "next_cursor": _encode_cursor(sort, rows[-1]) if has_more else None
+    }
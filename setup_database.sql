@@ -24,6 +24,9 @@ CREATE TABLE rooms (
     room_token VARCHAR(255) UNIQUE
 );
 
+-- Admin listings filtered by creator are paged by id
+CREATE INDEX IF NOT EXISTS idx_rooms_created_by ON rooms(created_by, id);
+
 -- Room participants
 CREATE TABLE room_participants (
     user_id INTEGER REFERENCES users(id),
@@ -32,15 +35,23 @@ CREATE TABLE room_participants (
     PRIMARY KEY (user_id, room_id)
 );
 
--- Messages table
+-- Messages table, range-partitioned by month on created_at
 CREATE TABLE messages (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     content TEXT NOT NULL,
     room_id INTEGER REFERENCES rooms(id),
     sender_id INTEGER REFERENCES users(id),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
 -- Create indexes
-CREATE INDEX idx_messages_room ON messages(room_id);
-CREATE INDEX idx_messages_sender ON messages(sender_id);
\ No newline at end of file
+-- (room_id, id) serves history pages by keyset and also covers plain room_id lookups
+CREATE INDEX idx_messages_room_id ON messages(room_id, id);
+CREATE INDEX idx_messages_sender ON messages(sender_id);
+
+-- Monthly partitions and retention settings
+\ir db/init/02_message_partitions.sql
+\ir db/init/03_message_search.sql
+\ir db/init/04_read_markers.sql
+\ir db/init/05_room_coalescing.sql
@@ -0,0 +1,40 @@
+# tests/fakes.py
+"""In-memory stand-ins shared by the tests. Nothing here needs a database."""
+import asyncio
+
+
+class FakeWebSocket:
+    """Records every frame the server sends; ``delay`` slows each send down."""
+
+    def __init__(self, subprotocols=(), headers=(), delay: float = 0.0):
+        self.scope = {"subprotocols": list(subprotocols), "headers": list(headers)}
+        self.delay = delay
+        self.sent = []
+        self.subprotocol = None
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, data: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+def user(user_id: int) -> dict:
+    return {"user_id": str(user_id), "username": f"user{user_id}", "role": "user"}
+
+
+async def settle(rounds: int = 5):
+    """Let writer tasks and scheduled callbacks run."""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
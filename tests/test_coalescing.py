@@ -0,0 +1,63 @@
+# tests/test_coalescing.py
+import asyncio
+import json
+
+from coalescing import FrameCoalescer
+
+
+def _coalescer(**options):
+    delivered = []
+    coalescer = FrameCoalescer(lambda room, payload, count: delivered.append((room, payload, count)), **options)
+    return coalescer, delivered
+
+
+def test_frames_in_one_window_go_out_as_one_batch():
+    async def scenario():
+        coalescer, delivered = _coalescer(window_ms=5)
+        assert coalescer.add("room", '{"n": 1}')
+        assert coalescer.add("room", '{"n": 2}')
+        assert delivered == []
+        await asyncio.sleep(0.02)
+        return coalescer, delivered
+
+    coalescer, delivered = asyncio.run(scenario())
+    [(room, payload, count)] = delivered
+    assert (room, count) == ("room", 2)
+    assert json.loads(payload) == {"type": "batch", "frames": [{"n": 1}, {"n": 2}]}
+    assert coalescer.stats() == {"coalesce_batches": 1, "coalesce_batched_frames": 2, "coalesce_pending_rooms": 0}
+
+
+def test_single_frame_is_sent_unchanged():
+    async def scenario():
+        coalescer, delivered = _coalescer(window_ms=1)
+        coalescer.add("room", '{"n": 1}')
+        await asyncio.sleep(0.01)
+        return delivered
+
+    assert asyncio.run(scenario()) == [("room", '{"n": 1}', 1)]
+
+
+def test_max_frames_flushes_early():
+    async def scenario():
+        coalescer, delivered = _coalescer(window_ms=1000, max_frames=2)
+        for n in range(3):
+            coalescer.add("room", str(n))
+        sent = list(delivered)
+        coalescer.flush_all()
+        return sent, delivered
+
+    sent, delivered = asyncio.run(scenario())
+    assert sent == [("room", '{"type": "batch", "frames": [0, 1]}', 2)]
+    assert delivered[-1] == ("room", "2", 1)
+
+
+def test_rooms_without_a_window_are_not_held():
+    async def scenario():
+        coalescer, delivered = _coalescer(window_ms=0)
+        held = coalescer.add("room", "1")
+        coalescer.set_window("slow", 1000)
+        coalescer.add("slow", "2")
+        coalescer.set_window("slow", None)  # back to the default of 0 sends what was held
+        return held, delivered, coalescer.window("slow")
+
+    assert asyncio.run(scenario()) == (False, [("slow", "2", 1)], 0)
@@ -0,0 +1,54 @@
+# tests/test_history_cache.py
+from history_cache import RoomHistoryCache
+
+
+def _message(message_id: int) -> dict:
+    return {"id": message_id, "sender": "a", "content": f"m{message_id}", "timestamp": ""}
+
+
+def _ids(messages):
+    return [message["id"] for message in messages]
+
+
+def test_cold_room_is_a_miss_until_warmed():
+    cache = RoomHistoryCache(per_room=3)
+    assert cache.get(1) is None
+    cache.append(1, _message(1))  # cold rooms stay cold
+    assert cache.get(1) is None
+    cache.warm(1, [_message(1), _message(2)])
+    assert _ids(cache.get(1)) == [1, 2]
+    assert cache.is_complete(1)
+
+
+def test_keeps_latest_per_room_in_id_order():
+    cache = RoomHistoryCache(per_room=3)
+    cache.warm(1, [_message(1), _message(2), _message(3)])
+    assert not cache.is_complete(1)
+    cache.append(1, _message(5))
+    cache.append(1, _message(4))  # late arrival from another worker
+    cache.append(1, _message(5))  # duplicate
+    assert _ids(cache.get(1)) == [3, 4, 5]
+
+
+def test_appends_during_warm_are_merged():
+    cache = RoomHistoryCache(per_room=5)
+    cache.begin_warm(1)
+    cache.append(1, _message(3))
+    assert _ids(cache.warm(1, [_message(1), _message(2)])) == [1, 2, 3]
+
+
+def test_least_recently_used_room_is_evicted():
+    cache = RoomHistoryCache(per_room=2, max_rooms=2)
+    cache.warm(1, [_message(1)])
+    cache.warm(2, [_message(2)])
+    cache.get(1)
+    cache.warm(3, [_message(3)])
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert cache.evictions == 1
+
+
+def test_byte_budget_evicts_rooms():
+    cache = RoomHistoryCache(per_room=10, max_bytes=1000)
+    cache.warm(1, [_message(i) for i in range(1, 4)])
+    assert len(cache) == 0 and cache.bytes == 0
@@ -0,0 +1,67 @@
+# tests/test_history_invalidation.py
+import json
+
+import chat_ws
+import maintenance
+from history_cache import RoomHistoryCache
+from pubsub import CONTROL_ROOM, decode_envelope, encode_event
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.statements.append((query, params))
+
+    def commit(self):
+        self.commits += 1
+
+
+def _warm_cache(monkeypatch):
+    cache = RoomHistoryCache()
+    for room_id in (1, 2):
+        cache.warm(room_id, [{"id": room_id, "sender": "a", "content": "old", "timestamp": ""}])
+    monkeypatch.setattr(chat_ws, "history_cache", cache)
+    return cache
+
+
+def test_pruned_rooms_are_published_to_every_worker(monkeypatch):
+    monkeypatch.setattr(maintenance, "PUBSUB_BACKEND", "postgres")
+    conn = RecordingConnection()
+    called = []
+    maintenance.invalidate_history(conn, [2], called.append)
+
+    [(query, (channel, notification))] = conn.statements
+    header, body = notification.split("\n", 1)
+    assert query == "SELECT pg_notify(%s, %s)" and header.endswith(":1:0:1")
+    room_token, payload, _ = decode_envelope(body)
+    assert room_token == CONTROL_ROOM
+    assert json.loads(payload) == {"kind": "history_invalidated", "data": [2]}
+    assert conn.commits == 1 and called == [[2]]
+
+
+def test_memory_backend_only_tells_this_worker(monkeypatch):
+    monkeypatch.setattr(maintenance, "PUBSUB_BACKEND", "memory")
+    conn = RecordingConnection()
+    called = []
+    maintenance.invalidate_history(conn, None, called.append)
+    assert conn.statements == [] and called == [None]
+
+
+def test_history_invalidated_event_drops_cached_rooms(monkeypatch):
+    cache = _warm_cache(monkeypatch)
+    chat_ws.manager._on_remote(CONTROL_ROOM, encode_event("history_invalidated", [2]))
+    assert cache.get(1) is not None and cache.get(2) is None
+    chat_ws.manager._on_remote(CONTROL_ROOM, encode_event("history_invalidated", None))
+    assert len(cache) == 0 and cache.bytes == 0
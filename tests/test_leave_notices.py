@@ -0,0 +1,59 @@
+# tests/test_leave_notices.py
+import asyncio
+import json
+
+import chat_ws
+from fakes import FakeWebSocket, settle, user
+
+
+def _run_with_presence_interval(interval: float, scenario):
+    manager = chat_ws.manager
+    saved = manager.presence.interval, manager.ping_timeout
+    manager.presence.interval = interval
+    manager.ping_timeout = 60
+    try:
+        return asyncio.run(scenario(manager))
+    finally:
+        manager.presence.interval, manager.ping_timeout = saved
+
+
+async def _leave(manager):
+    stays, goes = FakeWebSocket(), FakeWebSocket()
+    staying = await manager.connect(stays, "leave-room", user(1))
+    leaving = await manager.connect(goes, "leave-room", user(2))
+    manager.disconnect(leaving)
+    await settle()
+    manager.disconnect(staying)
+    return [json.loads(frame) for frame in stays.sent]
+
+
+def test_leave_is_announced_when_presence_is_off():
+    frames = _run_with_presence_interval(0, _leave)
+    assert frames == [{
+        "type": "system",
+        "content": "user2 left the chat",
+        "users": ["user2"],
+        "room_token": "leave-room"
+    }]
+
+
+def test_presence_diffs_replace_leave_messages():
+    assert _run_with_presence_interval(1, _leave) == []
+
+
+def test_reaped_users_share_one_leave_message():
+    async def scenario(manager):
+        stays = FakeWebSocket()
+        staying = await manager.connect(stays, "reap-room", user(1))
+        idle = [await manager.connect(FakeWebSocket(), "reap-room", user(i)) for i in range(2, 9)]
+        for connection in idle:
+            connection.last_seen -= 120
+        assert manager.reap() == len(idle)
+        await settle()
+        manager.disconnect(staying)
+        return [json.loads(frame) for frame in stays.sent]
+
+    frames = _run_with_presence_interval(0, scenario)
+    assert len(frames) == 1
+    assert frames[0]["content"] == "user2, user3, user4, user5, user6 and 2 others left the chat"
+    assert len(frames[0]["users"]) == 7
@@ -0,0 +1,125 @@
+# tests/test_message_writer.py
+import asyncio
+
+import pytest
+
+import psycopg2
+
+import message_writer
+from message_writer import BROADCAST_FIRST, MessageWriter
+
+
+DELETED_ROOM = 13
+
+
+class FakeCursor:
+    """Hands out sequence values out of order, as concurrent nextval calls can."""
+
+    def __init__(self):
+        self.inserted = []
+        self.next_id = 100
+
+    def execute(self, query, params):
+        self.count = params[0]
+
+    def fetchall(self):
+        ids = range(self.next_id, self.next_id + self.count)
+        self.next_id += self.count
+        return [(i,) for i in reversed(ids)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    cursor = FakeCursor()
+    batches = []
+
+    async def run_in_db(fn, *args, commit=False):
+        batches.append(len(args[0]))
+        return fn(cursor, *args)
+
+    def execute_values(cur, query, rows, page_size=None):
+        if query.startswith("INSERT"):
+            if any(row[3] == DELETED_ROOM for row in rows):
+                raise psycopg2.IntegrityError("violates foreign key constraint")
+            cur.inserted.extend(rows)
+
+    monkeypatch.setattr(message_writer, "run_in_db", run_in_db)
+    monkeypatch.setattr(message_writer, "execute_values", execute_values)
+    return cursor, batches
+
+
+@pytest.mark.parametrize("durability", ["commit", BROADCAST_FIRST])
+def test_ids_follow_submission_order_in_one_batch(database, durability):
+    cursor, batches = database
+
+    async def scenario():
+        writer = MessageWriter(max_batch=10, max_delay=0.01, durability=durability)
+        results = await asyncio.gather(*(writer.submit(f"m{i}", 1, 7) for i in range(4)))
+        await writer.stop()
+        return results, writer.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert [result["id"] for result in results] == [100, 101, 102, 103]
+    assert [row[:2] for row in cursor.inserted] == [(100, "m0"), (101, "m1"), (102, "m2"), (103, "m3")]
+    assert batches == [4]
+    assert stats["batches"] == 1 and stats["written"] == 4
+
+
+@pytest.mark.parametrize("durability", ["commit", BROADCAST_FIRST])
+def test_bad_row_only_fails_its_own_sender(database, durability):
+    cursor, batches = database
+
+    async def scenario():
+        writer = MessageWriter(max_batch=10, max_delay=0.01, durability=durability)
+        rooms = [7, 7, DELETED_ROOM, 8, 7]
+        results = await asyncio.gather(
+            *(writer.submit(f"m{i}", 1, room) for i, room in enumerate(rooms)),
+            return_exceptions=True
+        )
+        await writer.stop()
+        return results, writer.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert isinstance(results.pop(2), psycopg2.IntegrityError)
+    # Retried messages keep the ids they were given, still in submission order
+    assert [result["id"] for result in results] == [100, 101, 103, 104]
+    assert [row[:2] for row in cursor.inserted] == [(100, "m0"), (101, "m1"), (103, "m3"), (104, "m4")]
+    assert stats["written"] == 4 and stats["failed"] == 1
+
+
+def test_database_outage_is_not_retried(monkeypatch):
+    calls = []
+
+    async def run_in_db(fn, *args, commit=False):
+        calls.append(len(args[0]))
+        raise psycopg2.OperationalError("connection lost")
+
+    monkeypatch.setattr(message_writer, "run_in_db", run_in_db)
+
+    async def scenario():
+        writer = MessageWriter(max_delay=0.01)
+        results = await asyncio.gather(*(writer.submit("m", 1, 7) for _ in range(3)), return_exceptions=True)
+        await writer.stop()
+        return results, writer.failed
+
+    results, failed = asyncio.run(scenario())
+    assert all(isinstance(result, psycopg2.OperationalError) for result in results)
+    assert calls == [3] and failed == 3
+
+
+def test_nul_content_is_rejected_before_queueing(database):
+    cursor, batches = database
+
+    async def scenario():
+        writer = MessageWriter(max_delay=0)
+        with pytest.raises(ValueError):
+            await writer.submit("a\x00b", 1, 7)
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert batches == [] and cursor.inserted == []
+
+
+def test_unknown_durability_is_rejected():
+    with pytest.raises(ValueError):
+        MessageWriter(durability="sometimes")
@@ -0,0 +1,20 @@
+# tests/test_metrics.py
+import metrics
+
+
+def test_slow_query_log_keeps_templates(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "SLOW_QUERY_MS", 1)
+    metrics.record_query("SELECT *\n  FROM messages WHERE room_id = %s", 0.5)
+    assert capsys.readouterr().out == "[SLOW QUERY] 500.0ms SELECT * FROM messages WHERE room_id = %s\n"
+
+
+def test_slow_query_log_drops_rendered_values(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "SLOW_QUERY_MS", 1)
+    metrics.record_query(b"INSERT INTO messages (id, content) VALUES (1,'my secret'),(2,'another')", 0.5)
+    metrics.record_query(b"UPDATE room_participants rp SET n = 1 FROM (VALUES (1,'x')) AS b", 0.5)
+    metrics.record_query(b"SELECT 'my secret'", 0.5)
+    assert capsys.readouterr().out.splitlines() == [
+        "[SLOW QUERY] 500.0ms INSERT INTO messages (id, content) VALUES ... (rendered)",
+        "[SLOW QUERY] 500.0ms UPDATE room_participants rp SET n = 1 FROM (VALUES ... (rendered)",
+        "[SLOW QUERY] 500.0ms SELECT (rendered)"
+    ]
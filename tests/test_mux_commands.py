@@ -0,0 +1,43 @@
+# tests/test_mux_commands.py
+import asyncio
+import json
+
+import chat_ws
+from chat_ws import ConnectionManager, handle_mux_command
+from fakes import FakeWebSocket, settle, user
+
+
+async def _mux_connection():
+    manager = ConnectionManager(ping_interval=0, ping_timeout=0)
+    websocket = FakeWebSocket()
+    connection = await manager.accept(websocket, user(1))
+    return manager, websocket, connection
+
+
+def test_pong_on_mux_socket_gets_no_answer():
+    async def scenario():
+        manager, websocket, connection = await _mux_connection()
+        await handle_mux_command({"type": "pong"}, connection, {})
+        await settle()
+        manager.disconnect(connection)
+        return websocket.sent
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_room_command_without_subscription_is_rejected():
+    async def scenario():
+        manager, websocket, connection = await _mux_connection()
+        await handle_mux_command({"type": "typing", "room_token": "abc"}, connection, {})
+        await settle()
+        manager.disconnect(connection)
+        return websocket.sent
+
+    sent = asyncio.run(scenario())
+    assert [json.loads(frame) for frame in sent] == [
+        {"type": "error", "room_token": "abc", "content": "Not subscribed to that room"}
+    ]
+
+
+def test_pong_parses_as_mux_command():
+    assert chat_ws.parse_command('{"type": "pong"}', chat_ws.MUX_COMMANDS) == {"type": "pong"}
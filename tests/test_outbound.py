@@ -0,0 +1,76 @@
+# tests/test_outbound.py
+import asyncio
+
+from fastapi import status
+
+from fakes import FakeWebSocket, settle
+from outbound import COALESCE, DISCONNECT, DROP_OLDEST, SLOW_CONSUMER, OutboundQueue
+
+
+def _filled(policy: str, frames, maxsize: int = 3, **options):
+    """Queue frames without a writer running, as if the client were stalled."""
+    queue = OutboundQueue(FakeWebSocket(), maxsize=maxsize, policy=policy, **options)
+    results = [queue.put(*frame) if isinstance(frame, tuple) else queue.put(frame) for frame in frames]
+    return queue, results
+
+
+def _queued(queue):
+    return [payload for _, payload in queue._frames]
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    queue, results = _filled(DROP_OLDEST, ["1", "2", "3", "4", "5"])
+    assert results == [True] * 5
+    assert _queued(queue) == ["3", "4", "5"]
+    assert queue.dropped == 2
+
+
+def test_coalesce_replaces_queued_frame_with_same_key():
+    queue, _ = _filled(COALESCE, ["a", ("p1", "presence"), "b", ("p2", "presence")])
+    assert _queued(queue) == ["a", "p2", "b"]
+    assert queue.coalesced == 1
+
+
+def test_keys_are_ignored_without_the_coalesce_policy():
+    queue, _ = _filled(DROP_OLDEST, [("p1", "presence"), ("p2", "presence")])
+    assert _queued(queue) == ["p1", "p2"]
+
+
+def test_disconnect_closes_a_slow_consumer():
+    async def scenario():
+        failures = []
+        queue, results = _filled(DISCONNECT, ["1", "2", "3", "4"], on_failure=failures.append)
+        await settle()
+        return queue, results, failures
+
+    queue, results, failures = asyncio.run(scenario())
+    assert results == [True, True, True, False]
+    assert queue.closed and queue.failure == SLOW_CONSUMER
+    assert failures == [queue]
+    assert queue.websocket.closed_with == status.WS_1013_TRY_AGAIN_LATER
+    assert queue.dropped == 4
+
+
+def test_writer_sends_in_order_and_encodes_text():
+    async def scenario():
+        websocket = FakeWebSocket()
+        queue = OutboundQueue(websocket, encoder=lambda text: text.encode()).start()
+        queue.put("a")
+        queue.put(b"b")
+        await settle()
+        queue.close()
+        return websocket.sent, queue.sent
+
+    assert asyncio.run(scenario()) == ([b"a", b"b"], 2)
+
+
+def test_stuck_send_fails_the_next_put():
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(delay=1), send_timeout=0.01).start()
+        queue.put("first")
+        await settle()
+        await asyncio.sleep(0.02)
+        accepted = queue.put("second")
+        return accepted, queue.failure
+
+    assert asyncio.run(scenario()) == (False, "send timed out")
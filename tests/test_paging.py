@@ -0,0 +1,70 @@
+# tests/test_paging.py
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import chat_ws
+import database
+
+
+class FakeQueue:
+    def __init__(self):
+        self.frames = []
+
+    def put(self, payload, key=None):
+        self.frames.append(json.loads(payload))
+        return True
+
+
+def _rows(ids):
+    start = datetime(2024, 1, 1)
+    return [{"id": i, "sender": "a", "content": f"m{i}", "created_at": start + timedelta(seconds=i)} for i in ids]
+
+
+def _serve(monkeypatch, table):
+    """database.fetch_all over an in-memory message table, honouring the bound LIMIT."""
+    calls = []
+
+    async def fetch_all(query, params=None):
+        calls.append(params)
+        room_id, *bounds, limit = params
+        rows = table
+        if "m.id < %s" in query:
+            rows = [row for row in rows if row["id"] < bounds[0]]
+        if "m.id > %s" in query:
+            rows = [row for row in rows if row["id"] > bounds[0]]
+        rows = sorted(rows, key=lambda row: row["id"], reverse="DESC" in query)
+        return rows[:limit]
+
+    monkeypatch.setattr(database, "fetch_all", fetch_all)
+    monkeypatch.setattr(chat_ws, "fetch_all", fetch_all)
+    return calls
+
+
+def test_fetch_page_reports_more_rows(monkeypatch):
+    async def fetch_all(query, params=None):
+        return list(range(params[-1]))[:5]
+
+    monkeypatch.setattr(database, "fetch_all", fetch_all)
+    assert asyncio.run(database.fetch_page("... LIMIT %s", [], 3)) == ([0, 1, 2], True)
+    assert asyncio.run(database.fetch_page("... LIMIT %s", [], 5)) == ([0, 1, 2, 3, 4], False)
+
+
+def test_older_history_page(monkeypatch):
+    calls = _serve(monkeypatch, _rows(range(1, 31)))
+    queue = FakeQueue()
+    asyncio.run(chat_ws.send_recent_messages(queue, 1, limit=10, before_id=15, room_token="r"))
+    frame = queue.frames[0]
+    assert [m["id"] for m in frame["messages"]] == list(range(5, 15))
+    assert frame["has_more"] is True
+    assert calls == [[1, 15, 11]]
+
+
+def test_sync_streams_batches_until_caught_up(monkeypatch):
+    _serve(monkeypatch, _rows(range(1, 251)))
+    monkeypatch.setattr(chat_ws, "history_cache", chat_ws.RoomHistoryCache())
+    queue = FakeQueue()
+    asyncio.run(chat_ws.send_messages_since(queue, 1, 20, "r"))
+    assert [len(frame["messages"]) for frame in queue.frames] == [100, 100, 30]
+    assert [frame["has_more"] for frame in queue.frames] == [True, True, False]
+    assert queue.frames[-1]["messages"][-1]["id"] == 250
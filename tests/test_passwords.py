@@ -0,0 +1,19 @@
+# tests/test_passwords.py
+import asyncio
+
+from passwords import PasswordHasher
+
+
+def test_process_pool_is_spawned_and_round_trips():
+    hasher = PasswordHasher(workers=1, pool="process")
+
+    async def scenario():
+        hashed = await hasher.hash("secret")
+        return hashed, await hasher.verify_and_update("secret", hashed)
+
+    try:
+        hashed, (valid, new_hash) = asyncio.run(scenario())
+        assert hasher._executor._mp_context.get_start_method() == "spawn"
+    finally:
+        hasher.shutdown()
+    assert valid and new_hash is None
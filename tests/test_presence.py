@@ -0,0 +1,64 @@
+# tests/test_presence.py
+from presence import PresenceTracker
+
+
+def test_joins_and_leaves_collect_into_one_frame_per_room():
+    tracker = PresenceTracker(interval=1)
+    tracker.joined("room", "1", "alice")
+    tracker.joined("room", "2", "bob")
+    tracker.left("room", "2", "bob")  # back and forth within one interval
+    tracker.left("other", "3", "carol")
+    assert tracker.drain() == [
+        ("room", {"type": "presence", "joined": ["alice"], "left": [], "typing": []}),
+        ("other", {"type": "presence", "joined": [], "left": ["carol"], "typing": []})
+    ]
+    assert tracker.drain() == []
+
+
+def test_rejoin_within_interval_is_no_change():
+    tracker = PresenceTracker(interval=1)
+    tracker.left("room", "1", "alice")
+    tracker.joined("room", "1", "alice")
+    assert tracker.drain() == []
+
+
+def test_typing_is_throttled_per_user_and_room():
+    tracker = PresenceTracker(interval=1, typing_throttle=60)
+    assert tracker.typing("room", "1", "alice")
+    assert not tracker.typing("room", "1", "alice")
+    assert tracker.typing("other", "1", "alice")
+    tracker.left("room", "1", "alice")  # leaving clears both typing and throttle
+    frames = dict(tracker.drain())
+    assert frames["room"]["typing"] == [] and frames["other"]["typing"] == ["alice"]
+    assert tracker.typing("room", "1", "alice")
+    assert tracker.stats()["typing_throttled"] == 1
+
+
+def test_disabled_tracker_records_nothing():
+    tracker = PresenceTracker(interval=0)
+    tracker.joined("room", "1", "alice")
+    assert not tracker.typing("room", "1", "alice")
+    assert tracker.drain() == []
+
+
+def test_snapshot_merges_remote_workers_lists():
+    tracker = PresenceTracker(interval=1, snapshot_max=2)
+    tracker.apply_state({"worker": "w2", "rooms": {"room": ["bob", "alice"], "other": ["dave"]}})
+    tracker.apply_state({"worker": "w3", "rooms": {"room": ["carol"]}})
+    assert tracker.snapshot("room", ["alice"]) == {
+        "type": "presence", "room_token": "room", "online": ["alice", "bob"], "count": 3
+    }
+    # A newer list replaces the worker's previous one; None means it shut down
+    tracker.apply_state({"worker": "w2", "rooms": {"other": ["dave"]}})
+    tracker.apply_state({"worker": "w3", "rooms": None})
+    assert tracker.snapshot("room", ["alice"])["online"] == ["alice"]
+
+
+def test_silent_workers_are_forgotten():
+    tracker = PresenceTracker(interval=1, sync_interval=5)
+    tracker.apply_state({"worker": "w2", "rooms": {"room": ["bob"]}})
+    tracker.apply_state(tracker.state({"room": ["ignored"]}))  # our own list echoed back
+    assert tracker.snapshot("room", [])["online"] == ["bob"]
+    tracker._remote_seen["w2"] -= 16
+    assert tracker.snapshot("room", [])["online"] == []
+    assert tracker.remote == {}
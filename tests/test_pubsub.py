@@ -0,0 +1,75 @@
+# tests/test_pubsub.py
+import asyncio
+import json
+
+import pytest
+
+from chat_ws import ConnectionManager
+from fakes import FakeWebSocket, settle, user
+from pubsub import InMemoryPubSub, PubSub, decode_envelope, encode_envelope
+
+
+def test_pubsub_is_abstract():
+    with pytest.raises(TypeError):
+        PubSub()
+
+
+def test_envelope_round_trip_keeps_newlines_in_payload():
+    body = encode_envelope("room", '{"content": "a\\nb"}\nraw', "7")
+    assert decode_envelope(body) == ("room", '{"content": "a\\nb"}\nraw', "7")
+    assert decode_envelope(encode_envelope("room", "x", None)) == ("room", "x", None)
+
+
+def test_in_memory_relay_skips_the_publisher():
+    async def scenario():
+        hub = set()
+        received = {"a": [], "b": []}
+        a, b = InMemoryPubSub(hub), InMemoryPubSub(hub)
+        await a.start(lambda *args: received["a"].append(args))
+        await b.start(lambda *args: received["b"].append(args))
+        await a.publish("room", "frame")
+        await settle()
+        await b.stop()
+        await a.publish("room", "after stop")
+        await settle()
+        return received
+
+    assert asyncio.run(scenario()) == {"a": [], "b": [("room", "frame", None)]}
+
+
+def test_broadcast_reaches_members_on_every_worker_once():
+    async def scenario():
+        hub = set()
+        workers = [ConnectionManager(ping_interval=0, ping_timeout=0) for _ in range(2)]
+        for worker in workers:
+            worker.presence.interval = 0  # only chat frames in this test
+            await worker.start(InMemoryPubSub(hub))
+        sockets = [FakeWebSocket(), FakeWebSocket()]
+        for i, (worker, websocket) in enumerate(zip(workers, sockets)):
+            await worker.connect(websocket, "room", user(i))
+        await workers[0].broadcast({"type": "chat", "content": "hi"}, "room")
+        await settle()
+        for worker in workers:
+            await worker.stop()
+        return [[json.loads(frame) for frame in websocket.sent] for websocket in sockets]
+
+    local, remote = asyncio.run(scenario())
+    assert local == remote == [{"type": "chat", "content": "hi", "room_token": "room"}]
+
+
+def test_late_worker_is_seeded_and_forgets_stopped_workers():
+    async def scenario():
+        hub = set()
+        early, late = (ConnectionManager(ping_interval=0, ping_timeout=0) for _ in range(2))
+        await early.start(InMemoryPubSub(hub))
+        await early.connect(FakeWebSocket(), "room", user(1))
+        await late.start(InMemoryPubSub(hub))
+        await settle(10)
+        seeded = late.presence.snapshot("room", [])["online"]
+        await early.stop()
+        await settle(10)
+        after_stop = late.presence.snapshot("room", [])["online"]
+        await late.stop()
+        return seeded, after_stop
+
+    assert asyncio.run(scenario()) == (["user1"], [])
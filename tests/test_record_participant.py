@@ -0,0 +1,42 @@
+# tests/test_record_participant.py
+import asyncio
+
+import chat_ws
+
+
+def test_repeat_joins_write_once(monkeypatch):
+    writes = []
+
+    async def execute(query, params=None, returning=False):
+        writes.append(params)
+
+    monkeypatch.setattr(chat_ws, "execute", execute)
+    monkeypatch.setattr(chat_ws, "participant_cache", chat_ws.TTLCache(100))
+
+    async def scenario():
+        for _ in range(3):
+            await chat_ws.record_participant(1, 10)
+        await chat_ws.record_participant(2, 10)
+
+    asyncio.run(scenario())
+    assert writes == [(1, 10), (2, 10)]
+
+
+def test_failed_write_is_retried_on_next_join(monkeypatch):
+    calls = []
+
+    async def execute(query, params=None, returning=False):
+        calls.append(params)
+        if len(calls) == 1:
+            raise RuntimeError("pool exhausted")
+
+    monkeypatch.setattr(chat_ws, "execute", execute)
+    monkeypatch.setattr(chat_ws, "participant_cache", chat_ws.TTLCache(100))
+
+    async def scenario():
+        await chat_ws.record_participant(1, 10)
+        await chat_ws.record_participant(1, 10)
+        await chat_ws.record_participant(1, 10)
+
+    asyncio.run(scenario())
+    assert calls == [(1, 10), (1, 10)]
@@ -0,0 +1,78 @@
+# tests/test_room_settings.py
+import asyncio
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+
+import main
+import maintenance
+
+
+@pytest.mark.parametrize("settings", [
+    {"message_retention_days": 0},
+    {"message_retention_days": -5},
+    {"message_retention_days": "30"},
+    {"message_retention_days": True},
+    {"coalesce_window_ms": -1},
+    {"coalesce_window_ms": 5000},
+    {"coalesce_window_ms": 2.5},
+])
+def test_invalid_room_settings_are_rejected_before_the_database(settings):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.update_room("room-token", settings, user={"id": 1}))
+    assert error.value.status_code == 400
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if "FROM messages_default" in query:
+            self.result = [(month,) for month in self.conn.months]
+            return
+        month = params[0]
+        if month in self.conn.failing:
+            raise RuntimeError("partition clash")
+        self.conn.created.append(month)
+        self.result = [(f"messages_y{month:%Y}m{month:%m}",)]
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0]
+
+
+class FakeConnection:
+    def __init__(self, months, failing=()):
+        self.months = months
+        self.failing = set(failing)
+        self.created = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_default_partition_months_are_partitioned_one_by_one():
+    months = [date(2024, 3, 1), date(2024, 1, 1), date(2024, 2, 1)]
+    conn = FakeConnection(months, failing=[date(2024, 2, 1)])
+    maintenance.drain_default_partition(conn)
+    # A failing month is skipped without stopping the others
+    assert conn.created == [date(2024, 1, 1), date(2024, 3, 1)]
+    assert conn.rollbacks == 1
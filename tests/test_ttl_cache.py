@@ -0,0 +1,38 @@
+# tests/test_ttl_cache.py
+import time
+
+from ttl_cache import TTLCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(10, ttl=0.01)
+    cache.set("room", {"id": 1})
+    assert cache.get("room") == {"id": 1}
+    time.sleep(0.02)
+    assert cache.get("room") is None
+    assert len(cache) == 0
+
+
+def test_explicit_expiry_overrides_ttl():
+    cache = TTLCache(10, ttl=60)
+    cache.set("token", {"sub": "a"}, expires_at=time.time() - 1)
+    assert cache.get("token") is None
+
+
+def test_invalidate_and_stats():
+    cache = TTLCache(10)
+    cache.set("k", "v")
+    cache.get("k")
+    cache.invalidate("k")
+    cache.get("k")
+    assert cache.stats() == {"size": 0, "hits": 1, "misses": 1}
@@ -0,0 +1,52 @@
+# ttl_cache.py
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire.
+
+    An entry lives ``ttl`` seconds, unless ``set`` is given its own
+    ``expires_at`` (epoch seconds, e.g. a token's ``exp``); with neither it
+    stays until evicted. Beyond ``max_size`` entries the least recently used
+    go first. Writers must call ``invalidate`` when the cached data changes.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()  # {key: (expires_at, value)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, expires_at: Optional[float] = None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl if self.ttl is not None else float("inf")
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
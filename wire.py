@@ -0,0 +1,152 @@
+# wire.py
+import json
+from datetime import datetime, timezone
+from typing import Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # optional: without it every client gets JSON
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+# Offered as WebSocket subprotocols; ?encoding=msgpack works as well
+SUBPROTOCOLS = {"chat.json": JSON, "chat.msgpack": MSGPACK}
+
+# Field names in compact (msgpack) frames. Timestamps become integer epoch
+# milliseconds, and room_id is left out wherever room_token is present.
+SHORT_KEYS = {
+    "type": "t",
+    "id": "i",
+    "sender": "s",
+    "content": "c",
+    "timestamp": "ts",
+    "room_token": "r",
+    "room_id": "ri",
+    "messages": "m",
+    "has_more": "hm",
+    "before_id": "b",
+    "after_id": "a",
+    "truncated": "tr",
+    "user": "u",
+    "users": "us",
+    "username": "un",
+    "user_id": "ui",
+    "role": "ro",
+    "online": "o",
+    "count": "n",
+    "joined": "j",
+    "left": "l",
+    "typing": "ty",
+    "unread": "ur",
+    "last_read_id": "lr",
+    "results": "rs",
+    "next_cursor": "nc",
+    "snippet": "sn",
+    "rank": "rk",
+    "room_name": "rn",
+    "room": "rm",
+    "name": "nm",
+    "scope": "sc",
+    "encoding": "e",
+    "since_id": "si",
+    "limit": "lm",
+    "cursor": "cu",
+    "sort": "so",
+    "message_id": "mi",
+    "frames": "f",
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+
+def available() -> Tuple[str, ...]:
+    return (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+def negotiate(subprotocols, requested: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """(encoding, subprotocol to accept) for a new socket.
+
+    A subprotocol the client offered wins over the ``encoding`` query
+    parameter. msgpack is only chosen when the package is installed.
+    """
+    for offered in subprotocols or ():
+        encoding = SUBPROTOCOLS.get(offered)
+        if encoding is not None and encoding in available():
+            return encoding, offered
+    if requested in available():
+        return requested, None
+    return JSON, None
+
+
+def _epoch_ms(value: str) -> Union[int, str]:
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)  # stored as naive UTC
+    return int(moment.timestamp() * 1000)
+
+
+def compact(value):
+    """A frame (or part of one) with short keys and integer timestamps."""
+    if isinstance(value, dict):
+        drop_room_id = "room_token" in value
+        out = {}
+        for key, item in value.items():
+            if key == "room_id" and drop_room_id:
+                continue
+            if key == "timestamp" and isinstance(item, str):
+                item = _epoch_ms(item)
+            out[SHORT_KEYS.get(key, key)] = compact(item)
+        return out
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def pack(message: dict) -> bytes:
+    return msgpack.packb(compact(message), use_bin_type=True)
+
+
+def pack_json(payload: str) -> bytes:
+    """Re-encode a JSON frame as compact msgpack."""
+    return pack(json.loads(payload))
+
+
+def encoder(encoding: str):
+    """What an OutboundQueue applies to JSON text frames before sending, or None."""
+    return pack_json if encoding == MSGPACK else None
+
+
+def unpack_command(data: bytes) -> str:
+    """A binary client frame as the text the receive loops expect.
+
+    msgpack clients send either a string (a chat message) or a command map,
+    with short or long keys.
+    """
+    if msgpack is None:
+        raise ValueError("Binary frames need the msgpack encoding")
+    value = msgpack.unpackb(data, raw=False)
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return json.dumps({LONG_KEYS.get(key, key): item for key, item in value.items()})
+    raise ValueError("Expected a string or a map")
+
+
+class EncodedFrame:
+    """One broadcast frame, encoded at most once per wire encoding."""
+
+    __slots__ = ("text", "_packed")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._packed = None
+
+    def get(self, encoding: str) -> Union[str, bytes]:
+        if encoding == JSON:
+            return self.text
+        if self._packed is None:
+            self._packed = pack_json(self.text)
+        return self._packed